@@ -0,0 +1,532 @@
+import asyncio
+import time
+
+import aiohttp
+
+from urllib.parse import urljoin, urlsplit
+from src import config
+from src import codec
+from src import ingest
+from src.lifecycle import event_state
+from src.log import logging, quote_log
+from src.offers import offer_deadline, OFFER_EXPIRED
+from src.metrics import registry
+from src.session import refresh_delay, token_expiry
+from src.parlay_connect import ParlayInteractions, ASK_AGE, ASK_PARSE, ASK_PRICE, ASK_SERIALIZE, ASK_SEND, \
+    ASK_TOTAL, ASK_UNPRICED, ASK_SEND_FAILED, CONFIRM_PARSE, CONFIRM_PRICE, CONFIRM_SEND, CONFIRM_SEND_FAILED, \
+    ASK_DUPLICATE, CONFIRM_DUPLICATE, ASK_OVER_LIMIT
+
+ASK_DROPPED = registry.counter('ask_dropped_inflight_total')     # asks over ASYNC_MAX_INFLIGHT
+
+
+class AsyncParlayInteractions(ParlayInteractions):
+    # asyncio flavour of ParlayInteractions with the same surface, every I/O method is a coroutine.
+    # REST goes through one pooled aiohttp session, the pusher protocol is spoken directly over an
+    # aiohttp websocket and every ask is priced in its own task, so there is no thread per call.
+    # Catalog, pricing, quote cache and metrics are shared with the threaded client
+    session: aiohttp.ClientSession = None
+    auth_header: dict = dict()
+    ask_tasks: dict = dict()    # parlay_id -> task handling its ask, the confirm waits for it
+
+    def __init__(self):
+        super().__init__()
+        self.session = None
+        self.auth_header = dict()
+        self.ask_tasks = dict()
+        self.offer_slots = dict()   # callback host -> asyncio.Semaphore, see provide_price
+        self.background_tasks = set()
+        self.subscribed = None
+        self.websocket_task = None
+        self.websocket = None
+        self.socket_id = None
+        self.subscribed_channels = set()
+
+    def _http_clients(self) -> tuple:
+        # no requests transport nor offer sender threads, REST and offers go through self.session
+        return None, None
+
+    async def close(self):
+        for task in list(self.background_tasks) + [self.websocket_task]:
+            if task is not None:
+                task.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.metrics_writer.stop()
+
+    async def login(self) -> dict:
+        login_url = urljoin(self.base_url, config.URL['mm_login'])
+        request_body = {
+            'access_key': self.mm_keys.get('access_key'),
+            'secret_key': self.mm_keys.get('secret_key'),
+        }
+        status, content = await self._request('POST', login_url, data=codec.dumps(request_body))
+        if status != 200:
+            logging.debug(content)
+            raise Exception("login failed")
+        mm_session = codec.loads(content)['data']
+        self._set_session(mm_session)
+        logging.info("MM session started")
+        return mm_session
+
+    def _set_session(self, mm_session: dict):
+        # _channel_auth reads auth_header per call, so swapping it is all the websocket needs
+        self.mm_session = mm_session
+        self.token_expires_at = token_expiry(mm_session)
+        self.auth_header = {'Authorization': f'Bearer {mm_session["access_token"]}'}
+
+    async def extend_session(self):
+        # same as ParlayInteractions.extend_session, the websocket stays up
+        refresh_url = urljoin(self.base_url, config.URL['mm_refresh'])
+        status, content = await self._request('POST', refresh_url,
+                                              json={'refresh_token': self.mm_session['refresh_token']})
+        if status != 200:
+            logging.info("Failed to call refresh endpoint")
+            await self.login()
+        else:
+            self._set_session({**self.mm_session, **codec.loads(content)['data']})
+        if self.websocket is not None and not self.websocket.closed:
+            await self._subscribe_channels(self.websocket, self.socket_id)
+
+    async def _session_loop(self):
+        # SessionManager of the asyncio client
+        retry = config.SESSION_RETRY_MIN
+        delay = refresh_delay(self.token_expires_at)
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.extend_session()
+            except Exception as e:
+                logging.error(f"failed to extend session, retrying in {retry}s, error: {e}")
+                delay = retry
+                retry = min(retry * 2, config.SESSION_RETRY_MAX)
+                continue
+            retry = config.SESSION_RETRY_MIN
+            delay = max(refresh_delay(self.token_expires_at), config.SESSION_RETRY_MIN)
+            logging.info(f"session extended, next refresh in {int(delay)}s")
+
+    async def seeding(self, incremental: bool = False):
+        self._load_valid_odds()
+        logging.info("start seeding tournaments/events/markets")
+        started = time.monotonic()
+        seeded_before = len(self.sport_events) > 0
+        t_url = urljoin(self.base_url, config.URL['mm_tournaments'])
+        try:
+            status, content = await self._get_with_retry(t_url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.info(f"failed to get tournaments, error: {e}")
+            status, content = None, None
+        if status != 200:
+            if not seeded_before:
+                raise Exception("not able to seed tournaments")
+            # if seeded before, ignore one time failure
+            return
+        all_tournaments = codec.loads(content).get('data', {}).get('tournaments', {})
+        self.all_tournaments = all_tournaments
+
+        event_url = urljoin(self.base_url, config.URL['mm_events'])
+        market_url = urljoin(self.base_url, config.URL['mm_markets'])
+        sport_events = dict()
+        event_records = dict()
+        tournament_events = dict()
+        failed_tournaments = set()
+        my_tournaments = dict()
+        now_ns = time.time_ns()
+        limit = asyncio.Semaphore(config.SEEDING_CONCURRENCY)
+
+        async def seed_event(event):
+            try:
+                async with limit:
+                    status, content = await self._get_with_retry(market_url, params={'event_id': event['event_id']})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._keep_previous(sport_events, event['event_id'], incremental)
+                logging.info(f'failed to get markets of events {event["name"]}, error: {e}')
+                return
+            if status != 200:
+                self._keep_previous(sport_events, event['event_id'], incremental)
+                logging.info(f'failed to get markets of events {event["name"]}, status: {status}')
+                return
+            records = ingest.market_records(content, event['event_id'])
+            if records is None:
+                # this is more like a bug in MM api, as the event actually already closed
+                return
+            event_records[event['event_id']] = records
+            sport_events[event['event_id']] = event
+
+        async def seed_tournament(one_t):
+            try:
+                async with limit:
+                    status, content = await self._get_with_retry(event_url, params={'tournament_id': one_t['id']})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, content = None, e
+            if status != 200:
+                failed_tournaments.add(one_t['id'])
+                logging.info(f'skip tournament {one_t["name"]} as api request failed')
+                return
+            events = codec.loads(content).get('data', {}).get('sport_events')
+            if events is None:
+                return
+            tournament_events[one_t['id']] = {event['event_id'] for event in events}
+            to_fetch = []
+            for event in events:
+                if event_state(event, now_ns) == 'closed':
+                    continue
+                current = self.sport_events.get(event['event_id'])
+                if incremental and current is not None and self._same_event(current, event):
+                    sport_events[event['event_id']] = current
+                else:
+                    to_fetch.append(seed_event(event))
+            await asyncio.gather(*to_fetch)
+
+        interested = []
+        for one_t in all_tournaments:
+            if one_t['name'] in config.TOURNAMENTS_INTERESTED or config.LOAD_ALL_TOURNAMENTS:
+                my_tournaments[one_t['id']] = one_t
+                if not self.lifecycle.skip_tournament(one_t['id']):
+                    interested.append(seed_tournament(one_t))
+        await asyncio.gather(*interested)
+        self.my_tournaments = my_tournaments
+        self._apply_seed(sport_events, event_records, tournament_events, failed_tournaments, incremental,
+                         seeded_before, started)
+        await asyncio.to_thread(self._save_snapshot)
+
+    async def get_balance(self):
+        balance_url = urljoin(self.base_url, config.URL['mm_balance'])
+        status, content = await self._request('GET', balance_url)
+        if status != 200:
+            logging.error("failed to get balance")
+            return None
+        self.balance = codec.loads(content).get('data', {}).get('balance', 0)
+        self.exposure_ledger.reconcile(self.balance)
+        logging.info(f"still have ${self.balance} left")
+        return self.balance
+
+    def cancel_all_wagers(self) -> dict:
+        # src/wagers.py runs on the threaded client's transport and blocking get_balance
+        raise Exception("cancelling open wagers needs the threaded or sharded client, not the asyncio one")
+
+    async def send_supported_lines(self):
+        # same delta and chunking rules as ParlayInteractions.send_supported_lines
+        started = time.monotonic()
+        supported_url = urljoin(self.base_url, config.URL['parlay_supported_lines'])
+        chunks = self._supported_lines_chunks()
+        if len(chunks) == 0:
+            return
+        limit = asyncio.Semaphore(config.SUPPORTED_LINES_CONCURRENCY)
+
+        async def post_chunk(key, chunk):
+            body = codec.dumps({key: chunk})
+            try:
+                async with limit:
+                    status, _ = await self._request('POST', supported_url, data=body,
+                                                    headers={'Content-Type': 'application/json'})
+                return key, chunk, len(body), status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"failed to send supported lines, error: {e}")
+                return key, chunk, len(body), False
+
+        results = await asyncio.gather(*(post_chunk(key, chunk) for key, chunk in chunks))
+        self._record_publish(results, started)
+
+    async def refresh(self):
+        await self.seeding(incremental=True)
+        await self.send_supported_lines()
+
+    async def keep_alive(self):
+        # runs forever: periodic incremental reseed and supported lines publish, balance
+        # reconciliation and the event eviction sweep
+        self.metrics_writer.start()
+        self._spawn(self._session_loop())
+        self._spawn(self._balance_loop())
+        self._spawn(self._sweep_loop())
+        if self.warm_started:
+            self._spawn(self.refresh())
+        while True:
+            await asyncio.sleep(config.RESEED_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.exception(f"failed to refresh, error: {e}")
+
+    async def _sweep_loop(self):
+        # the eviction sweep rebuilds the catalog, off the event loop
+        while True:
+            await asyncio.sleep(config.EVENT_SWEEP_INTERVAL)
+            try:
+                await asyncio.to_thread(self.lifecycle.sweep)
+            except Exception as e:
+                logging.exception(f"failed to sweep events, error: {e}")
+
+    async def _balance_loop(self):
+        while True:
+            await asyncio.sleep(config.BALANCE_INTERVAL)
+            try:
+                await self.get_balance()
+            except Exception as e:
+                logging.exception(f"failed to reconcile balance, error: {e}")
+
+    async def subscribe(self):
+        # connect the pusher websocket in the background and return once the channels are bound
+        connection_configs = await self._get_connection_config()
+        url = config.PUSHER_URL.format(key=connection_configs['key'], cluster=connection_configs['cluster'])
+        self.subscribed = asyncio.Event()
+        self.websocket_task = asyncio.create_task(self._websocket_loop(url))
+        await self.subscribed.wait()
+
+    async def provide_price(self, price_quote_request: codec.AskRequest):
+        # have to be valid for more than 5 seconds
+        now_nanno = int((time.time() + 500) * 1000000000)
+        started = time.perf_counter_ns()
+        deadline = offer_deadline(price_quote_request, now_nanno, self.dispatcher.max_age_ns)
+        quote = self._price_ask(price_quote_request)
+        if quote is None and await self.market_loader.load_async(price_quote_request.market_lines,
+                                                                 self._load_timeout(deadline)):
+            quote = self._price_ask(price_quote_request)
+        priced = time.perf_counter_ns()
+        ASK_PRICE.record(priced - started)
+        if quote is None:
+            ASK_UNPRICED.inc()
+            return
+        offer_tails = self._offer_tails(price_quote_request, quote)
+        if offer_tails is None:
+            ASK_OVER_LIMIT.inc()
+            return
+        self._remember_quote(price_quote_request.parlay_id, quote)
+        body = codec.encode_offers(price_quote_request.parlay_id, now_nanno, offer_tails)
+        serialized = time.perf_counter_ns()
+        ASK_SERIALIZE.record(serialized - priced)
+        # same deadline as the threaded client's offer sender, checked once a connection to the
+        # host is free: an overloaded host drops the offers that went stale waiting, rather than
+        # spending every offer's deadline in the connector's queue
+        async with self._offer_slot(price_quote_request.callback_url):
+            picked = time.perf_counter_ns()
+            remaining = deadline - time.time_ns()
+            if remaining < config.OFFER_MIN_LEAD_MS * 1000000:
+                OFFER_EXPIRED.inc()
+                return
+            try:
+                status, _ = await self._request('POST', price_quote_request.callback_url, data=body,
+                                                timeout=aiohttp.ClientTimeout(total=remaining / 1e9))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                status = None
+        sent = time.perf_counter_ns()
+        ASK_SEND.record(sent - picked)
+        ASK_TOTAL.record(sent - started)
+        if status != 200:
+            ASK_SEND_FAILED.inc()
+            quote_log.error("price did not sent successfully, status %s", status, parlay_id=price_quote_request.parlay_id)
+
+    def _offer_slot(self, url: str) -> asyncio.Semaphore:
+        # one per callback host, as many as the connector keeps connections to it
+        host = urlsplit(url).netloc
+        slot = self.offer_slots.get(host)
+        if slot is None:
+            slot = self.offer_slots[host] = asyncio.Semaphore(config.HTTP_POOL_SIZE)
+        return slot
+
+    async def _get_markets(self, event_id: int):
+        # as ParlayInteractions._get_markets
+        market_url = urljoin(self.base_url, config.URL['mm_markets'])
+        try:
+            status, content = await self._request('GET', market_url, params={'event_id': event_id})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.info(f"failed to get markets of event {event_id}, error: {e}")
+            return None
+        if status != 200:
+            logging.info(f"failed to get markets of event {event_id}, status {status}")
+            return None
+        return content
+
+    async def confirm_price(self, price_confirm_request: codec.ConfirmRequest):
+        started = time.perf_counter_ns()
+        answer = self._confirm_body(price_confirm_request)
+        body = codec.dumps(answer)
+        serialized = time.perf_counter_ns()
+        CONFIRM_PRICE.record(serialized - started)
+        # the reservation an accept took in _confirm_body goes when the confirm does not get through
+        try:
+            (status, _), error = await self._request('POST', price_confirm_request.callback_url, data=body), None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, error = None, e
+        CONFIRM_SEND.record(time.perf_counter_ns() - serialized)
+        if status != 200:
+            CONFIRM_SEND_FAILED.inc()
+            if answer['action'] == 'accept':
+                self.exposure_ledger.release(price_confirm_request.parlay_id)
+            quote_log.error("price did not confirm successfully, status %s, error %s", status, error,
+                            parlay_id=price_confirm_request.parlay_id)
+
+    async def _get_channels(self, socket_id: str):
+        auth_endpoint_url = urljoin(self.base_url, config.URL['parlay_websocket_auth'])
+        status, content = await self._request('POST', auth_endpoint_url, data={'socket_id': socket_id})
+        if status != 200:
+            logging.error("failed to get channels")
+            raise Exception("failed to get channels")
+        return codec.loads(content).get('data').get('authorized_channel', [])
+
+    async def _get_connection_config(self):
+        connection_config_url = urljoin(self.base_url, config.URL['parlay_connection_config'])
+        status, content = await self._request('GET', connection_config_url)
+        if status != 200:
+            logging.error("failed to get connection configs")
+            raise Exception("failed to get channels")
+        return codec.loads(content)
+
+    async def _channel_auth(self, socket_id: str, channel_name: str) -> str:
+        auth_endpoint_url = urljoin(self.base_url, config.URL['parlay_websocket_auth'])
+        status, content = await self._request('POST', auth_endpoint_url,
+                                              data={'channel_name': channel_name, 'socket_id': socket_id})
+        if status != 200:
+            raise Exception(f"failed to get auth token for {channel_name}")
+        return codec.loads(content)['auth']
+
+    async def _websocket_loop(self, url: str):
+        # reconnects with exponential backoff for as long as the client runs
+        backoff = config.WEBSOCKET_RECONNECT_MIN
+        while True:
+            try:
+                async with self.session.ws_connect(url, autoping=True) as ws:
+                    backoff = config.WEBSOCKET_RECONNECT_MIN
+                    await self._read_websocket(ws)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"pusher connection failed, error: {e}")
+            logging.info(f"pusher connection closed, reconnecting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, config.WEBSOCKET_RECONNECT_MAX)
+
+    async def _read_websocket(self, ws):
+        activity_timeout = config.WEBSOCKET_ACTIVITY_TIMEOUT
+        ping_sent = False
+        while True:
+            try:
+                msg = await ws.receive(timeout=activity_timeout)
+            except asyncio.TimeoutError:
+                if ping_sent:
+                    raise Exception("pusher did not answer ping")
+                await ws.send_str('{"event":"pusher:ping","data":{}}')
+                ping_sent = True
+                continue
+            ping_sent = False
+            if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                return
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            message = codec.loads(msg.data)
+            event = message.get('event')
+            if 'channel' in message:
+                self._on_channel_event(event, message.get('data'))
+            elif event == 'pusher:connection_established':
+                data = codec.loads(message['data'])
+                activity_timeout = min(data.get('activity_timeout', activity_timeout), activity_timeout)
+                await self._subscribe_channels(ws, data['socket_id'])
+            elif event == 'pusher:ping':
+                await ws.send_str('{"event":"pusher:pong","data":{}}')
+            elif event == 'pusher:error':
+                logging.error(f"pusher error {message.get('data')}")
+
+    async def _subscribe_channels(self, ws, socket_id: str):
+        # as ParlayInteractions._register_channels: on a new socket everything is subscribed, on
+        # the same socket only channels that came, before the ones that went are unsubscribed
+        if socket_id != self.socket_id:
+            self.websocket = ws
+            self.socket_id = socket_id
+            self.subscribed_channels = set()
+        wanted = set()
+        for channel in await self._get_channels(socket_id):
+            channel_name = channel['channel_name']
+            wanted.add(channel_name)
+            if channel_name in self.subscribed_channels:
+                continue
+            data = {'channel': channel_name}
+            if channel_name.startswith('private-') or channel_name.startswith('presence-'):
+                data['auth'] = await self._channel_auth(socket_id, channel_name)
+            await ws.send_str(codec.dumps({'event': 'pusher:subscribe', 'data': data}).decode())
+            logging.info(f"subscribed to {channel_name}, events: {channel['binding_events']}")
+        for channel_name in self.subscribed_channels - wanted:
+            await ws.send_str(codec.dumps({'event': 'pusher:unsubscribe', 'data': {'channel': channel_name}}).decode())
+            logging.info(f"unsubscribed from {channel_name}")
+        self.subscribed_channels = wanted
+        self.subscribed.set()
+
+    def _on_channel_event(self, event: str, data):
+        started = time.perf_counter_ns()
+        try:
+            if event == 'price.ask.new':
+                ask = codec.decode_ask(data)
+                ASK_PARSE.record(time.perf_counter_ns() - started)
+                if ask.created_at is not None:
+                    ASK_AGE.record(time.time_ns() - ask.created_at)
+                if self.seen_asks.seen(ask.parlay_id):
+                    ASK_DUPLICATE.inc()
+                    return
+                self.start_ask(ask)
+            elif event == 'price.confirm.new':
+                confirm = codec.decode_confirm(data)
+                CONFIRM_PARSE.record(time.perf_counter_ns() - started)
+                if self.seen_confirms.seen(confirm.parlay_id):
+                    CONFIRM_DUPLICATE.inc()
+                    return
+                self._spawn(self._confirm_after_ask(confirm))
+            elif event == 'order.finalized':
+                self.order_finalized(codec.decode_finalized(data))
+        except (codec.InvalidPayload, ValueError) as e:
+            quote_log.error("invalid %s payload, error: %s", event, e)
+
+    def start_ask(self, ask: codec.AskRequest):
+        # a task per ask, up to ASYNC_MAX_INFLIGHT of them. Also how the supervisor's worker
+        # processes take the asks handed to them
+        if len(self.ask_tasks) >= config.ASYNC_MAX_INFLIGHT:
+            ASK_DROPPED.inc()
+            return
+        if self.dispatcher.is_stale(ask):
+            self.dispatcher.drop_stale()
+            return
+        task = self._spawn(self.provide_price(ask))
+        self.ask_tasks[ask.parlay_id] = task
+        task.add_done_callback(lambda _: self.ask_tasks.pop(ask.parlay_id, None))
+
+    async def _confirm_after_ask(self, confirm: codec.ConfirmRequest):
+        # a confirm can only follow our offer, but make sure the offer task is done before confirming
+        ask_task = self.ask_tasks.get(confirm.parlay_id)
+        if ask_task is not None:
+            await asyncio.wait([ask_task])
+        await self.confirm_price(confirm)
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            quote_log.error("quote task failed, error: %s", task.exception())
+
+    async def _get_with_retry(self, url, params=None):
+        delay = config.RETRY_BACKOFF
+        for attempt in range(config.REQUEST_RETRIES + 1):
+            last_attempt = attempt == config.REQUEST_RETRIES
+            try:
+                status, content = await self._request('GET', url, params=params)
+                if status < 500 or last_attempt:
+                    return status, content
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def _request(self, method: str, url: str, headers: dict = None, **kwargs):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=config.HTTP_POOL_HOSTS * config.HTTP_POOL_SIZE,
+                                             limit_per_host=config.HTTP_POOL_SIZE)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=config.REQUEST_TIMEOUT))
+        request_headers = self.auth_header
+        if headers:
+            request_headers = {**request_headers, **headers}
+        async with self.session.request(method, url, headers=request_headers, **kwargs) as response:
+            return response.status, await response.read()
@@ -0,0 +1,177 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+# the line_id index quoting runs on, built from the mm_markets responses by src/ingest.py
+#   python -m src.catalog bench --events 2000    memory of the catalog vs the raw market json
+
+
+class LineRecord:
+    # one quotable line, the only fields pricing needs out of the raw market json
+    __slots__ = ('line_id', 'event_id', 'market_id', 'outcome_id', 'line', 'odds')
+
+    def __init__(self, line_id: str, event_id: int, market_id: int, outcome_id: int, line: float, odds: int):
+        self.line_id = line_id
+        self.event_id = event_id
+        self.market_id = market_id
+        self.outcome_id = outcome_id
+        self.line = line
+        self.odds = odds
+
+    def __repr__(self):
+        return f'LineRecord({self.line_id}, event={self.event_id}, market={self.market_id}, ' \
+               f'outcome={self.outcome_id}, line={self.line}, odds={self.odds})'
+
+
+def iter_market_selections(market: dict):
+    # yield (line, selection) for every selection of a market, whether it is a flat
+    # 'selections' market (moneyline) or a 'market_lines' one (spread, totals)
+    if 'selections' in market:
+        for selection in market['selections']:
+            if len(selection) > 0:
+                yield selection[0].get('line'), selection[0]
+    elif 'market_lines' in market:
+        for market_line in market['market_lines']:
+            for selection in market_line.get('selections', []):
+                if len(selection) > 0:
+                    yield selection[0].get('line', market_line.get('line')), selection[0]
+
+
+class LineCatalog:
+    # line_id -> LineRecord index over the seeded sport events, with secondary indexes by
+    # event and by (event, market). Built once per seed, or copied with replaced(), and never
+    # mutated afterwards
+    lines: dict = dict()
+    by_event: dict = dict()
+    by_market: dict = dict()
+
+    def __init__(self):
+        self.lines = dict()
+        self.by_event = dict()
+        self.by_market = dict()
+
+    @classmethod
+    def build(cls, sport_events: dict, records: dict, previous: 'LineCatalog' = None,
+              reuse: set = ()) -> 'LineCatalog':
+        # records maps event id -> LineRecords of the freshly fetched events, see src/ingest.py.
+        # Events listed in reuse are unchanged since `previous` was built, their records are shared
+        catalog = cls()
+        for event_id in sport_events:
+            if previous is not None and event_id in reuse:
+                event_records = previous.lines_for_event(event_id)
+            else:
+                event_records = records.get(event_id, ())
+            for record in event_records:
+                catalog.add(record)
+        return catalog
+
+    @classmethod
+    def from_records(cls, records) -> 'LineCatalog':
+        # line_id index only, the by event and by market indexes are built on first use. Quoting
+        # needs just the former, so a catalog loaded from disk or shared memory quotes sooner
+        catalog = cls()
+        catalog.lines = {record.line_id: record for record in records}
+        catalog.by_event = None
+        catalog.by_market = None
+        return catalog
+
+    def replaced(self, event_records: dict, removed=()) -> 'LineCatalog':
+        # a copy without the lines of the events in removed and with those of event_records in
+        # place of what their events had. Copies the indexes rather than rebuilding them, for the
+        # few events evicted or fetched between seeds
+        if self.by_event is None:
+            self._index()
+        catalog = LineCatalog()
+        catalog.lines = dict(self.lines)
+        catalog.by_event = dict(self.by_event)
+        catalog.by_market = dict(self.by_market)
+        for event_id in [*removed, *event_records]:
+            for record in catalog.by_event.pop(event_id, ()):
+                catalog.lines.pop(record.line_id, None)
+                catalog.by_market.pop((event_id, record.market_id), None)
+        for records in event_records.values():
+            for record in records:
+                catalog.add(record)
+        return catalog
+
+    def _index(self):
+        by_event = dict()
+        by_market = dict()
+        for record in self.lines.values():
+            by_event.setdefault(record.event_id, []).append(record)
+            by_market.setdefault((record.event_id, record.market_id), []).append(record)
+        self.by_market = by_market
+        self.by_event = by_event
+
+    def add(self, record: LineRecord):
+        if self.by_event is None:
+            self._index()
+        self.lines[record.line_id] = record
+        self.by_event.setdefault(record.event_id, []).append(record)
+        self.by_market.setdefault((record.event_id, record.market_id), []).append(record)
+
+    def get(self, line_id: str) -> LineRecord:
+        return self.lines.get(line_id)
+
+    def lines_for_event(self, event_id: int) -> list:
+        if self.by_event is None:
+            self._index()
+        return self.by_event.get(event_id, [])
+
+    def lines_for_market(self, event_id: int, market_id: int) -> list:
+        if self.by_market is None:
+            self._index()
+        return self.by_market.get((event_id, market_id), [])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, line_id: str):
+        return line_id in self.lines
+
+
+def bench(events: int, tournaments: int) -> dict:
+    # bytes held for the markets of a synthetic replay catalog: every decoded mm_markets body, as
+    # sport_events used to keep them, vs the LineCatalog built from the same bodies
+    from src import codec
+    from src import config
+    from src import ingest
+    from src import replay
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'catalog.replay.gz')
+        replay.synthesize(path, tournaments=tournaments, events=max(events // tournaments, 1), asks=0)
+        _, responses, _ = replay.read_replay(path)
+    bodies = {int(query[0][1]): body.encode() for (_, path_, query), (_, body) in responses.items()
+              if path_.endswith(config.URL['mm_markets'])}
+    results = {'events': len(bodies), 'json_bytes': sum(len(body) for body in bodies.values())}
+    for name, build in (('raw', lambda: {event_id: codec.loads(body) for event_id, body in bodies.items()}),
+                        ('catalog', lambda: LineCatalog.build(bodies, {event_id: ingest.market_records(body, event_id)
+                                                                       for event_id, body in bodies.items()}))):
+        gc.collect()
+        tracemalloc.start()
+        held = build()
+        results[f'{name}_bytes'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        if name == 'catalog':
+            results['lines'] = len(held)
+        del held
+    results['catalog_bytes_per_line'] = round(results['catalog_bytes'] / max(results['lines'], 1), 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.catalog', description='line catalog tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='memory of the line catalog vs the raw market json')
+    p.add_argument('--events', type=int, default=2000)
+    p.add_argument('--tournaments', type=int, default=20)
+    args = parser.parse_args()
+    sys.stdout.write(json.dumps(bench(args.events, args.tournaments)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
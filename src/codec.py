@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# json codec for websocket payloads and REST bodies: orjson when installed, then msgspec, then the
+# standard library. dumps always returns bytes, loads takes bytes or str
+#   python -m src.codec bench load.replay.gz    decode and offer encode cost over a replay file
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    BACKEND = 'orjson'
+except ImportError:
+    try:
+        import msgspec
+
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+
+        def loads(data):
+            return _decoder.decode(data.encode() if isinstance(data, str) else data)
+
+        def dumps(obj) -> bytes:
+            return _encoder.encode(obj)
+
+        BACKEND = 'msgspec'
+    except ImportError:
+        def loads(data):
+            return json.loads(data)
+
+        def dumps(obj) -> bytes:
+            return json.dumps(obj, separators=(',', ':')).encode()
+
+        BACKEND = 'json'
+
+
+class InvalidPayload(Exception):
+    pass
+
+
+class Leg:
+    __slots__ = ('line_id', 'line', 'market_id', 'outcome_id', 'sport_event_id')
+
+    def __init__(self, line_id: str, line: float, market_id: int, outcome_id: int, sport_event_id: int):
+        self.line_id = line_id
+        self.line = line
+        self.market_id = market_id
+        self.outcome_id = outcome_id
+        self.sport_event_id = sport_event_id
+
+
+class AskRequest:
+    # price.ask.new payload
+    __slots__ = ('parlay_id', 'callback_url', 'created_at', 'stake', 'market_lines')
+
+    def __init__(self, parlay_id: str, callback_url: str, created_at: int, stake: float, market_lines: list):
+        self.parlay_id = parlay_id
+        self.callback_url = callback_url
+        self.created_at = created_at
+        self.stake = stake
+        self.market_lines = market_lines
+
+
+class ConfirmRequest:
+    # price.confirm.new payload, market_lines is None when the payload does not carry the legs
+    __slots__ = ('parlay_id', 'callback_url', 'created_at', 'odds', 'stake', 'market_lines')
+
+    def __init__(self, parlay_id: str, callback_url: str, created_at: int, odds: int, stake: float,
+                 market_lines: list):
+        self.parlay_id = parlay_id
+        self.callback_url = callback_url
+        self.created_at = created_at
+        self.odds = odds
+        self.stake = stake
+        self.market_lines = market_lines
+
+
+class OrderFinalized:
+    # order.finalized payload, only the fields the exposure ledger needs. status is None when the
+    # payload does not say, which is taken as the order standing
+    __slots__ = ('parlay_id', 'status')
+
+    def __init__(self, parlay_id: str, status: str):
+        self.parlay_id = parlay_id
+        self.status = status
+
+
+def event_payload(raw) -> dict:
+    # pusher delivers {"payload": ...}, with the payload either inlined or as a json string
+    payload = loads(raw).get('payload', {})
+    if isinstance(payload, (str, bytes)):
+        payload = loads(payload)
+    if not isinstance(payload, dict):
+        raise InvalidPayload(f"payload is not an object: {payload!r}")
+    return payload
+
+
+def decode_ask(raw) -> AskRequest:
+    payload = event_payload(raw)
+    return AskRequest(
+        _required(payload, 'parlay_id', str),
+        _required(payload, 'callback_url', str),
+        _optional(payload, 'created_at', int),
+        _optional(payload, 'stake', (int, float)),
+        _legs(payload.get('market_lines'), required=True),
+    )
+
+
+def decode_confirm(raw) -> ConfirmRequest:
+    payload = event_payload(raw)
+    return ConfirmRequest(
+        _required(payload, 'parlay_id', str),
+        _required(payload, 'callback_url', str),
+        _optional(payload, 'created_at', int),
+        _required(payload, 'odds', (int, float)),
+        _optional(payload, 'stake', (int, float)),
+        _legs(payload.get('market_lines'), required=False),
+    )
+
+
+def decode_finalized(raw) -> OrderFinalized:
+    payload = event_payload(raw)
+    return OrderFinalized(
+        _required(payload, 'parlay_id', str),
+        _optional(payload, 'status', str),
+    )
+
+
+def encode_offer_tail(offer: dict) -> bytes:
+    # everything of an offer but valid_until, without the opening brace, see encode_offers
+    return dumps(offer)[1:]
+
+
+def encode_offers(parlay_id: str, valid_until: int, offer_tails: list) -> bytes:
+    # splice parlay_id and valid_until into pre-encoded offers instead of dumping the whole body
+    prefix = b'{"valid_until":' + str(valid_until).encode() + b','
+    return b'{"parlay_id":' + dumps(parlay_id) + b',"offers":[' + \
+        b','.join(prefix + tail for tail in offer_tails) + b']}'
+
+
+def _legs(market_lines, required: bool):
+    if market_lines is None and not required:
+        return None
+    if not isinstance(market_lines, list) or len(market_lines) == 0:
+        raise InvalidPayload(f"market_lines must be a non empty list, got {market_lines!r}")
+    legs = []
+    for x in market_lines:
+        if not isinstance(x, dict):
+            raise InvalidPayload(f"market line is not an object: {x!r}")
+        legs.append(Leg(_required(x, 'line_id', str), _optional(x, 'line', (int, float)),
+                        _optional(x, 'market_id', int), _optional(x, 'outcome_id', int),
+                        _optional(x, 'sport_event_id', int)))
+    return legs
+
+
+def _required(payload: dict, key: str, kind):
+    value = payload.get(key)
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise InvalidPayload(f"{key} is missing or not {kind}: {value!r}")
+    return value
+
+
+def _optional(payload: dict, key: str, kind):
+    if payload.get(key) is None:
+        return None
+    return _required(payload, key, kind)
+
+
+def bench(path: str = None) -> dict:
+    # ns per payload over the websocket events of a replay file (a synthetic one when there is
+    # none): the stdlib double decode the handlers used to do, the same through this codec's
+    # backend, and the typed decode that also validates and builds the structs. Then the offer
+    # body of every priced ask dumped whole vs spliced into the pre-encoded offer tails
+    from src import replay
+    from src.odds import OddsLadder
+    from src.pricing import PricingEngine
+    with tempfile.TemporaryDirectory() as directory:
+        if path is None:
+            path = os.path.join(directory, 'codec.replay.gz')
+            replay.synthesize(path, tournaments=20, events=50, asks=20000)
+        _, responses, events = replay.read_replay(path)
+    decoders = {'price.ask.new': decode_ask, 'price.confirm.new': decode_confirm, 'order.finalized': decode_finalized}
+    corpus = [(decoders[event], data) for _, _, event, data in events if event in decoders]
+    results = {'backend': BACKEND, 'payloads': len(corpus)}
+
+    started = time.perf_counter_ns()
+    for _, data in corpus:
+        payload = json.loads(data).get('payload')
+        if isinstance(payload, str):
+            json.loads(payload)
+    results['decode_stdlib_ns'] = (time.perf_counter_ns() - started) / max(len(corpus), 1)
+    started = time.perf_counter_ns()
+    for _, data in corpus:
+        event_payload(data)
+    results['decode_backend_ns'] = (time.perf_counter_ns() - started) / max(len(corpus), 1)
+    started = time.perf_counter_ns()
+    for decode, data in corpus:
+        decode(data)
+    results['decode_typed_ns'] = (time.perf_counter_ns() - started) / max(len(corpus), 1)
+
+    catalog = replay.catalog_of(responses)
+    engine = PricingEngine(OddsLadder())
+    quotes = []
+    for decode, data in corpus:
+        if decode is decode_ask:
+            ask = decode(data)
+            quote = engine.price(catalog, ask.market_lines)
+            if quote is not None:
+                quotes.append((ask.parlay_id, quote))
+    valid_until = time.time_ns()
+    started = time.perf_counter_ns()
+    for parlay_id, quote in quotes:
+        json.dumps({'parlay_id': parlay_id, 'offers': [{'valid_until': valid_until, **offer} for offer in quote.offers]}).encode()
+    results['encode_stdlib_ns'] = (time.perf_counter_ns() - started) / max(len(quotes), 1)
+    started = time.perf_counter_ns()
+    for parlay_id, quote in quotes:
+        encode_offers(parlay_id, valid_until, quote.offer_tails)
+    results['encode_spliced_ns'] = (time.perf_counter_ns() - started) / max(len(quotes), 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.codec', description='json codec tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='decode and offer encode cost over the payloads of a replay file')
+    p.add_argument('path', nargs='?', help='replay file, see python -m src.replay; synthetic when left out')
+    args = parser.parse_args()
+    results = bench(args.path)
+    sys.stdout.write(dumps({k: round(v, 1) if isinstance(v, float) else v for k, v in results.items()}).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,48 @@ MM_KEYS = {
 
 TOURNAMENTS_INTERESTED = user_info_dict['tournaments']
 LOAD_ALL_TOURNAMENTS = user_info_dict['load_all_tournaments']
+# 'threaded' (ParlayInteractions), 'asyncio' (AsyncParlayInteractions) or 'sharded' (QuoteSupervisor)
+CLIENT = user_info_dict.get('client', 'threaded')
+QUOTE_PROCESSES = user_info_dict.get('quote_processes', 0)   # sharded client only, 0 is one per cpu
+
+# REST client behaviour
+REQUEST_TIMEOUT = 10    # seconds, per request
+REQUEST_RETRIES = 3     # extra attempts on connection errors and 5xx responses
+RETRY_BACKOFF = 0.5     # seconds before the first retry, doubled after every attempt
+SEEDING_CONCURRENCY = 8     # max in-flight mm_events/mm_markets requests while seeding
+INGEST_STREAM_BYTES = 1 << 20   # mm_markets bodies this large are parsed incrementally when ijson is installed
+RESEED_INTERVAL = 300   # seconds between incremental reseeds once keep_alive runs
+SCHEDULER_WORKERS = 4   # threads running keep_alive's jobs, see src/scheduler.py
+SUPPORTED_LINES_CHUNK_BYTES = 64 * 1024     # max size of the line id list in one supported-lines post
+SUPPORTED_LINES_CONCURRENCY = 4     # supported-lines chunks posted in parallel
+SUPPORTED_LINES_REMOVE_KEY = 'unsupported_lines'    # body key withdrawing lines after a reseed
+HTTP_POOL_HOSTS = 4     # distinct hosts kept in the shared session's connection pools
+HTTP_POOL_SIZE = 32     # keep-alive connections kept per host
+HTTP_WARM_CONNECTIONS = 4   # connections opened up front to the api and callback_url hosts
+
+# quote pipeline, see src/dispatcher.py
+QUOTE_WORKERS = 8       # worker threads pricing asks and posting offers
+QUOTE_QUEUE_SIZE = 256  # queued asks per worker before shedding
+QUOTE_MAX_AGE_MS = 2000     # asks older than this (by created_at) are dropped unpriced
+QUOTE_SHED_POLICY = 'drop_oldest'   # or 'drop_newest', which ask goes when a worker queue is full
+ASYNC_MAX_INFLIGHT = 2000   # asyncio client only, asks priced concurrently before new ones are dropped
+CATALOG_SEGMENT_TTL = 5     # sharded client only, seconds a replaced catalog stays in shared memory for the workers
+CATALOG_PUBLISH_INTERVAL = 1    # sharded client only, min seconds between catalog publishes to the workers
+
+# session, see src/session.py
+SESSION_REFRESH_MARGIN = 300    # seconds before the access token expires to refresh it
+SESSION_TOKEN_LIFETIME = 3600   # assumed token lifetime when neither the response nor the token tells
+SESSION_RETRY_MIN = 5       # seconds, first retry after a failed refresh, doubled up to SESSION_RETRY_MAX
+SESSION_RETRY_MAX = 60
+
+# websocket, the threaded client uses pysher (host, port and scheme of PUSHER_URL), the asyncio
+# client speaks the pusher protocol itself
+PUSHER_URL = 'wss://ws-{cluster}.pusher.com/app/{key}?protocol=7&client=python-parlay&version=1.0'
+WEBSOCKET_ACTIVITY_TIMEOUT = 120    # seconds of silence before we ping pusher
+WEBSOCKET_RECONNECT_MIN = 1     # seconds, first reconnect delay, doubled up to WEBSOCKET_RECONNECT_MAX
+WEBSOCKET_RECONNECT_MAX = 60
+WEBSOCKET_CHECK_INTERVAL = 1   # seconds between connection health checks of the threaded client
+DEDUP_WINDOW = 10000    # parlay ids remembered to drop asks and confirms pusher delivers twice
 
 BASE_URL = 'https://api-ss-sandbox.betprophet.co'
 URL = {
@@ -20,7 +62,74 @@ URL = {
     'mm_events': 'partner/mm/get_sport_events',
     'mm_markets': 'partner/mm/get_markets',
     'mm_balance': 'partner/mm/get_balance',
+    'mm_wager_histories': 'partner/mm/get_wager_histories',
+    'mm_batch_cancel': 'partner/mm/cancel_multiple_wagers',
     'parlay_connection_config': 'parlay/sp/websocket/connection-config',
     'parlay_websocket_auth': 'parlay/sp/websocket/register',
     'parlay_supported_lines': 'parlay/sp/supported-lines'
 }
+
+# pricing, see src/pricing.py
+PRICING_TIERS = [     # one offer per tier, margin is added on top of the combined probability
+    {'max_risk': 200, 'margin': 0.05},
+    {'max_risk': 2000, 'margin': 0.10},
+]
+PRICING_SAME_EVENT_CORRELATION = 1.1    # probability factor for each extra leg on the same sport event
+PRICING_MAX_PROBABILITY = 0.99      # never price a leg or a parlay above this
+RECENT_QUOTES_SIZE = 10000      # quotes kept to answer price.confirm.new
+QUOTE_CACHE_SIZE = 50000    # priced leg sets kept for repeated asks
+QUOTE_CACHE_TTL = 60    # seconds a cached quote is reused before it is priced again
+
+# exposure, see src/exposure.py. Limits are on liability, what we pay out if the parlays win
+EXPOSURE_LIMITS = {'line': 20000, 'event': 50000, 'tournament': 200000}
+EXPOSURE_STRIPES = 64   # locks the ledger is split over
+EXPOSURE_MIN_RISK = 5   # offers sized below this max_risk are not made
+EXPOSURE_RELEASE_STATUSES = ('rejected', 'cancelled', 'canceled', 'expired', 'void')   # order.finalized
+BALANCE_INTERVAL = 60   # seconds between balance reconciliations
+
+# bulk wager cancellation, see src/wagers.py
+WAGER_CANCEL_ON_START = user_info_dict.get('cancel_wagers_on_start', False)    # threaded and sharded clients
+WAGER_PAGE_SIZE = 1000  # open wagers listed per request
+WAGER_CANCELLED_STATUS = 'cancelled'    # wager history status the cancelled wagers are listed under
+WAGER_CANCEL_BATCH = 50     # wagers per cancel request
+WAGER_CANCEL_CONCURRENCY = 4    # cancel requests in flight
+WAGER_CANCEL_RATE = 20  # cancel requests per second at most, 0 is no limit
+WAGER_CANCEL_RETRIES = 3    # extra attempts on connection errors, 429 and 5xx
+WAGER_CANCEL_ROUNDS = 3     # list and cancel again while wagers are still open
+WAGER_BALANCE_TIMEOUT = 10  # seconds to wait for the balance to show the cancelled stakes
+if WAGER_CANCEL_ON_START and CLIENT == 'asyncio':
+    raise Exception("cancel_wagers_on_start needs the threaded or sharded client, src/wagers.py cancels over the "
+                    "threaded transport. Set client to threaded or sharded, or turn cancel_wagers_on_start off")
+
+# offer submission, see src/offers.py
+OFFER_HOST_CONCURRENCY = 16     # offers in flight per callback host
+OFFER_RETRIES = 1       # extra attempts on connection errors and 5xx, deadline permitting
+OFFER_MIN_LEAD_MS = 50  # offers with less time than this left before their deadline are not sent
+OFFER_HTTP2 = user_info_dict.get('offer_http2', True)   # post offers over HTTP/2 when httpx and h2 are installed
+
+# catalog snapshot for warm restarts, see src/snapshot.py
+SNAPSHOT_FILE = 'catalog.snapshot'  # *.json for the json format, anything else is binary, '' disables
+SNAPSHOT_MAX_AGE = 6 * 3600     # seconds, older snapshots are ignored and the api is crawled
+
+# event lifecycle and catalog memory budget, see src/lifecycle.py
+EVENT_LIVE_WINDOW = 6 * 3600    # seconds after its scheduled start an event counts as closed
+EVENT_CLOSED_STATUSES = ('closed', 'ended', 'finished', 'cancelled', 'canceled', 'settled')
+EVENT_SWEEP_INTERVAL = 60   # seconds between eviction sweeps
+CATALOG_MAX_LINES = user_info_dict.get('catalog_max_lines', 0)     # lines kept before tournaments are evicted, 0 is no limit
+EVICTED_EVENTS_MAX = 10000  # evicted events remembered for a re-fetch when an ask references them
+
+# markets loaded on demand, see src/market_loader.py
+LAZY_MARKETS = user_info_dict.get('lazy_markets', False)    # fetch the markets of events no seeded tournament has
+LAZY_MARKETS_CONCURRENCY = 8    # mm_markets calls in flight for asks
+LAZY_MARKETS_NEGATIVE_TTL = 60  # seconds an event that failed to load is not tried again
+LAZY_MARKETS_TTL = 300  # seconds an event loaded on demand is kept, it is fetched again on the next ask after
+
+# logging, see src/log.py
+LOG_LEVEL = user_info_dict.get('log_level', 'INFO')
+LOG_FORMAT = user_info_dict.get('log_format', 'text')   # 'text' or 'json', one object per line
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread, more are dropped and counted
+LOG_QUOTE_RATE = 10     # per-quote messages written per second, per message
+
+# metrics, see src/metrics.py
+METRICS_FILE = 'metrics.prom'   # *.prom is written as prometheus text, anything else as json, '' disables
+METRICS_INTERVAL = 10   # seconds between metrics file writes
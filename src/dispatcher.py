@@ -0,0 +1,122 @@
+import threading
+import time
+import zlib
+
+from collections import deque
+from src import config
+from src.log import logging
+from src.metrics import registry
+
+QUEUE_WAIT = registry.histogram('quote_queue_wait_ns')
+DROPPED_STALE = registry.counter('quote_dropped_stale_total')
+
+
+def is_stale(payload, max_age_ns: int) -> bool:
+    # payload is a codec.AskRequest or ConfirmRequest
+    created_at = payload.created_at
+    return created_at is not None and time.time_ns() - created_at > max_age_ns
+
+
+class _Shard:
+    # bounded FIFO of (handler, payload, sheddable, enqueued_ns) jobs feeding one worker thread
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.jobs = deque()
+        self.ready = threading.Condition()
+        self.dropped = 0
+
+    def put(self, job, shed_policy: str = None) -> bool:
+        # job None is the stop marker, it and non sheddable jobs always get in
+        with self.ready:
+            if job is not None and job[2] and len(self.jobs) >= self.maxsize:
+                self.dropped += 1
+                if shed_policy == 'drop_newest' or not self._drop_oldest_sheddable():
+                    return False
+            self.jobs.append(job)
+            self.ready.notify()
+            return True
+
+    def get(self):
+        with self.ready:
+            while not self.jobs:
+                self.ready.wait()
+            return self.jobs.popleft()
+
+    def _drop_oldest_sheddable(self) -> bool:
+        for i, queued in enumerate(self.jobs):
+            if queued is not None and queued[2]:
+                del self.jobs[i]
+                return True
+        return False
+
+
+class QuoteDispatcher:
+    # moves quote handling off the pusher websocket thread: the socket handler only parses and
+    # calls submit(), and a pool of workers prices and posts. Jobs are sharded by parlay_id, one
+    # queue per worker, so a price.confirm.new is always handled after the ask of the same parlay
+    workers: int = 0
+    max_age_ns: int = 0
+    shed_policy: str = None
+    dropped_stale: int = 0
+
+    def __init__(self, workers: int = None, queue_size: int = None, max_age_ms: int = None,
+                 shed_policy: str = None):
+        self.workers = workers or config.QUOTE_WORKERS
+        self.max_age_ns = (max_age_ms or config.QUOTE_MAX_AGE_MS) * 1000000
+        self.shed_policy = shed_policy or config.QUOTE_SHED_POLICY
+        if self.shed_policy not in ('drop_oldest', 'drop_newest'):
+            raise Exception(f"unknown shed policy {self.shed_policy}")
+        self.shards = [_Shard(queue_size or config.QUOTE_QUEUE_SIZE) for _ in range(self.workers)]
+        self.threads = []
+        self.dropped_stale = 0
+
+    def start(self):
+        if self.threads:
+            return
+        for i, shard in enumerate(self.shards):
+            thread = threading.Thread(target=self._work, args=(shard,), name=f'quote-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for shard in self.shards:
+            shard.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, parlay_id: str, handler, payload, sheddable: bool = True) -> bool:
+        # asks are sheddable: on a full shard either the incoming ask or the oldest queued ask is
+        # dropped, following shed_policy. Confirms are never shed, an accepted quote must be answered
+        shard = self.shards[zlib.crc32(parlay_id.encode()) % self.workers]
+        return shard.put((handler, payload, sheddable, time.perf_counter_ns()), self.shed_policy)
+
+    @property
+    def dropped_full(self) -> int:
+        return sum(shard.dropped for shard in self.shards)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(shard.jobs) for shard in self.shards)
+
+    def is_stale(self, payload) -> bool:
+        return is_stale(payload, self.max_age_ns)
+
+    def drop_stale(self):
+        self.dropped_stale += 1
+        DROPPED_STALE.inc()
+
+    def _work(self, shard: _Shard):
+        while True:
+            job = shard.get()
+            if job is None:
+                return
+            handler, payload, sheddable, enqueued_ns = job
+            QUEUE_WAIT.record(time.perf_counter_ns() - enqueued_ns)
+            if sheddable and self.is_stale(payload):
+                self.drop_stale()
+                continue
+            try:
+                handler(payload)
+            except Exception as e:
+                logging.exception("failed to handle parlay, error: %s", e, extra={'parlay_id': payload.parlay_id})
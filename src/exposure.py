@@ -0,0 +1,205 @@
+import argparse
+import json
+import sys
+import threading
+
+from src import config
+from src.log import logging
+
+
+class ExposureLedger:
+    # liability we carry, i.e. what we pay out if the parlays we accepted all win, aggregated per
+    # line, sport event and tournament. A parlay counts in full against every key of its legs.
+    # Keys are ('line', line_id), ('event', event_id) and ('tournament', tournament_id).
+    #
+    # Quoting only reads (a few dict lookups per leg, no lock). A reservation locks the stripes of
+    # the keys it touches, always in stripe order, checks every limit and adds the liability, so
+    # concurrent confirms never overshoot a limit together. With `share` < 1 (one ledger per
+    # quote process) every limit and the balance are scaled down by it.
+    #
+    # The exchange takes a parlay's liability out of the balance once its order is finalized. Until
+    # then it is pending, from then until the next balance read it is debited, and both count
+    # against the balance we last read
+    #
+    #   python -m src.exposure check    reserve, finalize, release and reconcile scenarios
+    limits: dict = dict()
+    share: float = 1.0
+    balance: float = None
+
+    def __init__(self, limits: dict = None, stripes: int = None, share: float = 1.0):
+        self.limits = limits or config.EXPOSURE_LIMITS
+        self.share = share
+        self.exposure = dict()      # key -> liability
+        self.parlays = dict()       # parlay_id -> (keys, liability, finalized)
+        self.open_events = dict()   # parlay_id -> event ids of its legs not settled yet, once one is
+        self.settle_lock = threading.Lock()
+        self.locks = [threading.Lock() for _ in range(stripes or config.EXPOSURE_STRIPES)]
+        self.balance = None
+        self.pending = 0.0      # liability of the parlays reserved and not finalized yet
+        self.debited = 0.0      # liability finalized since the last balance read
+        self.balance_lock = threading.Lock()
+        self.rejected = 0
+
+    def headroom(self, keys: list) -> float:
+        # liability we can still take on keys, lock free and so only indicative
+        headroom = float('inf')
+        for key in keys:
+            headroom = min(headroom, self.limits[key[0]] * self.share - self.exposure.get(key, 0))
+        if self.balance is not None:
+            headroom = min(headroom, self.balance * self.share - self.pending - self.debited)
+        return max(headroom, 0)
+
+    def reserve(self, parlay_id: str, keys: list, liability: float) -> bool:
+        # all or nothing: False when the liability does not fit under every limit, or when the parlay
+        # is reserved already, a second reservation must neither replace nor double the first
+        stripes = sorted({hash(key) % len(self.locks) for key in keys})
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+        try:
+            if parlay_id in self.parlays:
+                logging.info(f"parlay {parlay_id} is reserved already")
+                return False
+            for key in keys:
+                if self.exposure.get(key, 0) + liability > self.limits[key[0]] * self.share:
+                    self.rejected += 1
+                    return False
+            with self.balance_lock:
+                if self.balance is not None and self.pending + self.debited + liability > self.balance * self.share:
+                    self.rejected += 1
+                    return False
+                self.pending += liability
+            for key in keys:
+                self.exposure[key] = self.exposure.get(key, 0) + liability
+            self.parlays[parlay_id] = (keys, liability, False)
+            return True
+        finally:
+            for stripe in stripes:
+                self.locks[stripe].release()
+
+    def release(self, parlay_id: str):
+        # the parlay did not go through (our accept failed, the order was cancelled) or it settled
+        entry = self.parlays.pop(parlay_id, None)
+        self.open_events.pop(parlay_id, None)
+        if entry is None:
+            return
+        keys, liability, finalized = entry
+        stripes = sorted({hash(key) % len(self.locks) for key in keys})
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+        try:
+            for key in keys:
+                left = self.exposure.get(key, 0) - liability
+                if left > 1e-9:
+                    self.exposure[key] = left
+                else:
+                    self.exposure.pop(key, None)
+        finally:
+            for stripe in stripes:
+                self.locks[stripe].release()
+        if not finalized:
+            with self.balance_lock:
+                self.pending = max(self.pending - liability, 0)
+
+    def finalize(self, parlay_id: str):
+        entry = self.parlays.get(parlay_id)
+        if entry is None or entry[2]:
+            return
+        self.parlays[parlay_id] = (entry[0], entry[1], True)
+        with self.balance_lock:
+            self.pending = max(self.pending - entry[1], 0)
+            self.debited += entry[1]
+
+    def settle_events(self, event_ids: set):
+        # sport events gone from the catalog are over. A parlay still pays out if its legs on the
+        # other events win, so it counts in full until the events of all its legs are over
+        if len(event_ids) == 0:
+            return
+        settled = []
+        with self.settle_lock:
+            for parlay_id, (keys, _, _) in list(self.parlays.items()):
+                open_events = self.open_events.get(parlay_id)
+                if open_events is None:
+                    open_events = {key[1] for key in keys if key[0] == 'event'}
+                if open_events.isdisjoint(event_ids):
+                    continue
+                open_events = open_events - event_ids
+                if open_events:
+                    self.open_events[parlay_id] = open_events
+                else:
+                    settled.append(parlay_id)
+        for parlay_id in settled:
+            self.release(parlay_id)
+        if settled:
+            logging.info(f"released {len(settled)} parlays on {len(event_ids)} finished events")
+
+    def reconcile(self, balance: float):
+        # a fresh balance reflects the parlays finalized so far, not the pending ones. Logs how far
+        # off we were
+        with self.balance_lock:
+            if self.balance is not None and self.share == 1.0:
+                expected = self.balance - self.debited
+                if abs(expected - balance) > 0.01:
+                    logging.info(f"balance drift {expected - balance:.2f}, expected {expected:.2f}, "
+                                 f"exchange has {balance:.2f}")
+            self.balance = balance
+            self.debited = 0.0
+
+    def stats(self) -> dict:
+        return {
+            'parlays': len(self.parlays),
+            'finalized': sum(1 for _, _, finalized in list(self.parlays.values()) if finalized),
+            'pending': round(self.pending, 2),
+            'debited': round(self.debited, 2),
+            'rejected': self.rejected,
+            'max_line': max((v for k, v in list(self.exposure.items()) if k[0] == 'line'), default=0),
+            'max_event': max((v for k, v in list(self.exposure.items()) if k[0] == 'event'), default=0),
+            'max_tournament': max((v for k, v in list(self.exposure.items()) if k[0] == 'tournament'), default=0),
+        }
+
+
+def check() -> dict:
+    # the balance scenarios the ledger must get right, raises on the first one it does not
+    unlimited = {'line': float('inf'), 'event': float('inf'), 'tournament': float('inf')}
+    keys = [('line', 'a'), ('event', 1), ('tournament', 1)]
+    results = dict()
+
+    def expect(name: str, got, wanted):
+        if got != wanted:
+            raise Exception(f"{name}: got {got}, expected {wanted}")
+        results[name] = 'ok'
+
+    # a balance read between a confirm and its order being finalized does not free the liability
+    ledger = ExposureLedger(unlimited)
+    ledger.reconcile(1000)
+    expect('reserve', ledger.reserve('p1', keys, 600), True)
+    ledger.reconcile(1000)
+    expect('reserve_after_reconcile', ledger.reserve('p2', keys, 600), False)
+    # once finalized the next balance has it debited, until then it still counts
+    ledger.finalize('p1')
+    expect('reserve_after_finalize', ledger.reserve('p2', keys, 600), False)
+    ledger.reconcile(400)
+    expect('reserve_after_debit', ledger.reserve('p2', keys, 600), False)
+    expect('reserve_within_debited_balance', ledger.reserve('p2', keys, 300), True)
+    # a parlay that falls through gives its pending liability back, a settled one leaves it to the balance
+    ledger.release('p2')
+    expect('pending_after_release', ledger.pending, 0)
+    ledger.release('p1')
+    expect('debited_after_settle', ledger.debited, 0)
+    expect('headroom', ledger.headroom(keys), 400)
+    # a parlay is reserved once
+    expect('reserve_again', ledger.reserve('p3', keys, 100), True)
+    expect('reserve_duplicate', ledger.reserve('p3', keys, 50), False)
+    expect('pending_after_duplicate', ledger.pending, 100)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.exposure', description='exposure ledger tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('check', help='reserve, finalize, release and reconcile scenarios')
+    parser.parse_args()
+    sys.stdout.write(json.dumps(check()) + '\n')
+
+
+if __name__ == '__main__':
+    main()
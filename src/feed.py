@@ -0,0 +1,101 @@
+import threading
+import time
+
+from collections import OrderedDict
+from src import config
+from src.log import logging
+from src.metrics import registry
+
+RECONNECTS = registry.counter('websocket_reconnects_total')
+RECOVERY = registry.histogram('websocket_recovery_ns')     # connection lost to channels subscribed again
+
+
+class RecentIds:
+    # bounded set of the last `size` ids seen, oldest forgotten first. Pusher may deliver an
+    # event twice around a reconnect, this is how the handlers notice
+    def __init__(self, size: int):
+        self.size = size
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        return key in self.ids
+
+    def seen(self, key) -> bool:
+        # remembers key and tells whether it was already there
+        with self.lock:
+            if key in self.ids:
+                return True
+            self.ids[key] = None
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return False
+
+
+class PusherSupervisor:
+    # keeps the pysher connection of a ParlayInteractions up. pysher only retries after a socket
+    # error and at a fixed interval, and a clean close from the server ends its thread for good.
+    # Every WEBSOCKET_CHECK_INTERVAL seconds this checks that the connection is up and its
+    # channels are subscribed; once it has been down for longer than the current backoff the
+    # pusher is replaced by a fresh one, which rediscovers its channels on connect
+    def __init__(self, client):
+        self.client = client
+        self.stopped = threading.Event()
+        self.thread = None
+        self.down_since = None
+        self.retry_at = None
+        self.backoff = config.WEBSOCKET_RECONNECT_MIN
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.client._connect_pusher()
+        self.thread = threading.Thread(target=self._run, name='pusher-supervisor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def healthy(self) -> bool:
+        connection = self.client.pusher.connection
+        return connection.is_alive() and connection.state == 'connected' and \
+            self.client.channels_socket_id == connection.socket_id
+
+    def check(self):
+        now = time.monotonic()
+        if self.healthy():
+            if self.down_since is not None:
+                RECOVERY.record(int((now - self.down_since) * 1e9))
+                logging.info(f"pusher connection recovered after {now - self.down_since:.1f}s")
+                self.down_since = None
+            self.backoff = config.WEBSOCKET_RECONNECT_MIN
+            return
+        if self.down_since is None:
+            # give pysher's own retry the first backoff period, unless its thread is gone already
+            self.down_since = now
+            self.retry_at = now + self.backoff if self.client.pusher.connection.is_alive() else now
+            logging.info("pusher connection lost")
+        if now < self.retry_at:
+            return
+        logging.info(f"pusher connection down for {now - self.down_since:.1f}s, reconnecting")
+        RECONNECTS.inc()
+        try:
+            self.client.pusher.disconnect(timeout=0)
+        except Exception as e:
+            logging.info(f"failed to close pusher connection, error: {e}")
+        try:
+            self.client._connect_pusher()
+        except Exception as e:
+            logging.error(f"failed to reconnect pusher, error: {e}")
+        self.backoff = min(self.backoff * 2, config.WEBSOCKET_RECONNECT_MAX)
+        self.retry_at = now + self.backoff
+
+    def _run(self):
+        while not self.stopped.wait(config.WEBSOCKET_CHECK_INTERVAL):
+            try:
+                self.check()
+            except Exception as e:
+                logging.exception(f"pusher supervisor check failed, error: {e}")
@@ -0,0 +1,82 @@
+import io
+
+from src import codec
+from src import config
+from src.catalog import LineRecord, iter_market_selections
+from src.log import logging
+from src.metrics import registry
+from src.odds import is_american
+
+# mm_markets responses straight to LineRecords, the raw markets are never kept around. A body is
+# decoded in one go with src.codec and dropped as soon as its records are built; with ijson
+# installed, bodies of INGEST_STREAM_BYTES or more are parsed incrementally instead, one market
+# object alive at a time. Streaming is slower and, for the few KB an event usually has, no smaller.
+# Odds that are not american odds (0, or between -100 and +100) are kept as missing, pricing skips
+# the line as it does one without odds
+try:
+    import ijson
+    BACKEND = f'ijson-{ijson.backend}'
+except ImportError:
+    ijson = None
+    BACKEND = codec.BACKEND
+
+INVALID_ODDS = registry.counter('ingest_invalid_odds_total')
+
+
+def market_records(content: bytes, event_id: int):
+    # LineRecords of one event's mm_markets response, None when it has no markets (event closed)
+    if ijson is None or len(content) < config.INGEST_STREAM_BYTES:
+        markets = codec.loads(content).get('data', {}).get('markets', {})
+        if markets is None:
+            return None
+        records = []
+        for market in markets:
+            records.extend(_records(market, event_id))
+        return records
+    return _stream(content, event_id)
+
+
+def _stream(content: bytes, event_id: int):
+    records = []
+    builder = None
+    for prefix, event, value in ijson.parse(io.BytesIO(content), use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event == 'end_map' and prefix == 'data.markets.item':
+                records.extend(_records(builder.value, event_id))
+                builder = None
+        elif prefix == 'data.markets.item' and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == 'data.markets' and event == 'null':
+            return None
+    return records
+
+
+def _records(market: dict, event_id: int) -> list:
+    # checks the market the way the exchange is expected to send it, then keeps only what
+    # pricing needs
+    if 'selections' in market:
+        if len(market['selections']) == 0:
+            raise Exception(f"selection is empty for event {event_id}")
+    elif 'market_lines' in market:
+        for market_line in market['market_lines']:
+            if 'selections' not in market_line or len(market_line['selections']) == 0:
+                raise Exception(f'selections is empty')
+            for selection in market_line['selections']:
+                if len(selection) > 0 and selection[0].get('line_id', None) is None:
+                    raise Exception(f'line_id is empty for event {event_id}')
+    else:
+        logging.info(f"no selection, no market_lines in market {market.get('id')} of event {event_id}")
+        return []
+    market_id = market.get('id')
+    return [LineRecord(selection['line_id'], event_id, market_id, selection.get('outcome_id'), line,
+                       _odds(selection.get('odds')))
+            for line, selection in iter_market_selections(market) if selection.get('line_id') is not None]
+
+
+def _odds(odds):
+    if odds is None or is_american(odds):
+        return odds
+    INVALID_ODDS.inc()
+    return None
@@ -0,0 +1,141 @@
+import threading
+import time
+
+from collections import OrderedDict
+from src import config
+from src.log import logging
+from src.metrics import registry
+
+# sport event lifecycle and the memory bound of the catalog. An event is 'scheduled' until its
+# start time, 'live' for EVENT_LIVE_WINDOW seconds after it and 'closed' from then on, or earlier
+# when its status says so. Closed events are evicted from the catalog by the periodic sweep and
+# are not fetched again by reseeds. Above CATALOG_MAX_LINES lines, whole tournaments are evicted
+# least recently quoted first (never the TOURNAMENTS_INTERESTED ones) and left out of reseeds;
+# an ask on one of their events fetches that event's markets again, see src/market_loader.py.
+# Events loaded on demand outside any tournament (tournament None) go after LAZY_MARKETS_TTL
+
+EVICTED_CLOSED = registry.counter('events_evicted_closed_total')
+EVICTED_BUDGET = registry.counter('events_evicted_budget_total')
+EVICTED_LAZY = registry.counter('events_evicted_lazy_total')
+REFETCHED = registry.counter('events_refetched_total')
+
+
+def _epoch_ns(value) -> int:
+    # start times may come as epoch seconds, milliseconds or nanoseconds
+    if value >= 1e17:
+        return int(value)
+    if value >= 1e11:
+        return int(value * 1e6)
+    return int(value * 1e9)
+
+
+def event_state(event: dict, now_ns: int = None) -> str:
+    status = event.get('status')
+    if isinstance(status, str) and status.lower() in config.EVENT_CLOSED_STATUSES:
+        return 'closed'
+    scheduled = event.get('scheduled')
+    if not isinstance(scheduled, (int, float)) or isinstance(scheduled, bool):
+        return 'scheduled'
+    now_ns = now_ns or time.time_ns()
+    started = _epoch_ns(scheduled)
+    if now_ns < started:
+        return 'scheduled'
+    if now_ns < started + config.EVENT_LIVE_WINDOW * 1000000000:
+        return 'live'
+    return 'closed'
+
+
+class EventLifecycle:
+    # which tournaments were quoted when, and what was evicted for the memory budget
+    def __init__(self, client):
+        self.client = client
+        self.quoted = dict()    # tournament id -> time.monotonic() of its last quote
+        self.evicted_tournaments = set()
+        self.evicted = OrderedDict()    # event id -> (tournament id, event), oldest first
+        self.lock = threading.Lock()
+
+    def touch(self, market_lines: list):
+        # the tournaments of a priced ask, one dict write per leg and no lock
+        now = time.monotonic()
+        event_tournaments = self.client.event_tournaments
+        for leg in market_lines:
+            if leg.sport_event_id in event_tournaments:
+                self.quoted[event_tournaments[leg.sport_event_id]] = now
+
+    def skip_tournament(self, t_id) -> bool:
+        # reseeds leave evicted tournaments alone
+        return t_id in self.evicted_tournaments
+
+    def restored(self, event_id):
+        # an evicted event is back in the catalog, so is its tournament at the next reseed
+        with self.lock:
+            entry = self.evicted.pop(event_id, None)
+            if entry is not None:
+                self.evicted_tournaments.discard(entry[0])
+                self.quoted[entry[0]] = time.monotonic()
+                REFETCHED.inc()
+
+    def forget(self, event_id):
+        with self.lock:
+            self.evicted.pop(event_id, None)
+
+    def sweep(self):
+        # scheduled job: evict closed events and expired on demand ones, then tournaments until the
+        # catalog fits the budget
+        client = self.client
+        now_ns = time.time_ns()
+        loaded_before = time.time() - config.LAZY_MARKETS_TTL
+        closed = set()
+        expired = set()
+        for event_id, event in list(client.sport_events.items()):
+            if event_state(event, now_ns) == 'closed':
+                closed.add(event_id)
+            elif event.get('lazy_loaded_at', loaded_before) < loaded_before:
+                expired.add(event_id)
+        if closed or expired:
+            client._remove_events(closed | expired)
+            client._settle_events(closed)
+            EVICTED_CLOSED.inc(len(closed))
+            EVICTED_LAZY.inc(len(expired))
+            logging.info(f"evicted {len(closed)} closed and {len(expired)} expired on demand events, "
+                         f"{len(client.catalog)} lines left")
+        if config.CATALOG_MAX_LINES and len(client.catalog) > config.CATALOG_MAX_LINES:
+            self._evict_tournaments()
+
+    def _evict_tournaments(self):
+        client = self.client
+        interested = {t_id for t_id, t in client.my_tournaments.items() if t['name'] in config.TOURNAMENTS_INTERESTED}
+        candidates = sorted((t_id for t_id in client.tournament_events if t_id not in interested),
+                            key=lambda t_id: self.quoted.get(t_id, 0))
+        lines = len(client.catalog)
+        events = set()
+        tournaments = []
+        for t_id in candidates:
+            if lines <= config.CATALOG_MAX_LINES:
+                break
+            for event_id in client.tournament_events[t_id]:
+                lines -= len(client.catalog.lines_for_event(event_id))
+                events.add(event_id)
+            tournaments.append(t_id)
+        if not tournaments:
+            return
+        with self.lock:
+            for t_id in tournaments:
+                self.evicted_tournaments.add(t_id)
+                self.quoted.pop(t_id, None)
+                for event_id in client.tournament_events[t_id]:
+                    if event_id in client.sport_events:
+                        self.evicted[event_id] = (t_id, client.sport_events[event_id])
+            while len(self.evicted) > config.EVICTED_EVENTS_MAX:
+                self.evicted.popitem(last=False)
+        client._remove_events(events)
+        EVICTED_BUDGET.inc(len(events))
+        logging.info(f"catalog over {config.CATALOG_MAX_LINES} lines, evicted {len(tournaments)} tournaments "
+                     f"({len(events)} events), {len(client.catalog)} lines left")
+
+    def stats(self) -> dict:
+        return {
+            'evicted_tournaments': len(self.evicted_tournaments),
+            'evicted_events': len(self.evicted),
+            'tracked_tournaments': len(self.quoted),
+        }
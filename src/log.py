@@ -1,6 +1,226 @@
+import argparse
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
 
-logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    level=logging.INFO,
-    datefmt='%Y-%m-%d %H:%M:%S')
\ No newline at end of file
+from src import config
+
+# logging setup shared by every module (`from src.log import logging`). Records are put on a
+# bounded queue by the calling thread and formatted and written by a listener thread, so a slow
+# terminal or pipe never blocks the websocket or quote threads; when the queue is full the record is
+# dropped and counted instead. Messages are formatted only when written, pass arguments
+# %-style (logging.info("skip parlay %s", parlay_id)) rather than as f-strings on hot paths.
+#
+# LOG_FORMAT 'json' writes one object per line with the record's extra fields, e.g.
+# extra={'parlay_id': ...}, as keys. Per-quote messages go through `quote_log`, rate limited per
+# message to LOG_QUOTE_RATE a second; the next one written carries how many were suppressed.
+#
+#   python -m src.log bench     cost per quote path log call, synchronous vs queued vs off
+
+# attributes every LogRecord has, anything else on a record came in through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+TEXT_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    # the classic format with the extra fields appended as key=value
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = ' '.join(f'{key}={value}' for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        return f'{line} {extra}' if extra else line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # never blocks and never formats in the calling thread: the record goes on the queue as is
+    # and is formatted by the listener
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimit:
+    # at most `rate` per second per key, with a burst of as many
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.buckets = dict()   # key -> [tokens, last refill, suppressed]
+        self.lock = threading.Lock()
+        self.suppressed = 0
+
+    def take(self, key):
+        # None when key is over its rate, else how many were suppressed since the last one let through
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.rate, now, 0]
+            bucket[0] = min(bucket[0] + (now - bucket[1]) * self.rate, self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return None
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+            return suppressed
+
+
+class QuoteRecord(logging.LogRecord):
+    # the record of a quote_log message: skips what LogRecord.__init__ looks up per record (caller,
+    # thread and process), none of the formats show it and those fields are left None. Only these
+    # records skip it, other loggers in the process keep the logging module's defaults
+    def __init__(self, name: str, level: int, msg: str, args: tuple, extra: dict):
+        created = time.time()
+        self.name = name
+        self.msg = msg
+        self.args = args
+        self.levelname = logging.getLevelName(level)
+        self.levelno = level
+        self.pathname = self.filename = self.module = self.funcName = None
+        self.lineno = 0
+        self.exc_info = self.exc_text = self.stack_info = None
+        self.created = created
+        self.msecs = int((created - int(created)) * 1000) + 0.0
+        self.relativeCreated = (created - logging._startTime) * 1000
+        self.thread = self.threadName = self.process = self.processName = None
+        self.__dict__.update(extra)
+
+
+class QuoteLog:
+    # per-quote messages, keyed by parlay_id. The level check and the rate limit per message
+    # template come before a record is built, so a suppressed message costs next to nothing, and
+    # the record is a QuoteRecord handed straight to the logger's handlers
+    def __init__(self, logger: logging.Logger, rate: float):
+        self.logger = logger
+        self.limit = RateLimit(rate)
+
+    def log(self, level: int, msg: str, *args, parlay_id: str = None):
+        if not self.logger.isEnabledFor(level):
+            return
+        suppressed = self.limit.take(msg)
+        if suppressed is None:
+            return
+        extra = {'parlay_id': parlay_id}
+        if suppressed:
+            extra['suppressed'] = suppressed
+        self.logger.handle(QuoteRecord(self.logger.name, level, msg, args, extra))
+
+    def info(self, msg: str, *args, parlay_id: str = None):
+        self.log(logging.INFO, msg, *args, parlay_id=parlay_id)
+
+    def error(self, msg: str, *args, parlay_id: str = None):
+        self.log(logging.ERROR, msg, *args, parlay_id=parlay_id)
+
+
+class Listener(logging.handlers.QueueListener):
+    # stop() waits for room on a full queue instead of failing, what is queued is still written
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def _sink() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if config.LOG_FORMAT == 'json' else TextFormatter(TEXT_FORMAT, DATE_FORMAT))
+    return handler
+
+
+queue_handler = DroppingQueueHandler(queue.Queue(maxsize=config.LOG_QUEUE_SIZE))
+listener = Listener(queue_handler.queue, _sink(), respect_handler_level=False)
+logging.basicConfig(level=config.LOG_LEVEL, handlers=[queue_handler])
+listener.start()
+atexit.register(listener.stop)
+
+quote_log = QuoteLog(logging.getLogger('quote'), config.LOG_QUOTE_RATE)
+
+
+def stats() -> dict:
+    return {
+        'queued': queue_handler.queue.qsize(),
+        'dropped': queue_handler.dropped,
+        'suppressed': quote_log.limit.suppressed,
+    }
+
+
+def bench(messages: int) -> dict:
+    # ns per call of a typical quote path message, written to /dev/null: straight through a
+    # StreamHandler as before, through the queue, through the rate limited quote logger, and
+    # with the level above it
+    results = dict()
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    listener.stop()
+    with open('/dev/null', 'w') as null:
+        sync = logging.StreamHandler(null)
+        sync.setFormatter(TextFormatter(TEXT_FORMAT, DATE_FORMAT))
+        listener.handlers = (sync,)
+        cases = [
+            ('sync', [sync], logging.getLogger('bench'), logging.INFO),
+            ('queued', [queue_handler], logging.getLogger('bench'), logging.INFO),
+            ('queued_rate_limited', [queue_handler], quote_log, logging.INFO),
+            ('off', [queue_handler], logging.getLogger('bench'), logging.WARNING),
+        ]
+        try:
+            for name, case_handlers, logger, case_level in cases:
+                root.handlers = case_handlers
+                root.setLevel(case_level)
+                listener.start()
+                started = time.perf_counter_ns()
+                if logger is quote_log:
+                    for i in range(messages):
+                        logger.info("price sent, parlay %s", i, parlay_id=i)
+                else:
+                    for i in range(messages):
+                        logger.info("price sent, parlay %s", i, extra={'parlay_id': i})
+                results[f'{name}_ns'] = (time.perf_counter_ns() - started) / messages
+                listener.stop()
+        finally:
+            root.handlers = handlers
+            root.setLevel(level)
+            listener.handlers = (_sink(),)
+            listener.start()
+    results['dropped'] = queue_handler.dropped
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.log', description='logging tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='cost per log call on the quote path, synchronous vs queued vs off')
+    p.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+    results = bench(args.messages)
+    sys.stdout.write(json.dumps({k: round(v, 1) for k, v in results.items()}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,49 @@
+import asyncio
+
+from src import config
 from src import parlay_connect
 from src.log import logging
+from src.supervisor import QuoteSupervisor
+
+
+async def run_async_client():
+    from src.async_parlay_connect import AsyncParlayInteractions
+    mm_instance = AsyncParlayInteractions()
+    try:
+        await mm_instance.login()
+        await mm_instance.get_balance()
+        if not mm_instance.warm_start():
+            await mm_instance.seeding()
+        await mm_instance.subscribe()
+        await mm_instance.send_supported_lines()
+        await mm_instance.keep_alive()
+    finally:
+        await mm_instance.close()
 
 
 if __name__ == '__main__':
     logging.info("testing MM api")
-    mm_instance = parlay_connect.ParlayInteractions()
-    mm_instance.login()
-    # mm_instance.cancel_all_wagers()
-    mm_instance.get_balance()
-    mm_instance.seeding()
-    mm_instance.subscribe()
-    mm_instance.send_supported_lines()
-    mm_instance.keep_alive()
+    if config.CLIENT == 'asyncio':
+        try:
+            asyncio.run(run_async_client())
+        except KeyboardInterrupt:
+            logging.info("interrupted, shutting down")
+    else:
+        if config.CLIENT == 'sharded':
+            mm_instance = QuoteSupervisor()
+        else:
+            mm_instance = parlay_connect.ParlayInteractions()
+        mm_instance.login()
+        if config.WAGER_CANCEL_ON_START:
+            mm_instance.cancel_all_wagers()
+        mm_instance.get_balance()
+        if not mm_instance.warm_start():
+            mm_instance.seeding()
+        mm_instance.subscribe()
+        mm_instance.send_supported_lines()
+        try:
+            mm_instance.keep_alive()
+        except KeyboardInterrupt:
+            logging.info("interrupted, shutting down")
+        mm_instance.shutdown()
     # Jun 21, 2024, start with $908,637.13, then test batch bet/cancel to make sure all money are returned
@@ -0,0 +1,181 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from src import config
+from src import ingest
+from src.log import logging
+from src.metrics import registry
+
+# markets fetched on demand, when an ask has legs on events the catalog does not hold: events
+# evicted for the memory budget (see src/lifecycle.py) and, with LAZY_MARKETS, any event never
+# seeded, so a small TOURNAMENTS_INTERESTED seed still quotes broad parlays.
+#   - one mm_markets call per event at a time: asks arriving while it is in flight wait on it
+#     instead of fetching again, LAZY_MARKETS_CONCURRENCY calls at most
+#   - events that fail to load, or come back without markets, are not fetched again for
+#     LAZY_MARKETS_NEGATIVE_TTL seconds
+#   - every fetched event goes into the catalog on its own; events not seeded through a
+#     tournament are grouped under tournament None and dropped by the sweep after
+#     LAZY_MARKETS_TTL, so their odds are never older than that
+# The threaded client does not wait: the ask is handed back to the dispatcher once the fetches it
+# started are done, and the shard thread goes on with the next ask. The asyncio client awaits them
+# until the ask's deadline. Either way the fetches go on for the asks after it
+
+FETCHED = registry.counter('markets_lazy_fetch_total')
+COALESCED = registry.counter('markets_lazy_coalesced_total')
+FAILED = registry.counter('markets_lazy_failed_total')
+NEGATIVE_HIT = registry.counter('markets_lazy_negative_hit_total')
+WAIT = registry.histogram('markets_lazy_wait_ns')   # an ask waiting for the events it needs
+
+
+class MarketLoader:
+    enabled: bool = True    # off in the sharded workers, the supervisor loads and publishes
+
+    def __init__(self, client):
+        self.client = client
+        self.inflight = dict()  # event id -> Future (threaded client) or Task (asyncio client) of its fetch
+        self.failed = dict()    # event id -> time.monotonic() until which it is not fetched again
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def wanted(self, market_lines: list) -> dict:
+        # event id -> (tournament id, event) of the legs' events to fetch
+        client = self.client
+        if not self.enabled:
+            return {}
+        wanted = dict()
+        now = None
+        for leg in market_lines:
+            event_id = leg.sport_event_id
+            if event_id is None or event_id in wanted or event_id in client.sport_events:
+                continue
+            entry = client.lifecycle.evicted.get(event_id)
+            if entry is None:
+                if not config.LAZY_MARKETS:
+                    continue
+                entry = (None, {'event_id': event_id})
+            failed_until = self.failed.get(event_id)
+            if failed_until is not None:
+                now = now or time.monotonic()
+                if failed_until > now:
+                    NEGATIVE_HIT.inc()
+                    continue
+                self.failed.pop(event_id, None)
+            wanted[event_id] = entry
+        return wanted
+
+    def load_then(self, market_lines: list, callback) -> bool:
+        # threaded client: start fetching what the legs miss and return right away. callback(loaded)
+        # runs on a loader thread when all of it is done, loaded is True when any of it came into
+        # the catalog. False, and no callback, when there is nothing to fetch
+        wanted = self.wanted(market_lines)
+        if not wanted:
+            return False
+        started = time.perf_counter_ns()
+        futures = self._submit(wanted)
+        waiting = {'left': len(futures), 'loaded': False}
+        lock = threading.Lock()
+
+        def done(future):
+            loaded = not future.cancelled() and future.exception() is None and future.result()
+            with lock:
+                waiting['left'] -= 1
+                waiting['loaded'] = waiting['loaded'] or loaded
+                if waiting['left']:
+                    return
+            WAIT.record(time.perf_counter_ns() - started)
+            callback(waiting['loaded'])
+
+        for future in futures:
+            future.add_done_callback(done)
+        return True
+
+    def prefetch(self, market_lines: list):
+        # start the fetches without waiting for them
+        wanted = self.wanted(market_lines)
+        if wanted:
+            self._submit(wanted)
+
+    def _submit(self, wanted: dict) -> list:
+        futures = []
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=config.LAZY_MARKETS_CONCURRENCY,
+                                               thread_name_prefix='market-loader')
+            for event_id, entry in wanted.items():
+                future = self.inflight.get(event_id)
+                if future is None:
+                    future = self.inflight[event_id] = self.pool.submit(self._fetch, event_id, entry)
+                else:
+                    COALESCED.inc()
+                futures.append(future)
+        return futures
+
+    async def load_async(self, market_lines: list, timeout: float) -> bool:
+        # asyncio client: fetch what the legs miss, waiting up to timeout seconds. True when any of
+        # it came into the catalog. The fetches are tasks on the running loop
+        wanted = self.wanted(market_lines)
+        if not wanted:
+            return False
+        started = time.perf_counter_ns()
+        tasks = []
+        for event_id, entry in wanted.items():
+            task = self.inflight.get(event_id)
+            if task is None:
+                task = self.inflight[event_id] = asyncio.ensure_future(self._fetch_async(event_id, entry))
+            else:
+                COALESCED.inc()
+            tasks.append(task)
+        done, _ = await asyncio.wait(tasks, timeout=max(timeout, 0))
+        WAIT.record(time.perf_counter_ns() - started)
+        return any(task.result() for task in done)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            'inflight': len(self.inflight),
+            'negative': len(self.failed),
+        }
+
+    def _fetch(self, event_id: int, entry: tuple) -> bool:
+        try:
+            return self._apply(event_id, entry, self.client._get_markets(event_id))
+        finally:
+            with self.lock:
+                self.inflight.pop(event_id, None)
+
+    async def _fetch_async(self, event_id: int, entry: tuple) -> bool:
+        try:
+            content = await self.client._get_markets(event_id)
+            # the catalog copy is a few ms on a large catalog, not on the event loop
+            return await asyncio.to_thread(self._apply, event_id, entry, content)
+        finally:
+            self.inflight.pop(event_id, None)
+
+    def _apply(self, event_id: int, entry: tuple, content) -> bool:
+        # content is the mm_markets body, None when the call failed
+        FETCHED.inc()
+        records = None
+        if content is not None:
+            try:
+                records = ingest.market_records(content, event_id)
+            except Exception as e:
+                logging.info(f"invalid markets of event {event_id}, error: {e}")
+            if records is None:
+                # closed, or nothing we could use
+                self.client.lifecycle.forget(event_id)
+        if not records:
+            FAILED.inc()
+            self.failed[event_id] = time.monotonic() + config.LAZY_MARKETS_NEGATIVE_TTL
+            return False
+        t_id, event = entry
+        if t_id is None:
+            event = {**event, 'lazy_loaded_at': time.time()}
+        self.client._add_events({event_id: (t_id, event)}, {event_id: records})
+        self.client.lifecycle.restored(event_id)
+        logging.debug(f"loaded {len(records)} lines of event {event_id} on demand")
+        return True
@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+import time
+
+from src import config
+from src.log import logging
+
+# hot path metrics. Recording is a couple of integer operations under a lock, all naming and
+# formatting happens in the exporter thread
+
+
+class Histogram:
+    # HDR style log-linear histogram of non negative integers (nanoseconds): values are bucketed by
+    # power of two, each power split into 2**SUB_BITS linear sub buckets, so every bucket is
+    # within 1/2**SUB_BITS of the values it holds
+    SUB_BITS = 5
+    BUCKETS = (64 - SUB_BITS + 1) << SUB_BITS
+    __slots__ = ('name', 'counts', 'count', 'total', 'max', 'lock')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.SUB_BITS - 1
+        if shift <= 0:
+            index = value
+        else:
+            index = ((shift + 1) << self.SUB_BITS) + ((value >> shift) - (1 << self.SUB_BITS))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    @classmethod
+    def bucket_upper_bound(cls, index: int) -> int:
+        if index < 2 << cls.SUB_BITS:
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        sub = index & ((1 << cls.SUB_BITS) - 1)
+        return (((1 << cls.SUB_BITS) + sub + 1) << shift) - 1
+
+    def percentile(self, q: float) -> int:
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            max_value = self.max
+        if count == 0:
+            return 0
+        rank = max(1, int(round(q / 100 * count)))
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= rank:
+                return min(self.bucket_upper_bound(index), max_value)
+        return max_value
+
+    def raw(self) -> tuple:
+        # picklable state, for shipping worker process histograms to the supervisor
+        with self.lock:
+            return list(self.counts), self.count, self.total, self.max
+
+    def absorb(self, raw: tuple):
+        counts, count, total, max_value = raw
+        with self.lock:
+            for index, n in enumerate(counts):
+                if n:
+                    self.counts[index] += n
+            self.count += count
+            self.total += total
+            self.max = max(self.max, max_value)
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+
+
+class Counter:
+    __slots__ = ('name', 'value', 'lock')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n: int = 1):
+        with self.lock:
+            self.value += n
+
+
+class Registry:
+    # named histograms, counters and gauges (callables sampled at export time). Other processes
+    # can push their raw metrics in with set_remote, snapshots then report the sum of all of them
+    def __init__(self):
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self.remote = dict()    # source -> latest raw() of that source
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(name)
+            return self.histograms[name]
+
+    def counter(self, name: str) -> Counter:
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = Counter(name)
+            return self.counters[name]
+
+    def gauge(self, name: str, sample):
+        with self.lock:
+            self.gauges[name] = sample
+
+    def raw(self) -> dict:
+        return {
+            'histograms': {name: h.raw() for name, h in list(self.histograms.items())},
+            'counters': {name: c.value for name, c in list(self.counters.items())},
+        }
+
+    def set_remote(self, source, raw: dict):
+        with self.lock:
+            self.remote[source] = raw
+
+    def _merged(self):
+        histograms = dict(self.histograms)
+        counters = {name: c.value for name, c in list(self.counters.items())}
+        with self.lock:
+            remotes = list(self.remote.values())
+        if not remotes:
+            return histograms, counters
+        merged = dict()
+        for name, h in histograms.items():
+            merged[name] = Histogram(name)
+            merged[name].absorb(h.raw())
+        for raw in remotes:
+            for name, h in raw['histograms'].items():
+                merged.setdefault(name, Histogram(name)).absorb(h)
+            for name, value in raw['counters'].items():
+                counters[name] = counters.get(name, 0) + value
+        return merged, counters
+
+    def snapshot(self) -> dict:
+        histograms, counters = self._merged()
+        gauges = dict()
+        for name, sample in list(self.gauges.items()):
+            try:
+                gauges[name] = sample()
+            except Exception as e:
+                logging.info(f"failed to sample gauge {name}, error: {e}")
+        return {
+            'timestamp': time.time(),
+            'histograms': {name: h.snapshot() for name, h in histograms.items()},
+            'counters': counters,
+            'gauges': gauges,
+        }
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, h in snapshot['histograms'].items():
+            lines.append(f'# TYPE {name} summary')
+            for q, key in (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'), ('0.999', 'p999')):
+                lines.append(f'{name}{{quantile="{q}"}} {h[key]}')
+            lines.append(f'{name}_count {h["count"]}')
+            lines.append(f'{name}_sum {int(h["mean"] * h["count"])}')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        for name, value in snapshot['gauges'].items():
+            if isinstance(value, dict):
+                for key, one in value.items():
+                    if _is_sample(one):
+                        lines.append(f'{name}{{key="{key}"}} {int(one) if isinstance(one, bool) else one}')
+            elif _is_sample(value):
+                lines.append(f'{name} {int(value) if isinstance(value, bool) else value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _is_sample(value) -> bool:
+    # prometheus samples are numbers, flags go out as 0/1 and anything else is json only
+    return isinstance(value, (int, float))
+
+
+registry = Registry()
+
+
+class MetricsWriter:
+    # dumps the registry every `interval` seconds to `path`, prometheus text for *.prom files and
+    # json otherwise. The file is replaced atomically so scrapers never read half of it
+    def __init__(self, path: str = None, interval: float = None):
+        self.path = path or config.METRICS_FILE
+        self.interval = interval or config.METRICS_INTERVAL
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None or not self.path:
+            return
+        self.thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.path:
+            self.write()
+
+    def write(self):
+        if self.path.endswith('.prom'):
+            content = registry.to_prometheus()
+        else:
+            content = json.dumps(registry.snapshot(), indent=2)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(content)
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f"failed to write metrics to {self.path}, error: {e}")
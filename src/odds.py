@@ -0,0 +1,166 @@
+import argparse
+import bisect
+import json
+import math
+import numbers
+import random
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:     # numpy is optional, the list based path below gives the same results
+    numpy = None
+
+from src import constants
+
+# conversions between american odds, decimal odds and implied probability. Every function takes
+# either one number or a whole sequence of legs, sequences are converted in one batched call
+#   python -m src.odds bench    ladder snapping of a parlay's odds, leg by leg vs batched
+
+
+def is_american(odds) -> bool:
+    # american odds are 100 or more away from zero, 0 and anything between -100 and +100 is no price
+    return isinstance(odds, numbers.Real) and not isinstance(odds, bool) and math.isfinite(odds) and abs(odds) >= 100
+
+
+def american_to_decimal(odds):
+    if numpy is not None and not _is_scalar(odds):
+        odds = numpy.asarray(odds, dtype=float)
+        return numpy.where(odds > 0, 1 + odds / 100, 1 - 100 / odds)
+    if _is_scalar(odds):
+        return 1 + odds / 100 if odds > 0 else 1 - 100 / odds
+    return [1 + x / 100 if x > 0 else 1 - 100 / x for x in odds]
+
+
+def decimal_to_american(decimal):
+    # not snapped to the ladder, see OddsLadder.snap for that
+    if numpy is not None and not _is_scalar(decimal):
+        decimal = numpy.asarray(decimal, dtype=float)
+        return numpy.where(decimal >= 2, (decimal - 1) * 100, -100 / (decimal - 1))
+    if _is_scalar(decimal):
+        return (decimal - 1) * 100 if decimal >= 2 else -100 / (decimal - 1)
+    return [(x - 1) * 100 if x >= 2 else -100 / (x - 1) for x in decimal]
+
+
+def american_to_probability(odds):
+    decimal = american_to_decimal(odds)
+    if isinstance(decimal, list):
+        return [1 / x for x in decimal]
+    return 1 / decimal
+
+
+def probability_to_american(probability):
+    if numpy is not None and not _is_scalar(probability):
+        return decimal_to_american(1 / numpy.asarray(probability, dtype=float))
+    if _is_scalar(probability):
+        return decimal_to_american(1 / probability)
+    return decimal_to_american([1 / x for x in probability])
+
+
+class OddsLadder:
+    # the exchange only accepts american odds on a fixed ladder (constants.VALID_ODDS_BACKUP).
+    # Ladder ticks are kept in decimal, which is monotonic across the -100/+100 gap, so snapping
+    # is a binary search
+    ticks: list = []
+    decimal_ticks: list = []
+
+    def __init__(self, ticks: list = None):
+        ticks = ticks or constants.VALID_ODDS_BACKUP
+        invalid = [x for x in ticks if not is_american(x)]
+        if invalid:
+            raise Exception(f"odds ladder ticks {invalid} are not american odds")
+        self.ticks = sorted(ticks, key=american_to_decimal)
+        self.decimal_ticks = [american_to_decimal(x) for x in self.ticks]
+        if numpy is not None:
+            self._np_ticks = numpy.asarray(self.ticks)
+            self._np_decimal_ticks = numpy.asarray(self.decimal_ticks)
+
+    def snap(self, odds, direction: str = 'nearest'):
+        # snap american odds to a ladder tick. direction 'down' never pays out more than asked
+        # (the tick at or below in decimal terms), 'up' never less, 'nearest' picks the closer one
+        if _is_scalar(odds):
+            return self._snap_one(american_to_decimal(odds), direction)
+        if numpy is not None:
+            return self._snap_numpy(american_to_decimal(odds), direction)
+        return [self._snap_one(x, direction) for x in american_to_decimal(odds)]
+
+    def snap_probability(self, probability, direction: str = 'nearest'):
+        return self.snap(probability_to_american(probability), direction)
+
+    def _snap_one(self, decimal: float, direction: str) -> int:
+        ticks = self.decimal_ticks
+        i = bisect.bisect_left(ticks, decimal)
+        if i < len(ticks) and ticks[i] == decimal:
+            return self.ticks[i]
+        lower, upper = max(i - 1, 0), min(i, len(ticks) - 1)
+        if direction == 'down':
+            return self.ticks[lower]
+        if direction == 'up':
+            return self.ticks[upper]
+        return self.ticks[lower if decimal - ticks[lower] <= ticks[upper] - decimal else upper]
+
+    def _snap_numpy(self, decimal, direction: str):
+        ticks = self._np_decimal_ticks
+        i = numpy.searchsorted(ticks, decimal, side='left')
+        exact = (i < len(ticks)) & (ticks[numpy.minimum(i, len(ticks) - 1)] == decimal)
+        lower = numpy.where(exact, i, numpy.maximum(i - 1, 0))
+        upper = numpy.minimum(i, len(ticks) - 1)
+        if direction == 'down':
+            pick = lower
+        elif direction == 'up':
+            pick = upper
+        else:
+            pick = numpy.where(decimal - ticks[lower] <= ticks[upper] - decimal, lower, upper)
+        return self._np_ticks[pick].tolist()
+
+
+def _is_scalar(value) -> bool:
+    return isinstance(value, numbers.Number)
+
+
+def bench(parlays: int, legs: list, seed: int = 1) -> dict:
+    # ns per parlay to snap the offer and leg odds of every pricing tier, one snap call per price
+    # as pricing used to vs one batched call as PricingEngine.price does now, and the whole price()
+    from src import config
+    from src.catalog import LineCatalog, LineRecord
+    from src.codec import Leg
+    from src.pricing import PricingEngine
+    rng = random.Random(seed)
+    ladder = OddsLadder()
+    engine = PricingEngine(ladder)
+    tiers = len(config.PRICING_TIERS)
+    results = {'numpy': numpy is not None}
+    for n in legs:
+        cases = [[rng.uniform(0.01, 0.9) for _ in range((n + 1) * tiers)] for _ in range(parlays)]
+        started = time.perf_counter_ns()
+        looped = [[ladder.snap(probability_to_american(p), 'down') for p in probabilities] for probabilities in cases]
+        results[f'legs_{n}_loop_ns'] = (time.perf_counter_ns() - started) / parlays
+        started = time.perf_counter_ns()
+        batched = [ladder.snap_probability(probabilities, 'down') for probabilities in cases]
+        results[f'legs_{n}_batched_ns'] = (time.perf_counter_ns() - started) / parlays
+        if looped != batched:
+            raise Exception(f"batched snapping of {n} leg parlays differs from the per leg one")
+        records = [LineRecord(f'line-{i}', i, 1, 1, None, rng.choice(ladder.ticks)) for i in range(n)]
+        catalog = LineCatalog.from_records(records)
+        market_lines = [Leg(record.line_id, None, 1, 1, record.event_id) for record in records]
+        started = time.perf_counter_ns()
+        for _ in range(parlays):
+            engine.price(catalog, market_lines)
+        results[f'legs_{n}_price_ns'] = (time.perf_counter_ns() - started) / parlays
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.odds', description='odds tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='ladder snapping of a parlay, leg by leg vs batched')
+    p.add_argument('--parlays', type=int, default=20000)
+    p.add_argument('--legs', type=int, nargs='+', default=[2, 3, 4, 6, 8, 12, 16, 20])
+    args = parser.parse_args()
+    results = bench(args.parlays, args.legs)
+    sys.stdout.write(json.dumps({k: round(v, 1) if isinstance(v, float) else v for k, v in results.items()}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import threading
+import time
+
+import requests
+
+from collections import deque
+from urllib.parse import urlsplit
+from src import config
+from src.feed import RecentIds
+from src.log import quote_log
+from src.metrics import registry
+
+# offer submission stage between provide_price and the callback hosts. The quote worker hands the
+# encoded offers over and goes back to pricing; per callback host, OFFER_HOST_CONCURRENCY sender
+# threads post them over the transport's keep-alive connections, or over one multiplexed HTTP/2
+# connection when httpx and h2 are installed and OFFER_HTTP2 is set.
+#   - a parlay is queued at most once: a newer offer for a parlay still waiting replaces it, one
+#     already in flight or sent is not posted again
+#   - connection errors and 5xx are retried OFFER_RETRIES times through the same queue
+#   - every offer has a deadline (valid_until, or earlier the end of the ask's useful window),
+#     it is dropped rather than sent with less than OFFER_MIN_LEAD_MS left, and the post times
+#     out at the deadline
+try:
+    import httpx
+    import h2   # noqa: F401, httpx only speaks HTTP/2 with it
+except ImportError:
+    httpx = None
+
+_ERRORS = (requests.RequestException,) if httpx is None else (requests.RequestException, httpx.HTTPError)
+
+ASK_SEND = registry.histogram('ask_send_ns')
+ASK_TOTAL = registry.histogram('ask_total_ns')     # worker pickup to offer posted
+ASK_SEND_FAILED = registry.counter('ask_send_failed_total')
+OFFER_WAIT = registry.histogram('offer_queue_wait_ns')     # handed over to picked up by a sender
+OFFER_EXPIRED = registry.counter('offer_expired_total')
+OFFER_COALESCED = registry.counter('offer_coalesced_total')
+OFFER_DUPLICATE = registry.counter('offer_duplicate_total')
+OFFER_RETRIED = registry.counter('offer_retried_total')
+
+
+def offer_deadline(ask, valid_until: int, max_age_ns: int) -> int:
+    # epoch ns after which an offer for ask is no use, ask is a codec.AskRequest
+    if ask.created_at is None:
+        return valid_until
+    return min(valid_until, ask.created_at + max_age_ns)
+
+
+class Offer:
+    __slots__ = ('parlay_id', 'url', 'body', 'deadline', 'started', 'enqueued', 'attempts')
+
+    def __init__(self, parlay_id: str, url: str, body: bytes, deadline: int, started: int):
+        self.parlay_id = parlay_id
+        self.url = url
+        self.body = body
+        self.deadline = deadline    # epoch ns
+        self.started = started      # perf_counter_ns the quote worker picked the ask up
+        self.enqueued = 0
+        self.attempts = 0
+
+
+class _Host:
+    # queue of parlay ids waiting for one callback host, the offers themselves are in `pending`
+    def __init__(self):
+        self.order = deque()
+        self.pending = dict()   # parlay_id -> Offer
+        self.ready = threading.Condition()
+        self.threads = []
+
+
+class OfferSender:
+    def __init__(self, transport, per_host: int = None):
+        self.transport = transport
+        self.per_host = per_host or config.OFFER_HOST_CONCURRENCY
+        self.client = None
+        if config.OFFER_HTTP2 and httpx is not None:
+            self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=self.per_host))
+        self.hosts = dict()     # scheme://netloc -> _Host
+        self.in_flight = set()
+        self.sent = RecentIds(config.DEDUP_WINDOW)
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def submit(self, parlay_id: str, url: str, body: bytes, deadline: int, started: int):
+        self._enqueue(Offer(parlay_id, url, body, deadline, started))
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            hosts = list(self.hosts.values())
+        for host in hosts:
+            with host.ready:
+                host.order.extend([None] * len(host.threads))
+                host.ready.notify_all()
+        for host in hosts:
+            for thread in host.threads:
+                thread.join()
+        if self.client is not None:
+            self.client.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            hosts = list(self.hosts.items())
+        return {
+            'hosts': len(hosts),
+            'queued': sum(len(host.pending) for _, host in hosts),
+            'in_flight': len(self.in_flight),
+            'http2': int(self.client is not None),
+        }
+
+    def _enqueue(self, offer: Offer):
+        parlay_id = offer.parlay_id
+        host = self._host(offer.url)
+        if host is None:
+            return
+        with host.ready:
+            if parlay_id in host.pending:
+                # the newer offer wins, a retry never replaces one
+                OFFER_COALESCED.inc()
+                if offer.attempts == 0:
+                    host.pending[parlay_id] = offer
+                return
+            if offer.attempts == 0 and (parlay_id in self.in_flight or parlay_id in self.sent):
+                OFFER_DUPLICATE.inc()
+                return
+            offer.enqueued = time.perf_counter_ns()
+            host.pending[parlay_id] = offer
+            host.order.append(parlay_id)
+            host.ready.notify()
+
+    def _host(self, url: str):
+        parts = urlsplit(url)
+        key = f'{parts.scheme}://{parts.netloc}'
+        host = self.hosts.get(key)
+        if host is not None:
+            return host
+        with self.lock:
+            if self.stopped:
+                return None
+            host = self.hosts.get(key)
+            if host is None:
+                host = _Host()
+                for i in range(self.per_host):
+                    thread = threading.Thread(target=self._work, args=(host,), name=f'offer-sender-{parts.netloc}-{i}',
+                                              daemon=True)
+                    thread.start()
+                    host.threads.append(thread)
+                self.hosts[key] = host
+                if self.client is None:
+                    self.transport.warm(url, wait=False)
+        return host
+
+    def _work(self, host: _Host):
+        while True:
+            with host.ready:
+                while not host.order:
+                    host.ready.wait()
+                parlay_id = host.order.popleft()
+                if parlay_id is None:
+                    return
+                offer = host.pending.pop(parlay_id)
+                self.in_flight.add(parlay_id)
+            retry = False
+            try:
+                retry = self._send(offer)
+            finally:
+                with host.ready:
+                    self.in_flight.discard(parlay_id)
+            if retry:
+                OFFER_RETRIED.inc()
+                self._enqueue(offer)
+
+    def _send(self, offer: Offer) -> bool:
+        # True when the offer should go again
+        picked = time.perf_counter_ns()
+        OFFER_WAIT.record(picked - offer.enqueued)
+        remaining = offer.deadline - time.time_ns()
+        if remaining < config.OFFER_MIN_LEAD_MS * 1000000:
+            OFFER_EXPIRED.inc()
+            quote_log.info("offer expired before it could be sent", parlay_id=offer.parlay_id)
+            return False
+        offer.attempts += 1
+        error = None
+        try:
+            status = self._post(offer.url, offer.body, remaining / 1e9)
+        except _ERRORS as e:
+            status, error = None, e
+        sent = time.perf_counter_ns()
+        ASK_SEND.record(sent - picked)
+        if status == 200:
+            ASK_TOTAL.record(sent - offer.started)
+            self.sent.seen(offer.parlay_id)
+            quote_log.info("price sent successfully", parlay_id=offer.parlay_id)
+            return False
+        if (status is None or status >= 500) and offer.attempts <= config.OFFER_RETRIES:
+            return True
+        ASK_SEND_FAILED.inc()
+        quote_log.error("price did not sent successfully, status %s, error %s", status, error,
+                        parlay_id=offer.parlay_id)
+        return False
+
+    def _post(self, url: str, body: bytes, timeout: float) -> int:
+        if self.client is not None:
+            return self.client.post(url, content=body, headers=self.transport.auth_header, timeout=timeout).status_code
+        return self.transport.post(url, data=body, timeout=timeout).status_code
@@ -1,16 +1,56 @@
+import argparse
+import os
+import sys
+import tempfile
 import time
 
 import requests
-import json
 import pysher
-import schedule
 import threading
 
-from urllib.parse import urljoin
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urljoin, urlsplit
 from src import config
 #from src import config_staging as config
-from src.log import logging
+from src.log import logging, quote_log
+from src import log
 from src import constants
+from src import codec
+from src.transport import Transport
+from src.dispatcher import QuoteDispatcher
+from src.catalog import LineCatalog
+from src.odds import OddsLadder, american_to_decimal
+from src.pricing import PricingEngine, Quote
+from src.quote_cache import QuoteCache
+from src.metrics import registry, MetricsWriter
+from src.session import SessionManager, token_expiry
+from src.feed import PusherSupervisor, RecentIds
+from src.exposure import ExposureLedger
+from src.scheduler import Scheduler
+from src.offers import OfferSender, offer_deadline, ASK_SEND, ASK_TOTAL, ASK_SEND_FAILED
+from src import snapshot
+from src import ingest
+from src.wagers import WagerCanceller
+from src.lifecycle import EventLifecycle, event_state
+from src.market_loader import MarketLoader
+
+# hot path timings in nanoseconds, see src/metrics.py
+ASK_AGE = registry.histogram('ask_age_ns')     # created_at to arrival on the websocket
+ASK_PARSE = registry.histogram('ask_parse_ns')
+ASK_PRICE = registry.histogram('ask_price_ns')
+ASK_SERIALIZE = registry.histogram('ask_serialize_ns')
+ASK_UNPRICED = registry.counter('ask_unpriced_total')
+CONFIRM_PARSE = registry.histogram('confirm_parse_ns')
+CONFIRM_PRICE = registry.histogram('confirm_price_ns')
+CONFIRM_SEND = registry.histogram('confirm_send_ns')
+CONFIRM_SEND_FAILED = registry.counter('confirm_send_failed_total')
+ASK_DUPLICATE = registry.counter('ask_duplicate_total')     # redelivered by pusher, see src/feed.py
+CONFIRM_DUPLICATE = registry.counter('confirm_duplicate_total')
+ASK_OVER_LIMIT = registry.counter('ask_over_limit_total')   # no offer fits the exposure headroom
+CONFIRM_OVER_LIMIT = registry.counter('confirm_over_limit_total')
+
+#   python -m src.parlay_connect bench --events 100 400 1600    seeding wall-clock, serial vs concurrent
 
 
 class ParlayInteractions:
@@ -20,13 +60,67 @@ class ParlayInteractions:
     mm_session: dict = dict()
     all_tournaments: dict = dict()    # mapping from string to id
     my_tournaments: dict = dict()
-    sport_events: dict = dict()   # key is event id, value is a list of event details and markets
+    sport_events: dict = dict()   # key is event id, value is the event details, its markets live in the catalog
+    tournament_events: dict = dict()    # tournament id -> ids of its events seen on the last seed
+    last_seed_diff: dict = dict()   # 'added'/'changed'/'removed' event ids of the last seed
+    catalog: LineCatalog = LineCatalog()    # line_id index over sport_events, rebuilt on every seed
     valid_odds: list = []
+    odds_ladder: OddsLadder = None
+    pricing_engine: PricingEngine = None
+    recent_quotes: OrderedDict = None   # parlay_id -> Quote we offered, oldest first
+    quote_cache: QuoteCache = None
+    published_lines: set = None     # line ids the exchange has been told we support, None before the first publish
+    last_publish_stats: dict = dict()
+    exposure_ledger: ExposureLedger = None
+    event_tournaments: dict = dict()    # sport event id -> tournament id, for the exposure keys
+    warm_started: bool = False  # seeded from the snapshot, keep_alive reconciles with the api right away
+    token_expires_at: float = 0     # epoch seconds, see src/session.py
+    connection_configs: dict = dict()   # pusher key and cluster
     pusher = None
+    event_handlers: dict = dict()   # private channel event name -> handler, see _register_channels
+    default_event_handler = None
+    subscribed_channels: dict = dict()     # channel name -> bound events, on channels_socket_id
+    channels_socket_id: str = None
+    transport: Transport = None     # None in the asyncio client, see _http_clients
+    offer_sender: OfferSender = None
+    dispatcher: QuoteDispatcher = None
 
     def __init__(self):
         self.base_url = config.BASE_URL
         self.mm_keys = config.MM_KEYS
+        self.transport, self.offer_sender = self._http_clients()
+        self.dispatcher = QuoteDispatcher()
+        self.recent_quotes = OrderedDict()
+        self.quote_cache = QuoteCache(config.QUOTE_CACHE_SIZE, config.QUOTE_CACHE_TTL)
+        self.metrics_writer = MetricsWriter()
+        registry.gauge('quote_queue_depth', lambda: self.dispatcher.queued)
+        registry.gauge('quote_dropped_full', lambda: self.dispatcher.dropped_full)
+        registry.gauge('quote_dropped_stale', lambda: self.dispatcher.dropped_stale)
+        registry.gauge('quote_cache', self.quote_cache.stats)
+        registry.gauge('supported_lines_publish', lambda: self.last_publish_stats)
+        self.exposure_ledger = ExposureLedger()
+        registry.gauge('exposure', self.exposure_ledger.stats)
+        registry.gauge('log', log.stats)
+        if self.offer_sender is not None:
+            registry.gauge('offers', self.offer_sender.stats)
+        self._quotes_lock = threading.Lock()
+        self._catalog_lock = threading.Lock()   # one catalog rebuild at a time, readers never take it
+        self.lifecycle = EventLifecycle(self)
+        registry.gauge('lifecycle', self.lifecycle.stats)
+        self.market_loader = MarketLoader(self)
+        registry.gauge('market_loader', self.market_loader.stats)
+        self.scheduler = Scheduler()
+        self.session_manager = SessionManager(self, self.scheduler)
+        self.pusher_supervisor = PusherSupervisor(self)
+        self.seen_asks = RecentIds(config.DEDUP_WINDOW)
+        self.seen_confirms = RecentIds(config.DEDUP_WINDOW)
+        self.subscribed_channels = dict()
+        self._channels_lock = threading.Lock()
+
+    def _http_clients(self) -> tuple:
+        # (transport, offer sender) every REST call and offer goes through
+        transport = Transport()
+        return transport, OfferSender(transport)
 
     def login(self) -> dict:
         login_url = urljoin(self.base_url, config.URL['mm_login'])
@@ -34,117 +128,266 @@ class ParlayInteractions:
             'access_key': self.mm_keys.get('access_key'),
             'secret_key': self.mm_keys.get('secret_key'),
         }
-        response = requests.post(login_url, data=json.dumps(request_body))
+        response = self.transport.post(login_url, data=codec.dumps(request_body))
         if response.status_code != 200:
             logging.debug(response)
             raise Exception("login failed")
-        mm_session = json.loads(response.content)['data']
+        mm_session = codec.loads(response.content)['data']
         logging.info(mm_session)
-        self.mm_session = mm_session
+        self._set_session(mm_session)
+        self.transport.warm(self.base_url)
         logging.info("MM session started")
         return mm_session
 
-    def seeding(self):
-        # get allowed odds
-        logging.info("start to get allowed odds")
-        self.valid_odds = constants.VALID_ODDS_BACKUP
+    def seeding(self, incremental: bool = False):
+        # incremental=True keeps the markets of events that did not change since the last seed and
+        # only fetches markets for new or changed ones; events no longer listed are evicted
+        self._load_valid_odds()
 
         # initiate available tournaments/sport_events
         # tournaments
         logging.info("start seeding tournaments/events/markets")
+        started = time.monotonic()
+        seeded_before = len(self.sport_events) > 0
         t_url = urljoin(self.base_url, config.URL['mm_tournaments'])
-        headers = self.__get_auth_header()
         try:
-            all_tournaments_response = requests.get(t_url, headers=headers)
-        except Exception as e:
-            print(e)
-            if len(self.sport_events) == 0:
-                return
-            else:
-                raise Exception("not able to seed tournaments")
-        if all_tournaments_response.status_code != 200:
-            if len(self.sport_events) == 0:
-                # if seeded before, ignore one time failure
+            all_tournaments_response = self._get_with_retry(t_url)
+        except requests.RequestException as e:
+            logging.info(f"failed to get tournaments, error: {e}")
+            all_tournaments_response = None
+        if all_tournaments_response is None or all_tournaments_response.status_code != 200:
+            if not seeded_before:
                 raise Exception("not able to seed tournaments")
-            else:
-                return
-        all_tournaments = json.loads(all_tournaments_response.content).get('data', {}).get('tournaments', {})
+            # if seeded before, ignore one time failure
+            return
+        all_tournaments = codec.loads(all_tournaments_response.content).get('data', {}).get('tournaments', {})
         self.all_tournaments = all_tournaments
 
-        # get sportevents and markets of each
+        # get sportevents and markets of each, fanned out over a bounded pool: every finished
+        # mm_events call queues one mm_markets call per event it returned
         event_url = urljoin(self.base_url, config.URL['mm_events'])
         market_url = urljoin(self.base_url, config.URL['mm_markets'])
-        self.sport_events = dict()
-        for one_t in all_tournaments:
-            if one_t['name'] in config.TOURNAMENTS_INTERESTED or config.LOAD_ALL_TOURNAMENTS:
-                self.my_tournaments[one_t['id']] = one_t
-                try:
-                    events_response = requests.get(event_url, params={'tournament_id': one_t['id']}, headers=headers)
-                except Exception as e:
-                    if len(self.sport_events) == 0:
-                        raise Exception("Error")
-                    else:
+        sport_events = dict()
+        event_records = dict()
+        tournament_events = dict()
+        failed_tournaments = set()
+        my_tournaments = dict()
+        now_ns = time.time_ns()
+        with ThreadPoolExecutor(max_workers=config.SEEDING_CONCURRENCY) as pool:
+            pending = dict()
+            for one_t in all_tournaments:
+                if one_t['name'] in config.TOURNAMENTS_INTERESTED or config.LOAD_ALL_TOURNAMENTS:
+                    my_tournaments[one_t['id']] = one_t
+                    if self.lifecycle.skip_tournament(one_t['id']):
                         continue
-                if events_response.status_code == 200:
-                    events = json.loads(events_response.content).get('data', {}).get('sport_events')
-                    if events is None:
+                    future = pool.submit(self._get_with_retry, event_url,
+                                         params={'tournament_id': one_t['id']})
+                    pending[future] = ('events', one_t)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, item = pending.pop(future)
+                    try:
+                        response = future.result()
+                    except requests.RequestException as e:
+                        if kind == 'events':
+                            failed_tournaments.add(item['id'])
+                            logging.info(f'skip tournament {item["name"]} as api request failed, error: {e}')
+                        else:
+                            self._keep_previous(sport_events, item['event_id'], incremental)
+                            logging.info(f'failed to get markets of events {item["name"]}, error: {e}')
                         continue
-                    for event in events:
-                        market_response = requests.get(market_url, params={'event_id': event['event_id']},
-                                                       headers=headers)
-                        if market_response.status_code == 200:
-                            markets = json.loads(market_response.content).get('data', {}).get('markets', {})
-                            if markets is None:
-                                # this is more like a bug in MM api, as the event actually already closed
+                    if kind == 'events':
+                        if response.status_code != 200:
+                            failed_tournaments.add(item['id'])
+                            logging.info(f'skip tournament {item["name"]} as api request failed')
+                            continue
+                        events = codec.loads(response.content).get('data', {}).get('sport_events')
+                        if events is None:
+                            continue
+                        tournament_events[item['id']] = {event['event_id'] for event in events}
+                        for event in events:
+                            if event_state(event, now_ns) == 'closed':
                                 continue
-                            event['markets'] = markets
-                            self.sport_events[event['event_id']] = event
-                            logging.info(f'successfully get markets of events {event["name"]}')
-                        else:
-                            logging.info(f'failed to get markets of events {event["name"]},'
-                                         f' error: {market_response.reason}')
-                else:
-                    logging.info(f'skip tournament {one_t["name"]} as api request failed')
-
-        logging.info("Done, seeding")
-        logging.info(f"found {len(self.my_tournaments)} tournament, ingested {len(self.sport_events)} "
-                     f"sport events from {len(config.TOURNAMENTS_INTERESTED)} tournaments")
-        for key in self.sport_events:
-            one_event = self.sport_events[key]
-            for market in one_event['markets']:
-                if 'selections' in market:
-                    if len(market['selections']) == 0:
-                        raise Exception(f"selection is empty for event {key}")
-                    for selection in market['selections']:
-                        if len(selection) == 0 or selection[0].get('line_id', None) is None:
-                            pass
-                            #raise Exception(f'line_id is empty for event {key}')
-                        #else:
-                        #    print(selection[0]['line_id'])
-                elif 'market_lines' in market:
-                    for market_line in market['market_lines']:
-                        if 'selections' not in market_line or len(market_line['selections']) == 0:
-                            raise Exception(f'selections is empty')
-                        for selection in market_line['selections']:
-                            if len(selection) < 1:
-                                #TODO: need to make sure we never get here
+                            current = self.sport_events.get(event['event_id'])
+                            if incremental and current is not None and self._same_event(current, event):
+                                sport_events[event['event_id']] = current
                                 continue
-                            if selection[0].get('line_id', None) is None:
-                                raise Exception(f'line_id is empty for event {key}')
-                            #print(selection[0]['line_id'])
-                else:
-                    #raise Exception("no selection, no market_lines")
-                    print("no selection, no market_lines")
-        print("validated")
+                            market_future = pool.submit(self._get_with_retry, market_url,
+                                                        params={'event_id': event['event_id']})
+                            pending[market_future] = ('markets', event)
+                    elif response.status_code == 200:
+                        records = ingest.market_records(response.content, item['event_id'])
+                        if records is None:
+                            # this is more like a bug in MM api, as the event actually already closed
+                            continue
+                        event_records[item['event_id']] = records
+                        sport_events[item['event_id']] = item
+                        logging.info(f'successfully get markets of events {item["name"]}')
+                    else:
+                        self._keep_previous(sport_events, item['event_id'], incremental)
+                        logging.info(f'failed to get markets of events {item["name"]},'
+                                     f' error: {response.reason}')
+        self.my_tournaments = my_tournaments
+        self._apply_seed(sport_events, event_records, tournament_events, failed_tournaments, incremental,
+                         seeded_before, started)
+        self._save_snapshot()
+
+    def warm_start(self) -> bool:
+        # seed from the on-disk snapshot instead of crawling the api, False when there is none usable
+        if not config.SNAPSHOT_FILE:
+            return False
+        started = time.monotonic()
+        loaded = snapshot.load(config.SNAPSHOT_FILE, config.SNAPSHOT_MAX_AGE, snapshot.source())
+        if loaded is None:
+            return False
+        self._load_valid_odds()
+        snapshot.apply(self, *loaded)
+        self.warm_started = True
+        logging.info(f"warm start from {config.SNAPSHOT_FILE} in {time.monotonic() - started:.3f}s, "
+                     f"{len(self.sport_events)} sport events, {len(self.catalog)} lines")
+        return True
+
+    def _save_snapshot(self):
+        if not config.SNAPSHOT_FILE:
+            return
+        try:
+            snapshot.save(self, config.SNAPSHOT_FILE)
+        except OSError as e:
+            logging.error(f"failed to write catalog snapshot, error: {e}")
 
+    def _load_valid_odds(self):
+        # get allowed odds
+        logging.info("start to get allowed odds")
+        self.valid_odds = constants.VALID_ODDS_BACKUP
+        self.odds_ladder = OddsLadder(self.valid_odds)
+        self.pricing_engine = PricingEngine(self.odds_ladder)
+
+    def _apply_seed(self, sport_events: dict, event_records: dict, tournament_events: dict,
+                    failed_tournaments: set, incremental: bool, seeded_before: bool, started: float):
+        # second half of seeding, shared with the asyncio client: fill in what failed to refresh,
+        # diff against the current state and swap the new catalog in
+        if len(failed_tournaments) > 0 and len(sport_events) == 0 and not seeded_before:
+            raise Exception("not able to seed sport events")
+        with self._catalog_lock:
+            self._merge_seed(sport_events, event_records, tournament_events, failed_tournaments, incremental)
+        logging.info(f"quote cache {self.quote_cache.stats()}")
+        logging.info(f"Done, seeding in {time.monotonic() - started:.2f}s, {len(self.last_seed_diff['added'])} "
+                     f"events added, {len(self.last_seed_diff['changed'])} changed, "
+                     f"{len(self.last_seed_diff['removed'])} removed")
+        logging.info(f"found {len(self.my_tournaments)} tournament, ingested {len(self.sport_events)} "
+                     f"sport events from {len(config.TOURNAMENTS_INTERESTED)} tournaments, "
+                     f"{len(self.catalog)} lines indexed")
+
+    def _merge_seed(self, sport_events: dict, event_records: dict, tournament_events: dict,
+                    failed_tournaments: set, incremental: bool):
+        if incremental:
+            # a tournament we could not list this time keeps the events it had
+            for t_id in failed_tournaments:
+                tournament_events[t_id] = self.tournament_events.get(t_id, set())
+                for event_id in tournament_events[t_id]:
+                    self._keep_previous(sport_events, event_id, incremental)
+        # events loaded on demand stay until the sweep expires them, unless a tournament listed them
+        loaded = self.tournament_events.get(None, set()) - sport_events.keys()
+        if loaded:
+            tournament_events[None] = loaded
+            for event_id in loaded:
+                self._keep_previous(sport_events, event_id, True)
+
+        previous_events = self.sport_events
+        unchanged = {k for k, v in sport_events.items() if previous_events.get(k) is v}
+        self.last_seed_diff = {
+            'added': sport_events.keys() - previous_events.keys(),
+            'changed': (sport_events.keys() & previous_events.keys()) - unchanged,
+            'removed': previous_events.keys() - sport_events.keys(),
+        }
+        catalog = LineCatalog.build(sport_events, event_records, previous=self.catalog, reuse=unchanged)
+        self._install(catalog, sport_events, tournament_events,
+                      self.last_seed_diff['changed'] | self.last_seed_diff['removed'])
+        self._settle_events(self.last_seed_diff['removed'])
+
+    def _install(self, catalog: LineCatalog, sport_events: dict, tournament_events: dict, stale_events):
+        # swap in one go, quote handlers only ever see the old or the new catalog. Cached quotes
+        # touching the lines of stale_events go
+        previous_catalog = self.catalog
+        self.catalog, self.sport_events, self.tournament_events = catalog, sport_events, tournament_events
+        self.event_tournaments = {event_id: t_id for t_id, event_ids in tournament_events.items()
+                                  for event_id in event_ids}
+        stale_lines = [record.line_id for event_id in stale_events
+                       for record in previous_catalog.lines_for_event(event_id)]
+        self.quote_cache.invalidate_lines(stale_lines)
+
+    def _settle_events(self, event_ids: set):
+        # events over, the parlays on them stop counting once all their legs' events are
+        self.exposure_ledger.settle_events(event_ids)
+
+    def _remove_events(self, event_ids: set):
+        # evict events between seeds, see src/lifecycle.py. Tournaments left without events go too
+        with self._catalog_lock:
+            sport_events = {k: v for k, v in self.sport_events.items() if k not in event_ids}
+            tournament_events = dict()
+            for t_id, t_event_ids in self.tournament_events.items():
+                remaining = t_event_ids - event_ids
+                if remaining or not t_event_ids:
+                    tournament_events[t_id] = remaining
+            self._install(self.catalog.replaced({}, event_ids), sport_events, tournament_events, event_ids)
+
+    def _add_events(self, events: dict, event_records: dict):
+        # events maps event id -> (tournament id, event), fetched between seeds by the market
+        # loader. Tournament None holds the events of no seeded tournament
+        with self._catalog_lock:
+            previous_events = self.sport_events
+            sport_events = dict(previous_events)
+            tournament_events = dict(self.tournament_events)
+            for event_id, (t_id, event) in events.items():
+                sport_events[event_id] = event
+                tournament_events[t_id] = tournament_events.get(t_id, set()) | {event_id}
+            self._install(self.catalog.replaced(event_records), sport_events, tournament_events,
+                          events.keys() & previous_events.keys())
+
+    def _get_markets(self, event_id: int):
+        # mm_markets body of one event for the market loader, None when the call failed
+        market_url = urljoin(self.base_url, config.URL['mm_markets'])
+        try:
+            response = self.transport.get(market_url, params={'event_id': event_id})
+        except requests.RequestException as e:
+            logging.info(f"failed to get markets of event {event_id}, error: {e}")
+            return None
+        if response.status_code != 200:
+            logging.info(f"failed to get markets of event {event_id}, status {response.status_code}")
+            return None
+        return response.content
+
+    @staticmethod
+    def _same_event(current: dict, fetched: dict) -> bool:
+        # snapshots written before markets moved to the catalog still carry them, ignore those
+        return {k: v for k, v in current.items() if k != 'markets'} == fetched
+
+    def _keep_previous(self, sport_events: dict, event_id: int, incremental: bool):
+        if incremental and event_id in self.sport_events and event_id not in sport_events:
+            sport_events[event_id] = self.sport_events[event_id]
+
+    def _get_with_retry(self, url, params=None):
+        # retry connection errors and 5xx responses with exponential backoff, anything else is
+        # returned to the caller as is
+        delay = config.RETRY_BACKOFF
+        for attempt in range(config.REQUEST_RETRIES + 1):
+            last_attempt = attempt == config.REQUEST_RETRIES
+            try:
+                response = self.transport.get(url, params=params)
+                if response.status_code < 500 or last_attempt:
+                    return response
+            except requests.RequestException:
+                if last_attempt:
+                    raise
+            time.sleep(delay)
+            delay *= 2
 
     def _get_channels(self, socket_id: float):
         # get websocket channels to subscribe to
         auth_endpoint_url = urljoin(self.base_url, config.URL['parlay_websocket_auth'])
         # auth_endpoint_url = "http://localhost:19002/api/v1/mm/pusher"
-        channels_response = requests.post(auth_endpoint_url,
-                                          data={'socket_id': socket_id},
-                                          headers=self.__get_auth_header())
+        channels_response = self.transport.post(auth_endpoint_url, data={'socket_id': socket_id})
         if channels_response.status_code != 200:
             logging.error("failed to get channels")
             raise Exception("failed to get channels")
@@ -153,7 +396,7 @@ class ParlayInteractions:
 
     def _get_connection_config(self):
         connection_config_url = urljoin(self.base_url, config.URL['parlay_connection_config'])
-        connection_response = requests.get(connection_config_url, headers=self.__get_auth_header())
+        connection_response = self.transport.get(connection_config_url)
         if connection_response.status_code != 200:
             logging.error("failed to get connection configs")
             raise Exception("failed to get channels")
@@ -161,22 +404,28 @@ class ParlayInteractions:
         return conn_configs
 
     def subscribe(self):
-        connection_configs = self._get_connection_config()
-        auth_endpoint_url = urljoin(self.base_url, config.URL['parlay_websocket_auth'])
-        auth_header = self.__get_auth_header()
-        auth_headers = {
-                           "Authorization": auth_header['Authorization'],
-                       }
-        self.pusher = pysher.Pusher(key=connection_configs['key'], cluster=connection_configs['cluster'],
-                                    auth_endpoint=auth_endpoint_url,
-                                    auth_endpoint_headers=auth_headers)
+        self.connection_configs = self._get_connection_config()
 
         def public_event_handler(*args, **kwargs):
-            print("processing public, Args:", args)
-            event_received = json.loads(args[0]).get('payload', '{}')
-            print(f"event details {event_received}")
-            print("processing public, Kwargs:", kwargs)
-            self.provide_price(event_received)
+            # runs on the pusher thread: parse and hand over to the quote workers, nothing else
+            started = time.perf_counter_ns()
+            try:
+                ask = codec.decode_ask(args[0])
+            except (codec.InvalidPayload, ValueError) as e:
+                quote_log.error("invalid price.ask.new payload, error: %s", e)
+                return
+            ASK_PARSE.record(time.perf_counter_ns() - started)
+            if ask.created_at is not None:
+                ASK_AGE.record(time.time_ns() - ask.created_at)
+            if self.seen_asks.seen(ask.parlay_id):
+                ASK_DUPLICATE.inc()
+                return
+            if self.dispatcher.is_stale(ask):
+                # past its useful window already, do not even queue it
+                self.dispatcher.drop_stale()
+                return
+            if not self.dispatcher.submit(ask.parlay_id, self.provide_price, ask):
+                quote_log.info("quote queue full, dropped parlay", parlay_id=ask.parlay_id)
             """
             {'callback_url': 'https://api-ss-sandbox.betprophet.co/parlay/sp/order/offers', 
             'created_at': 1744210012349577200,
@@ -192,180 +441,426 @@ class ParlayInteractions:
             """
 
         def private_price_confirm_event_handler(*args, **kwargs):
-            print("processing price.confirm.new, Args:", args)
-            event_received = json.loads(args[0]).get('payload', '{}')
-            self.confirm_price(event_received)
+            started = time.perf_counter_ns()
+            try:
+                confirm = codec.decode_confirm(args[0])
+            except (codec.InvalidPayload, ValueError) as e:
+                quote_log.error("invalid price.confirm.new payload, error: %s", e)
+                return
+            CONFIRM_PARSE.record(time.perf_counter_ns() - started)
+            if self.seen_confirms.seen(confirm.parlay_id):
+                CONFIRM_DUPLICATE.inc()
+                return
+            # same shard as the ask of this parlay, so the confirm never overtakes it
+            self.dispatcher.submit(confirm.parlay_id, self.confirm_price, confirm, sheddable=False)
 
         def order_finalized_handler(*args, **kwargs):
-            print("order finalized, parlay contract is locked")
+            try:
+                finalized = codec.decode_finalized(args[0])
+            except (codec.InvalidPayload, ValueError) as e:
+                quote_log.error("invalid order.finalized payload, error: %s", e)
+                return
+            # behind the confirm of the same parlay on its shard
+            self.dispatcher.submit(finalized.parlay_id, self.order_finalized, finalized, sheddable=False)
 
         def private_event_handler(*args, **kwargs):
-            print("processing other private events, Args:", args)
+            logging.debug("processing other private events, args: %s", args)
+
+        self.event_handlers = {
+            'price.ask.new': public_event_handler,
+            'price.confirm.new': private_price_confirm_event_handler,
+            'order.finalized': order_finalized_handler,
+        }
+        self.default_event_handler = private_event_handler
+
+        self.dispatcher.start()
+        self.pusher_supervisor.start()
+
+    def _connect_pusher(self):
+        # a fresh pysher connection, made by subscribe() and on every reconnect by PusherSupervisor
+        auth_endpoint_url = urljoin(self.base_url, config.URL['parlay_websocket_auth'])
+        # pysher builds the path itself, only host, port and scheme are taken from PUSHER_URL
+        url = urlsplit(config.PUSHER_URL.format(**self.connection_configs))
+        pusher = pysher.Pusher(key=self.connection_configs['key'], cluster=self.connection_configs['cluster'],
+                               secure=url.scheme == 'wss', custom_host=url.hostname, port=url.port,
+                               auth_endpoint=auth_endpoint_url,
+                               auth_endpoint_headers=dict(self.transport.auth_header),
+                               reconnect_interval=config.WEBSOCKET_RECONNECT_MIN,
+                               log_level=logging.WARNING)
 
         # We can't subscribe until we've connected, so we use a callback handler
         # to subscribe when able
         def connect_handler(data):
-            socket_id = json.loads(data)['socket_id']
-            available_channels = self._get_channels(socket_id)
-            broadcast_channel_name = None
-            private_channel_name = None
-            private_events = None
+            if pusher is self.pusher:
+                self._register_channels(codec.loads(data)['socket_id'])
+
+        pusher.connection.bind('pusher:connection_established', connect_handler)
+        self.pusher = pusher
+        pusher.connect()
+
+    def _register_channels(self, socket_id: str):
+        # register the socket through parlay_websocket_auth and subscribe the channels it is
+        # authorized for. Runs on every (re)connect and after a session refresh: channels already
+        # subscribed on this socket are left alone and new ones are subscribed before dropped ones
+        # are unsubscribed, so the feed has no gap
+        available_channels = self._get_channels(socket_id)
+        with self._channels_lock:
+            if socket_id != self.channels_socket_id:
+                self.subscribed_channels = dict()
+            wanted = dict()
             for channel in available_channels:
-                if 'broadcast' in channel['channel_name']:
-                    broadcast_channel_name = channel['channel_name']
-                    public_events = channel['binding_events']
-                else:
-                    private_channel_name = channel['channel_name']
-                    private_events = channel['binding_events']
-            broadcast_channel = self.pusher.subscribe(broadcast_channel_name)
-            for event in public_events:
-                # 'price.ask.new' is to receive parlay quoting requests
-                broadcast_channel.bind(event, public_event_handler)
-                logging.info(f"subscribed to broadcast channel, event name: {event}, successfully")
-
-            private_channel = self.pusher.subscribe(private_channel_name)
-            for private_event in private_events:
-                # 'price.confirm.new'
-                if private_event == 'price.confirm.new':
-                    private_channel.bind(private_event, private_price_confirm_event_handler)
-                elif private_event == 'order.finalized':
-                    private_channel.bind(private_event, order_finalized_handler)
-                else:
-                    private_channel.bind(private_event, private_event_handler)
-                logging.info(f"subscribed to private channel, event name: {private_event}, successfully")
-
-        self.pusher.connection.bind('pusher:connection_established', connect_handler)
-        self.pusher.connect()
-
-    def provide_price(self, price_quote_request):
+                channel_name = channel['channel_name']
+                events = channel['binding_events']
+                wanted[channel_name] = events
+                if self.subscribed_channels.get(channel_name) == events:
+                    continue
+                subscribed = self.pusher.subscribe(channel_name)
+                for event in events:
+                    if 'broadcast' in channel_name:
+                        # 'price.ask.new' is to receive parlay quoting requests
+                        handler = self.event_handlers['price.ask.new']
+                    else:
+                        handler = self.event_handlers.get(event, self.default_event_handler)
+                    subscribed.bind(event, handler)
+                    logging.info(f"subscribed to channel {channel_name}, event name: {event}, successfully")
+            for channel_name in self.subscribed_channels.keys() - wanted.keys():
+                self.pusher.unsubscribe(channel_name)
+                logging.info(f"unsubscribed from channel {channel_name}")
+            self.subscribed_channels = wanted
+            self.channels_socket_id = socket_id
+
+    def provide_price(self, price_quote_request: codec.AskRequest):
         # have to be valid for more than 5 seconds
         now_nanno = int((time.time() + 500) * 1000000000)
-        lines = price_quote_request['market_lines']
-        provide_price_result = requests.post(
-            price_quote_request['callback_url'],
-            data=json.dumps({
-                'parlay_id': price_quote_request['parlay_id'],
-                'offers': [
-                    {
-                        'valid_until': now_nanno,
-                        'odds': 100000,
-                        'max_risk': 200,
-                        "estimated_price": [{'line_id': x['line_id'], 'odds': 200} for x in lines]
-                    },
-                    {
-                        'valid_until': now_nanno,
-                        'odds': 800,
-                        'max_risk': 2000,
-                        "estimated_price": [{'line_id': x['line_id'], 'odds': 200} for x in lines]
-                    }
-                ]
-            }),
-            headers=self.__get_auth_header()
-        )
-        if provide_price_result.status_code == 200:
-            print("price sent successfully")
+        started = time.perf_counter_ns()
+        deadline = offer_deadline(price_quote_request, now_nanno, self.dispatcher.max_age_ns)
+        quote = self._price_ask(price_quote_request)
+        if quote is None and self.market_loader.load_then(
+                price_quote_request.market_lines, lambda loaded: self._retry_ask(price_quote_request, deadline, loaded)):
+            # priced again once the markets it misses are in, this worker moves on to the next ask
+            return
+        priced = time.perf_counter_ns()
+        ASK_PRICE.record(priced - started)
+        if quote is None:
+            ASK_UNPRICED.inc()
+            quote_log.info("skip parlay, it has lines we did not seed", parlay_id=price_quote_request.parlay_id)
+            return
+        offer_tails = self._offer_tails(price_quote_request, quote)
+        if offer_tails is None:
+            ASK_OVER_LIMIT.inc()
+            quote_log.info("skip parlay, no exposure headroom left on its lines",
+                           parlay_id=price_quote_request.parlay_id)
+            return
+        self._remember_quote(price_quote_request.parlay_id, quote)
+        body = codec.encode_offers(price_quote_request.parlay_id, now_nanno, offer_tails)
+        ASK_SERIALIZE.record(time.perf_counter_ns() - priced)
+        # posted by the offer sender, this worker moves on to the next ask
+        self.offer_sender.submit(price_quote_request.parlay_id, price_quote_request.callback_url, body, deadline,
+                                 started)
+
+    def _retry_ask(self, price_quote_request: codec.AskRequest, deadline: int, loaded: bool):
+        # market loader callback: the ask goes back to its shard, unless its markets did not load or
+        # it could no longer be answered in time
+        if loaded and self._load_timeout(deadline) > 0:
+            self.dispatcher.submit(price_quote_request.parlay_id, self.provide_price, price_quote_request)
+            return
+        ASK_UNPRICED.inc()
+        quote_log.info("skip parlay, the markets of its lines did not load in time",
+                       parlay_id=price_quote_request.parlay_id)
+
+    @staticmethod
+    def _load_timeout(deadline: int) -> float:
+        # seconds an ask can wait for its markets and still have its offer sent in time
+        return (deadline - time.time_ns()) / 1e9 - config.OFFER_MIN_LEAD_MS / 1000
+
+    def confirm_price(self, price_confirm_request: codec.ConfirmRequest):
+        # confirm with the leg probabilities of the quote we offered for this parlay, reprice from
+        # the payload if we no longer hold it, and reject what we can not price at all
+        started = time.perf_counter_ns()
+        answer = self._confirm_body(price_confirm_request)
+        body = codec.dumps(answer)
+        serialized = time.perf_counter_ns()
+        CONFIRM_PRICE.record(serialized - started)
+        # the reservation an accept took in _confirm_body goes when the confirm does not get through
+        try:
+            status, error = self.transport.post(price_confirm_request.callback_url, data=body).status_code, None
+        except requests.RequestException as e:
+            status, error = None, e
+        CONFIRM_SEND.record(time.perf_counter_ns() - serialized)
+        if status == 200:
+            quote_log.info("price confirmed successfully", parlay_id=price_confirm_request.parlay_id)
         else:
-            print("price did not sent successfully")
-
-    def confirm_price(self, price_confirm_request):
-        # have to be valid for more than 5 seconds
-        confirm_price_result = requests.post(
-            price_confirm_request['callback_url'],
-            data=json.dumps({
-                                "action": "accept",  # "reject"
-                                "confirmed_odds": price_confirm_request['odds'],
-                                #"confirmed_stake": 100.0,  # Optional. If null, no change to the stake
-                                "price_probability": [
-                                    {
-                                        "max_risk": 200.0,
-                                        "lines": [
-                                            {"line_id": "line_1",
-                                             "probability": 0.5
-                                             },
-                                            {"line_id": "line_2",
-                                             "probability": 0.4
-                                             }
-                                        ]
-                                    },
-                                    {
-                                      "max_risk": 3000.0,
-                                      "lines": [
-                                        {
-                                          "line_id": "line_1",
-                                          "probability": 0.4
-                                        },
-                                        {
-                                          "line_id": "line_2",
-                                          "probability": 0.5
-                                        }
-                                      ]
-                                    }
-                               ]
-                            }),
-            headers=self.__get_auth_header()
-        )
-        if confirm_price_result.status_code == 200:
-            print("price confirmed successfully")
+            CONFIRM_SEND_FAILED.inc()
+            if answer['action'] == 'accept':
+                self.exposure_ledger.release(price_confirm_request.parlay_id)
+            quote_log.error("price did not confirm successfully, status %s, error %s", status, error,
+                            parlay_id=price_confirm_request.parlay_id)
+
+    def order_finalized(self, finalized: codec.OrderFinalized):
+        # the parlay contract is locked, or it fell through and its reservation goes
+        if finalized.status is not None and finalized.status.lower() in config.EXPOSURE_RELEASE_STATUSES:
+            self.exposure_ledger.release(finalized.parlay_id)
+            quote_log.info("order %s, exposure released", finalized.status, parlay_id=finalized.parlay_id)
         else:
-            print("price did not confirm successfully")
+            self.exposure_ledger.finalize(finalized.parlay_id)
+            quote_log.info("order finalized, parlay contract is locked", parlay_id=finalized.parlay_id)
+
+    def _price_ask(self, price_quote_request: codec.AskRequest):
+        cache_key = QuoteCache.key(price_quote_request.market_lines)
+        quote = self.quote_cache.get(cache_key)
+        if quote is None:
+            # read before the catalog, _install swaps the catalog first and invalidates after
+            generation = self.quote_cache.generation
+            quote = self.pricing_engine.price(self.catalog, price_quote_request.market_lines)
+            if quote is None:
+                return None
+            self.quote_cache.put(cache_key, quote, generation)
+        self.lifecycle.touch(price_quote_request.market_lines)
+        return quote
+
+    def _offer_tails(self, price_quote_request: codec.AskRequest, quote: Quote):
+        # size the offers to the exposure headroom of the legs: the quote's own offers when they all
+        # fit, smaller max_risk where they do not, None when not even EXPOSURE_MIN_RISK fits
+        headroom = self.exposure_ledger.headroom(self._exposure_keys(x.line_id for x in price_quote_request.market_lines))
+        if headroom >= quote.max_liability:
+            return quote.offer_tails
+        offer_tails = []
+        for offer, offer_tail in zip(quote.offers, quote.offer_tails):
+            max_risk = int(headroom / (american_to_decimal(offer['odds']) - 1))
+            if max_risk >= offer['max_risk']:
+                offer_tails.append(offer_tail)
+            elif max_risk >= config.EXPOSURE_MIN_RISK:
+                offer_tails.append(codec.encode_offer_tail({**offer, 'max_risk': max_risk}))
+        return offer_tails or None
+
+    def _exposure_keys(self, line_ids) -> list:
+        keys = []
+        for line_id in line_ids:
+            record = self.catalog.get(line_id)
+            keys.append(('line', line_id))
+            if record is not None:
+                keys.append(('event', record.event_id))
+                t_id = self.event_tournaments.get(record.event_id)
+                if t_id is not None:
+                    keys.append(('tournament', t_id))
+        return list(dict.fromkeys(keys))
+
+    def _confirm_body(self, price_confirm_request: codec.ConfirmRequest) -> dict:
+        # accepting reserves the parlay's liability in the exposure ledger, a confirm that no longer
+        # fits under the limits is rejected
+        quote = self.recent_quotes.get(price_confirm_request.parlay_id)
+        if quote is None and price_confirm_request.market_lines is not None:
+            quote = self.pricing_engine.price(self.catalog, price_confirm_request.market_lines)
+        if quote is None:
+            return {"action": "reject"}
+        if price_confirm_request.parlay_id in self.exposure_ledger.parlays:
+            # accepted before, the first confirm's reservation stands
+            CONFIRM_DUPLICATE.inc()
+            return {"action": "reject"}
+        line_ids = [x['line_id'] for x in quote.price_probability[0]['lines']]
+        stake = price_confirm_request.stake
+        if stake is None:
+            stake = max(offer['max_risk'] for offer in quote.offers)
+        liability = stake * (american_to_decimal(price_confirm_request.odds) - 1)
+        if not self.exposure_ledger.reserve(price_confirm_request.parlay_id, self._exposure_keys(line_ids), liability):
+            CONFIRM_OVER_LIMIT.inc()
+            return {"action": "reject"}
+        return {
+            "action": "accept",
+            "confirmed_odds": price_confirm_request.odds,
+            #"confirmed_stake": 100.0,  # Optional. If null, no change to the stake
+            "price_probability": quote.price_probability,
+        }
+
+    def _remember_quote(self, parlay_id: str, quote: Quote):
+        with self._quotes_lock:
+            self.recent_quotes[parlay_id] = quote
+            while len(self.recent_quotes) > config.RECENT_QUOTES_SIZE:
+                self.recent_quotes.popitem(last=False)
 
     def get_balance(self):
+        # the balance just read, None when the read failed and self.balance is the last one known
         balance_url = urljoin(self.base_url, config.URL['mm_balance'])
-        response = requests.get(balance_url, headers=self.__get_auth_header())
+        response = self.transport.get(balance_url)
         if response.status_code != 200:
             logging.error("failed to get balance")
-            return
-        self.balance = json.loads(response.content).get('data', {}).get('balance', 0)
+            return None
+        self.balance = codec.loads(response.content).get('data', {}).get('balance', 0)
+        self.exposure_ledger.reconcile(self.balance)
         logging.info(f"still have ${self.balance} left")
+        return self.balance
+
+    def cancel_all_wagers(self) -> dict:
+        # cancel every open wager and check the balance got their stakes back, see src/wagers.py
+        report = WagerCanceller(self).cancel_all()
+        logging.info(f"cancelled open wagers, {report}")
+        return report
 
     def send_supported_lines(self):
-        balance_url = urljoin(self.base_url, config.URL['parlay_supported_lines'])
-        ids_supported = []
-        if len(self.sport_events) > 0:
-            one_event = list(self.sport_events.keys())[0]
-            for market in self.sport_events[one_event]['markets']:
-                if 'selections' in market:
-                    ids_supported.extend([x[0]['line_id'] for x in market['selections']])
-        if len(ids_supported) > 0:
-            response = requests.post(balance_url,
-                                     json={'supported_lines': ids_supported},
-                                     headers=self.__get_auth_header())
-            if response.status_code != 200:
-                logging.error("failed to send supported lines")
-            else:
-                logging.info("sent supported line successfully")
+        # first call advertises every line of the catalog, later calls only send what was added or
+        # removed since the last successful publish. Ids go out in chunks of at most
+        # SUPPORTED_LINES_CHUNK_BYTES, posted in parallel
+        started = time.monotonic()
+        supported_url = urljoin(self.base_url, config.URL['parlay_supported_lines'])
+        chunks = self._supported_lines_chunks()
+        if len(chunks) == 0:
+            return
+
+        def post_chunk(key_and_chunk):
+            key, chunk = key_and_chunk
+            body = codec.dumps({key: chunk})
+            try:
+                response = self.transport.post(supported_url, data=body, headers={'Content-Type': 'application/json'})
+                return key, chunk, len(body), response.status_code == 200
+            except requests.RequestException as e:
+                logging.error(f"failed to send supported lines, error: {e}")
+                return key, chunk, len(body), False
+
+        with ThreadPoolExecutor(max_workers=config.SUPPORTED_LINES_CONCURRENCY) as pool:
+            results = list(pool.map(post_chunk, chunks))
+        self._record_publish(results, started)
+
+    def _supported_lines_chunks(self) -> list:
+        # (body key, line ids) chunks taking the exchange from published_lines to the catalog
+        ids_supported = set(self.catalog.lines)
+        if self.published_lines is None:
+            added, removed = ids_supported, set()
         else:
+            added, removed = ids_supported - self.published_lines, self.published_lines - ids_supported
+        if len(ids_supported) == 0:
             logging.warning("No supported lines found")
-
-    def schedule_in_thread(self):
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
-
-    def __auto_extend_session(self):
-        # need to use new api, for now just create new session to pretend session extended
+        return [('supported_lines', chunk) for chunk in self._chunk_line_ids(sorted(added))] + \
+               [(config.SUPPORTED_LINES_REMOVE_KEY, chunk) for chunk in self._chunk_line_ids(sorted(removed))]
+
+    def _record_publish(self, results: list, started: float):
+        # results are (body key, line ids, body bytes, ok) per posted chunk
+        published = set(self.published_lines or ())
+        stats = {'added': 0, 'removed': 0, 'chunks': len(results), 'failed_chunks': 0, 'bytes': 0}
+        for key, chunk, size, ok in results:
+            stats['bytes'] += size
+            if key == 'supported_lines':
+                stats['added'] += len(chunk)
+            else:
+                stats['removed'] += len(chunk)
+            if not ok:
+                stats['failed_chunks'] += 1
+            elif key == 'supported_lines':
+                published.update(chunk)
+            else:
+                published.difference_update(chunk)
+        stats['seconds'] = time.monotonic() - started
+        self.published_lines = published
+        self.last_publish_stats = stats
+        if stats['failed_chunks'] > 0:
+            logging.error(f"failed to send supported lines, {stats}")
+        else:
+            logging.info(f"sent supported line successfully, {stats}")
+
+    @staticmethod
+    def _chunk_line_ids(line_ids: list) -> list:
+        chunks = []
+        chunk = []
+        size = 0
+        for line_id in line_ids:
+            # quotes and separator around every id
+            if chunk and size + len(line_id) + 3 > config.SUPPORTED_LINES_CHUNK_BYTES:
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+            chunk.append(line_id)
+            size += len(line_id) + 3
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def refresh(self):
+        # periodic job: incremental reseed, then advertise the lines that came and went
+        self.seeding(incremental=True)
+        self.send_supported_lines()
+
+    def _set_session(self, mm_session: dict):
+        # swap in a new access token everywhere it is used: REST calls and pusher channel auth
+        self.mm_session = mm_session
+        self.token_expires_at = token_expiry(mm_session)
+        self.transport.set_access_token(mm_session['access_token'])
+        if self.pusher is not None:
+            self.pusher.auth_endpoint_headers = dict(self.transport.auth_header)
+
+    def extend_session(self):
+        # refresh the access token, falling back to a new login when the refresh token is refused.
+        # The websocket stays up: the socket is registered again under the new token and the
+        # subscriptions only change if the authorized channels did
         refresh_url = urljoin(self.base_url, config.URL['mm_refresh'])
-        response = requests.post(refresh_url, json={'refresh_token': self.mm_session['refresh_token']},
-                                 headers=self.__get_auth_header())
+        response = self.transport.post(refresh_url, json={'refresh_token': self.mm_session['refresh_token']})
         if response.status_code != 200:
             logging.info("Failed to call refresh endpoint")
             self.login()
         else:
-            self.mm_session['access_token'] = response.json()['data']['access_token']
-            if self.pusher is not None:
-                self.pusher.disconnect()
-                self.pusher = None
-            # self.subscribe()    # need to subscribe again, as the old access token will expire soon
+            self._set_session({**self.mm_session, **codec.loads(response.content)['data']})
+        if self.pusher is not None and self.pusher.connection.state == 'connected':
+            self._register_channels(self.pusher.connection.socket_id)
 
     def keep_alive(self):
-        child_thread = threading.Thread(target=self.schedule_in_thread, daemon=False)
-        child_thread.start()
-
-    def __get_auth_header(self) -> dict:
-        return {
-            'Authorization': f'Bearer '
-                             f'{self.mm_session["access_token"]}',
-        }
-
-
-
+        # runs the background jobs until shutdown(): token refresh ahead of expiry, balance
+        # reconciliation, the periodic reseed and supported lines publish (right away after a warm
+        # start, to reconcile the snapshot with the api) and the event eviction sweep
+        self.metrics_writer.start()
+        self.scheduler.start()
+        self.session_manager.start()
+        self.scheduler.every(config.RESEED_INTERVAL, self.refresh, first=0 if self.warm_started else None)
+        self.scheduler.every(config.BALANCE_INTERVAL, self.get_balance)
+        self.scheduler.every(config.EVENT_SWEEP_INTERVAL, self.lifecycle.sweep, name='event_sweep')
+        self.scheduler.wait()
+
+    def shutdown(self):
+        # stop the background jobs and the feed, waiting for running jobs and queued quotes
+        self.scheduler.stop()
+        self.pusher_supervisor.stop()
+        if self.pusher is not None:
+            self.pusher.disconnect(timeout=0)
+        self.dispatcher.stop()
+        self.market_loader.stop()
+        self.offer_sender.stop()
+        self.metrics_writer.stop()
+
+
+def bench(events: list, tournaments: int, latency_ms: float, concurrency: int) -> dict:
+    # seconds for a full seed of the replay stand-in at each catalog size, one request at a time
+    # vs concurrency at a time, every mm_events/mm_markets call taking latency_ms
+    from src import replay
+    config.LOAD_ALL_TOURNAMENTS = True
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for n in events:
+            path = os.path.join(directory, f'seed-{n}.replay.gz')
+            replay.synthesize(path, tournaments=tournaments, events=max(n // tournaments, 1), asks=0)
+            _, responses, _ = replay.read_replay(path)
+            stand_in = replay.StandIn(responses, rest_delay=latency_ms / 1000)
+            stand_in.start()
+            replay.point_at(stand_in)
+            for name, workers in (('serial', 1), ('concurrent', concurrency)):
+                config.SEEDING_CONCURRENCY = workers
+                client = ParlayInteractions()
+                client.login()
+                started = time.perf_counter()
+                client.seeding()
+                results[f'events_{n}_{name}_s'] = round(time.perf_counter() - started, 3)
+                if len(client.sport_events) != tournaments * max(n // tournaments, 1):
+                    raise Exception(f"seeded {len(client.sport_events)} of {n} events")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.parlay_connect', description='market maker client tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='seeding wall-clock against the replay stand-in, serial vs concurrent')
+    p.add_argument('--events', type=int, nargs='+', default=[100, 400, 1600])
+    p.add_argument('--tournaments', type=int, default=10)
+    p.add_argument('--latency-ms', type=float, default=20, help='stand-in time per request')
+    p.add_argument('--concurrency', type=int, default=config.SEEDING_CONCURRENCY)
+    args = parser.parse_args()
+    sys.stdout.write(codec.dumps(bench(args.events, args.tournaments, args.latency_ms, args.concurrency)).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
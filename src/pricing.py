@@ -0,0 +1,131 @@
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+from collections import Counter
+from src import config
+from src import codec
+from src.catalog import LineCatalog
+from src.codec import encode_offer_tail
+from src.metrics import Histogram
+from src.odds import OddsLadder, american_to_decimal, american_to_probability, is_american, probability_to_american
+
+#   python -m src.pricing bench load.replay.gz    asks priced per second on one core, from a replay file
+
+
+class Quote:
+    # priced parlay: offers for price.ask.new (without valid_until, stamped at send time) and the
+    # matching price_probability for price.confirm.new. offer_tails are the offers pre-encoded
+    # once, so a cached quote is sent by splicing in parlay_id and valid_until only. max_liability
+    # is what we pay out if the largest offer is taken in full and wins
+    __slots__ = ('offers', 'price_probability', 'offer_tails', 'max_liability')
+
+    def __init__(self, offers: list, price_probability: list):
+        self.offers = offers
+        self.price_probability = price_probability
+        self.offer_tails = [encode_offer_tail(offer) for offer in offers]
+        self.max_liability = max((offer['max_risk'] * (american_to_decimal(offer['odds']) - 1) for offer in offers),
+                                 default=0)
+
+
+class PricingEngine:
+    # prices a parlay from the seeded odds of its legs:
+    #   leg probability   implied by the seeded american odds
+    #   correlation       legs on the same sport event are not independent, every extra leg on an
+    #                     event scales the combined probability by same_event_correlation
+    #   margin            per tier, on top of the combined probability
+    # the combined probability is spread back over the legs geometrically, so the per leg
+    # probabilities we confirm with multiply up to exactly the offered probability
+    margin_tiers: list = []
+    same_event_correlation: float = 1.0
+
+    def __init__(self, ladder: OddsLadder, margin_tiers: list = None, same_event_correlation: float = None):
+        self.ladder = ladder
+        self.margin_tiers = margin_tiers or config.PRICING_TIERS
+        self.same_event_correlation = same_event_correlation or config.PRICING_SAME_EVENT_CORRELATION
+
+    def price(self, catalog: LineCatalog, market_lines: list):
+        # market_lines are codec.Leg, returns None when a leg is not in the catalog or has no seeded odds
+        legs = [catalog.get(x.line_id) for x in market_lines]
+        if None in legs or not all(is_american(leg.odds) for leg in legs):
+            return None
+        leg_probabilities = [american_to_probability(leg.odds) for leg in legs]
+        independent = math.prod(leg_probabilities)
+        same_event_legs = sum(n - 1 for n in Counter(leg.event_id for leg in legs).values())
+        fair = independent * self.same_event_correlation ** same_event_legs
+
+        # the offer and leg odds of every tier are snapped to the ladder in one batched call
+        tiers = []
+        probabilities = []
+        for tier in self.margin_tiers:
+            combined = min(fair * (1 + tier['margin']), config.PRICING_MAX_PROBABILITY)
+            scale = (combined / independent) ** (1 / len(legs))
+            adjusted = [min(p * scale, config.PRICING_MAX_PROBABILITY) for p in leg_probabilities]
+            tiers.append((tier, adjusted))
+            probabilities.append(combined)
+            probabilities.extend(adjusted)
+        snapped = self.ladder.snap_probability(probabilities, 'down')
+
+        offers = []
+        price_probability = []
+        step = len(legs) + 1
+        for i, (tier, adjusted) in enumerate(tiers):
+            odds = snapped[i * step:(i + 1) * step]
+            offers.append({
+                'odds': odds[0],
+                'max_risk': tier['max_risk'],
+                'estimated_price': [{'line_id': leg.line_id, 'odds': leg_odds} for leg, leg_odds in zip(legs, odds[1:])],
+            })
+            price_probability.append({
+                'max_risk': tier['max_risk'],
+                'lines': [{'line_id': leg.line_id, 'probability': round(p, 6)} for leg, p in zip(legs, adjusted)],
+            })
+        return Quote(offers, price_probability)
+
+
+def bench(path: str = None, loops: int = 1) -> dict:
+    # prices every price.ask.new of a replay file against the catalog of its mm_markets responses,
+    # a synthetic file when there is none. Decoding is not timed, see python -m src.codec bench
+    from src import replay
+    with tempfile.TemporaryDirectory() as directory:
+        if path is None:
+            path = os.path.join(directory, 'pricing.replay.gz')
+            replay.synthesize(path, tournaments=20, events=50, asks=20000)
+        _, responses, events = replay.read_replay(path)
+    catalog = replay.catalog_of(responses)
+    asks = [codec.decode_ask(data) for _, _, event, data in events if event == 'price.ask.new']
+    engine = PricingEngine(OddsLadder())
+    latency = Histogram('price')
+    priced = 0
+    started = time.perf_counter_ns()
+    for _ in range(loops):
+        for ask in asks:
+            one_started = time.perf_counter_ns()
+            if engine.price(catalog, ask.market_lines) is not None:
+                priced += 1
+            latency.record(time.perf_counter_ns() - one_started)
+    elapsed = (time.perf_counter_ns() - started) / 1e9
+    return {
+        'asks': len(asks) * loops,
+        'priced': priced,
+        'lines': len(catalog),
+        'asks_per_s': round(len(asks) * loops / elapsed, 1) if elapsed else 0,
+        'price_us': {q: round(latency.percentile(p) / 1e3, 2) for q, p in (('p50', 50), ('p99', 99))},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.pricing', description='pricing tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='pricing throughput over the asks of a replay file')
+    p.add_argument('path', nargs='?', help='replay file, see python -m src.replay; synthetic when left out')
+    p.add_argument('--loops', type=int, default=1)
+    args = parser.parse_args()
+    sys.stdout.write(codec.dumps(bench(args.path, args.loops)).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class QuoteCache:
+    # LRU + TTL cache of priced quotes keyed by the normalized leg set of an ask, so the same
+    # combination asked again with another stake is not repriced. A reverse line_id index lets a
+    # reseed drop every quote that has a leg whose market changed. Every invalidation starts a new
+    # generation: a quote priced from the catalog before it is not put, it may have a leg the
+    # invalidation was meant to drop
+    generation: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()    # key -> (expires_at, quote)
+        self.keys_by_line = dict()      # line_id -> set of keys with a leg on that line
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.stale_puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(market_lines: list) -> tuple:
+        return tuple(sorted((x.line_id, x.line) for x in market_lines))
+
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, quote, generation: int):
+        # generation is the one read before the catalog the quote was priced from
+        with self.lock:
+            if generation != self.generation:
+                self.stale_puts += 1
+                return
+            if key not in self.entries:
+                for line_id, _ in key:
+                    self.keys_by_line.setdefault(line_id, set()).add(key)
+            self.entries[key] = (time.monotonic() + self.ttl, quote)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate_lines(self, line_ids) -> int:
+        removed = 0
+        with self.lock:
+            self.generation += 1
+            for line_id in line_ids:
+                for key in self.keys_by_line.get(line_id, set()).copy():
+                    self._remove(key)
+                    removed += 1
+            self.invalidations += removed
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.keys_by_line.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'stale_puts': self.stale_puts}
+
+    def _remove(self, key: tuple):
+        del self.entries[key]
+        for line_id, _ in key:
+            keys = self.keys_by_line.get(line_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_line[line_id]
@@ -0,0 +1,523 @@
+import argparse
+import asyncio
+import gzip
+import random
+import sys
+import threading
+import time
+
+from aiohttp import web
+from urllib.parse import urljoin, urlsplit
+from src import config
+from src import codec
+from src import ingest
+from src.catalog import LineCatalog
+from src.log import logging
+from src.metrics import Histogram, registry
+
+# offline replay and load generation for the quote path, no sandbox needed:
+#   python -m src.replay record --out session.replay.gz --duration 600
+#   python -m src.replay synthesize --out load.replay.gz --asks 20000 --rate 2000
+#   python -m src.replay run load.replay.gz --speed max --client threaded
+# A replay file is gzipped json lines: a header, then [offset_ns, 'rest', method, path, query, status,
+# body] REST responses and [offset_ns, 'event', channel, event, data] websocket events. `run` serves
+# the REST responses and pushes the events from a local HTTP + pusher stand-in, with every callback_url
+# pointed back at the stand-in, and reports how fast and how well the client answered
+
+FORMAT = 'parlay-replay'
+VERSION = 1
+# never written to a recording, they carry credentials
+UNRECORDED = (config.URL['mm_login'], config.URL['mm_refresh'])
+
+
+class ReplayWriter:
+    def __init__(self, path: str, synthetic: bool = False):
+        self.fp = gzip.open(path, 'wb')
+        self.lock = threading.Lock()
+        self.started = time.perf_counter_ns()
+        self._write({'format': FORMAT, 'version': VERSION, 'recorded_at': time.time(), 'synthetic': synthetic})
+
+    def rest(self, method: str, path: str, query: dict, status: int, body: bytes, offset_ns: int = None):
+        self._write([self._offset(offset_ns), 'rest', method, path, _query_key(query), status,
+                     body.decode('utf-8', 'replace')])
+
+    def event(self, channel: str, event: str, data, offset_ns: int = None):
+        if not isinstance(data, str):
+            data = codec.dumps(data).decode()
+        self._write([self._offset(offset_ns), 'event', channel, event, data])
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+    def _offset(self, offset_ns: int) -> int:
+        return time.perf_counter_ns() - self.started if offset_ns is None else offset_ns
+
+    def _write(self, record):
+        line = codec.dumps(record) + b'\n'
+        with self.lock:
+            self.fp.write(line)
+
+
+def read_replay(path: str):
+    # returns (header, {(method, path, query): (status, body)}, [(offset_ns, channel, event, data)])
+    responses = dict()
+    events = []
+    with gzip.open(path, 'rb') as fp:
+        header = codec.loads(fp.readline())
+        if header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise Exception(f"{path} is not a version {VERSION} replay file")
+        for line in fp:
+            record = codec.loads(line)
+            if record[1] == 'rest':
+                _, _, method, path_, query, status, body = record
+                responses[(method, path_, tuple(tuple(x) for x in query))] = (status, body)
+            else:
+                _, _, channel, event, data = record
+                events.append((record[0], channel, event, data))
+    events.sort(key=lambda x: x[0])
+    return header, responses, events
+
+
+def catalog_of(responses: dict):
+    # the LineCatalog a client would seed from the mm_markets responses of a replay file
+    records = dict()
+    for (method, path, query), (status, body) in responses.items():
+        if path.endswith(config.URL['mm_markets']) and status == 200:
+            event_id = int(dict(query)['event_id'])
+            records[event_id] = ingest.market_records(body.encode(), event_id) or []
+    return LineCatalog.build(records, records)
+
+
+def _query_key(query) -> list:
+    return sorted([str(k), str(v)] for k, v in (query or dict()).items())
+
+
+class Recorder:
+    # taps a live threaded ParlayInteractions: GET responses and the channel list from
+    # parlay_websocket_auth as they come back from the transport, and every websocket event
+    # as pysher receives it
+    def __init__(self, client, writer: ReplayWriter):
+        self.client = client
+        self.writer = writer
+
+    def attach(self):
+        request = self.client.transport.request
+        connect_pusher = self.client._connect_pusher
+        auth_path = urlsplit(urljoin(self.client.base_url, config.URL['parlay_websocket_auth'])).path
+
+        def recording_request(method, url, **kwargs):
+            response = request(method, url, **kwargs)
+            path = urlsplit(url).path
+            if method == 'GET' or path == auth_path:
+                if not path.endswith(UNRECORDED):
+                    self.writer.rest(method, path, kwargs.get('params'), response.status_code, response.content)
+            return response
+
+        def recording_connect_pusher():
+            connect_pusher()
+            connection = self.client.pusher.connection
+            handler = connection.event_handler
+
+            def recording_handler(event_name, data, channel_name):
+                self.writer.event(channel_name, event_name, data)
+                handler(event_name, data, channel_name)
+
+            connection.event_handler = recording_handler
+
+        self.client.transport.request = recording_request
+        self.client._connect_pusher = recording_connect_pusher
+
+
+class StandIn:
+    # local HTTP + pusher server answering from a replay file. REST requests get the recorded
+    # response (login, refresh, channel auth and posts are answered synthetically), callbacks
+    # under /replay/{kind}/{seq} are timed against the moment event seq was pushed and answered
+    # callback_delay seconds later, as a remote exchange would. Recorded responses take rest_delay
+    # seconds, the round trip to the real api
+    def __init__(self, responses: dict, callback_delay: float = 0, rest_delay: float = 0):
+        self.responses = responses
+        self.callback_delay = callback_delay
+        self.rest_delay = rest_delay
+        self.loop = asyncio.new_event_loop()
+        self.clients = dict()       # websocket -> set of subscribed channel names
+        self.outbox = None
+        self.sent_ns = dict()       # seq -> perf_counter_ns the event went out
+        self.callbacks = dict()     # seq -> (perf_counter_ns the callback arrived, body)
+        self.bad_requests = 0
+        self.sockets = 0
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/'
+
+    @property
+    def pusher_url(self) -> str:
+        return f'ws://127.0.0.1:{self.port}/app/{{key}}?protocol=7&client=python-parlay&version=1.0'
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, name='replay-stand-in', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    def push(self, seq: int, channel: str, event: str, data: str):
+        self.loop.call_soon_threadsafe(self.outbox.put_nowait, (seq, channel, event, data))
+
+    def subscribed(self) -> set:
+        channels = set()
+        for subscribed in list(self.clients.values()):
+            channels |= subscribed
+        return channels
+
+    async def _start(self):
+        self.outbox = asyncio.Queue()
+        app = web.Application()
+        app.router.add_get('/app/{key}', self._websocket)
+        app.router.add_post('/replay/{kind}/{seq}', self._callback)
+        app.router.add_route('*', '/{tail:.*}', self._rest)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        asyncio.ensure_future(self._send_loop())
+
+    async def _send_loop(self):
+        # one sender keeps the events in order on every socket
+        while True:
+            seq, channel, event, data = await self.outbox.get()
+            message = codec.dumps({'event': event, 'channel': channel, 'data': data}).decode()
+            self.sent_ns[seq] = time.perf_counter_ns()
+            for ws, channels in list(self.clients.items()):
+                if channel in channels and not ws.closed:
+                    await ws.send_str(message)
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets += 1
+        self.clients[ws] = set()
+        socket_id = f'{self.sockets}.{random.randint(1, 1 << 30)}'
+        await ws.send_str(codec.dumps({'event': 'pusher:connection_established',
+                                       'data': codec.dumps({'socket_id': socket_id, 'activity_timeout': 120}).decode()}).decode())
+        async for msg in ws:
+            if msg.type != web.WSMsgType.TEXT:
+                break
+            message = codec.loads(msg.data)
+            event = message.get('event')
+            if event == 'pusher:subscribe':
+                channel = message['data']['channel']
+                self.clients[ws].add(channel)
+                await ws.send_str(codec.dumps({'event': 'pusher_internal:subscription_succeeded',
+                                               'channel': channel, 'data': '{}'}).decode())
+            elif event == 'pusher:unsubscribe':
+                self.clients[ws].discard(message['data']['channel'])
+            elif event == 'pusher:ping':
+                await ws.send_str('{"event":"pusher:pong","data":"{}"}')
+        self.clients.pop(ws, None)
+        return ws
+
+    async def _callback(self, request):
+        body = await request.read()
+        seq = int(request.match_info['seq'])
+        try:
+            codec.loads(body)
+        except ValueError:
+            self.bad_requests += 1
+            return web.json_response({'error': 'invalid json'}, status=400)
+        self.callbacks[seq] = (time.perf_counter_ns(), body)
+        if self.callback_delay:
+            await asyncio.sleep(self.callback_delay)
+        return web.json_response({'data': {}})
+
+    async def _rest(self, request):
+        path = request.path
+        if path.endswith(config.URL['mm_login']) or path.endswith(config.URL['mm_refresh']):
+            return web.json_response({'data': {'access_token': 'replay', 'refresh_token': 'replay',
+                                               'expires_in': 24 * 3600}})
+        if path.endswith(config.URL['parlay_websocket_auth']):
+            form = await request.post()
+            if 'channel_name' in form:
+                return web.json_response({'auth': f'replay:{form["socket_id"]}'})
+        if path.endswith(config.URL['parlay_connection_config']) and ('GET', path, ()) not in self.responses:
+            return web.json_response({'key': 'replay', 'cluster': 'replay'})
+        key = (request.method, path, tuple((k, v) for k, v in sorted(request.query.items())))
+        if key in self.responses:
+            status, body = self.responses[key]
+            if self.rest_delay:
+                await asyncio.sleep(self.rest_delay)
+            return web.Response(status=status, body=body, content_type='application/json')
+        if request.method == 'POST':
+            return web.json_response({'data': {}})
+        return web.json_response({'error': 'not recorded'}, status=404)
+
+
+def synthesize(path: str, tournaments: int = 4, events: int = 50, asks: int = 10000, rate: float = 1000,
+               legs: int = 4, confirm_ratio: float = 0.1, seed: int = 1, balance: float = 1000000):
+    # a replay file with a made up catalog (moneyline, spread and total per event) and `asks` parlays
+    # of `legs` legs on distinct events, arriving at `rate` per second
+    rng = random.Random(seed)
+    writer = ReplayWriter(path, synthetic=True)
+    register_path = '/' + config.URL['parlay_websocket_auth']
+    writer.rest('POST', register_path, None, 200, codec.dumps({'data': {'authorized_channel': [
+        {'channel_name': 'broadcast-replay', 'binding_events': ['price.ask.new']},
+        {'channel_name': 'private-replay', 'binding_events': ['price.confirm.new', 'order.finalized']},
+    ]}}), 0)
+    writer.rest('GET', '/' + config.URL['mm_balance'], None, 200, codec.dumps({'data': {'balance': balance}}), 0)
+    writer.rest('GET', '/' + config.URL['mm_tournaments'], None, 200, codec.dumps({'data': {'tournaments': [
+        {'id': t, 'name': f'Replay {t}'} for t in range(1, tournaments + 1)]}}), 0)
+    lines = []
+    scheduled = int((time.time() + 30 * 24 * 3600) * 1e9)
+    for t in range(1, tournaments + 1):
+        sport_events = [{'event_id': t * 100000 + e, 'name': f'Replay {t}.{e}', 'tournament_id': t,
+                         'scheduled': scheduled} for e in range(events)]
+        writer.rest('GET', '/' + config.URL['mm_events'], {'tournament_id': t}, 200,
+                    codec.dumps({'data': {'sport_events': sport_events}}), 0)
+        for event in sport_events:
+            markets = _synthetic_markets(event['event_id'], rng)
+            writer.rest('GET', '/' + config.URL['mm_markets'], {'event_id': event['event_id']}, 200,
+                        codec.dumps({'data': {'markets': markets}}), 0)
+            for market in markets:
+                for market_line in market.get('market_lines', [{'selections': market.get('selections')}]):
+                    for selection in market_line['selections']:
+                        lines.append((event['event_id'], market['id'], selection[0]))
+    by_event = dict()
+    for event_id, market_id, selection in lines:
+        by_event.setdefault(event_id, []).append((market_id, selection))
+    event_ids = list(by_event)
+    for i in range(asks):
+        offset_ns = int(i / rate * 1e9)
+        market_lines = []
+        for event_id in rng.sample(event_ids, min(legs, len(event_ids))):
+            market_id, selection = rng.choice(by_event[event_id])
+            market_lines.append({'line_id': selection['line_id'], 'line': selection['line'], 'market_id': market_id,
+                                 'outcome_id': selection['outcome_id'], 'sport_event_id': event_id})
+        parlay_id = f'replay-{i}'
+        writer.event('broadcast-replay', 'price.ask.new', codec.dumps({'payload': {
+            'parlay_id': parlay_id, 'callback_url': 'http://replay/offers', 'created_at': 0,
+            'stake': round(rng.uniform(1, 200), 2), 'market_lines': market_lines}}).decode(), offset_ns)
+        if rng.random() < confirm_ratio:
+            writer.event('private-replay', 'price.confirm.new', codec.dumps({'payload': {
+                'parlay_id': parlay_id, 'callback_url': 'http://replay/confirm', 'created_at': 0,
+                'odds': 500, 'stake': 10, 'market_lines': market_lines}}).decode(), offset_ns + int(0.5e9))
+    writer.close()
+
+
+def _synthetic_markets(event_id: int, rng: random.Random) -> list:
+    def selection(name: str, line: float, outcome_id: int):
+        return [{'line_id': f'{event_id}-{name}', 'line': line, 'outcome_id': outcome_id,
+                 'odds': rng.choice([-1, 1]) * rng.randint(100, 300)}]
+
+    return [
+        {'id': 251, 'name': 'Moneyline', 'type': 'moneyline',
+         'selections': [selection('home', 0, 1), selection('away', 0, 2)]},
+        {'id': 256, 'name': 'Spread', 'type': 'spread', 'market_lines': [
+            {'line': 1.5, 'selections': [selection('spread-home', -1.5, 3), selection('spread-away', 1.5, 4)]}]},
+        {'id': 258, 'name': 'Total', 'type': 'total', 'market_lines': [
+            {'line': 210.5, 'selections': [selection('over', 210.5, 5), selection('under', 210.5, 6)]}]},
+    ]
+
+
+def point_at(stand_in: StandIn, metrics_file: str = ''):
+    # aim the clients at the stand-in, and keep them off the snapshot of the real catalog: a
+    # synthetic seed must not be warm started from, nor written over it. Metrics of a bench or
+    # replay only go to `metrics_file`, never to the live metrics.prom in the working directory
+    config.BASE_URL = stand_in.base_url
+    config.PUSHER_URL = stand_in.pusher_url
+    config.SNAPSHOT_FILE = ''
+    config.METRICS_FILE = metrics_file
+
+
+def start_client(kind: str):
+    # login, seed, subscribe and publish lines with the client main.py would run for `kind`,
+    # returns the client and, for the asyncio one, the event loop it runs on
+    if kind == 'asyncio':
+        from src.async_parlay_connect import AsyncParlayInteractions
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name='replay-client', daemon=True).start()
+        client = AsyncParlayInteractions()
+
+        async def setup():
+            await client.login()
+            await client.get_balance()
+            await client.seeding()
+            await client.subscribe()
+            await client.send_supported_lines()
+
+        asyncio.run_coroutine_threadsafe(setup(), loop).result()
+        return client, loop
+    if kind == 'sharded':
+        from src.supervisor import QuoteSupervisor
+        client = QuoteSupervisor()
+    else:
+        from src.parlay_connect import ParlayInteractions
+        client = ParlayInteractions()
+    client.login()
+    client.get_balance()
+    client.seeding()
+    client.subscribe()
+    client.send_supported_lines()
+    return client, None
+
+
+def stop_client(client, loop):
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(client.close(), loop).result()
+        return
+    client.shutdown()
+
+
+def run(path: str, speed: float = 1.0, client_kind: str = 'threaded', loops: int = 1,
+        drain_timeout: float = 10, callback_ms: float = 0, metrics_file: str = '') -> dict:
+    # replays `path` `loops` times at `speed` (0 is as fast as possible) and returns the report
+    header, responses, events = read_replay(path)
+    stand_in = StandIn(responses, callback_ms / 1000)
+    stand_in.start()
+    point_at(stand_in, metrics_file)
+    if header.get('synthetic'):
+        config.LOAD_ALL_TOURNAMENTS = True
+    client, client_loop = start_client(client_kind)
+    try:
+        return _replay(stand_in, events, speed, client_kind, loops, drain_timeout)
+    finally:
+        stop_client(client, client_loop)
+
+
+def _replay(stand_in: StandIn, events: list, speed: float, client_kind: str, loops: int, drain_timeout: float) -> dict:
+    channels = {channel for _, channel, _, _ in events}
+    deadline = time.monotonic() + drain_timeout
+    while not channels <= stand_in.subscribed():
+        if time.monotonic() > deadline:
+            raise Exception(f"client did not subscribe to {channels - stand_in.subscribed()}")
+        time.sleep(0.05)
+
+    kinds = dict()      # seq -> 'ask' or 'confirm'
+    seq = 0
+    started = time.perf_counter_ns()
+    for loop in range(loops):
+        loop_started = time.perf_counter_ns()
+        for offset_ns, channel, event, data in events:
+            if speed > 0:
+                delay = loop_started + offset_ns / speed - time.perf_counter_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+            if event in ('price.ask.new', 'price.confirm.new'):
+                kind = 'ask' if event == 'price.ask.new' else 'confirm'
+                data = _rewrite(data, stand_in.base_url, kind, seq, loop)
+                kinds[seq] = kind
+            stand_in.push(seq, channel, event, data)
+            seq += 1
+    pushed = time.perf_counter_ns()
+
+    deadline = time.monotonic() + drain_timeout
+    while len(stand_in.callbacks) < len(kinds) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return _report(stand_in, kinds, client_kind, speed, started, pushed)
+
+
+def _rewrite(data: str, base_url: str, kind: str, seq: int, loop: int) -> str:
+    # fresh created_at, callback_url on the stand-in, and per loop parlay ids so they are not deduplicated
+    payload = codec.event_payload(data)
+    payload['created_at'] = time.time_ns()
+    payload['callback_url'] = f'{base_url}replay/{kind}/{seq}'
+    if loop > 0 and payload.get('parlay_id'):
+        payload['parlay_id'] = f'{payload["parlay_id"]}-{loop}'
+    return codec.dumps({'payload': payload}).decode()
+
+
+def _report(stand_in: StandIn, kinds: dict, client_kind: str, speed: float, started: int, pushed: int) -> dict:
+    latency = {'ask': Histogram('ask'), 'confirm': Histogram('confirm')}
+    answered = {'ask': 0, 'confirm': 0}
+    rejected = 0
+    finished = pushed
+    for seq, (arrived, body) in list(stand_in.callbacks.items()):
+        kind = kinds.get(seq)
+        if kind is None:
+            continue
+        answered[kind] += 1
+        latency[kind].record(arrived - stand_in.sent_ns[seq])
+        finished = max(finished, arrived)
+        if kind == 'confirm' and codec.loads(body).get('action') == 'reject':
+            rejected += 1
+    sent = {'ask': 0, 'confirm': 0}
+    for kind in kinds.values():
+        sent[kind] += 1
+    elapsed = (finished - started) / 1e9
+    counters = registry.snapshot()['counters']
+    return {
+        'client': client_kind,
+        'speed': speed or 'max',
+        'elapsed_s': round(elapsed, 3),
+        'asks': sent['ask'],
+        'confirms': sent['confirm'],
+        'throughput_per_s': round((answered['ask'] + answered['confirm']) / elapsed, 1) if elapsed else 0,
+        'ask_latency_ms': {q: round(latency['ask'].percentile(p) / 1e6, 3) for q, p in (('p50', 50), ('p99', 99))},
+        'confirm_latency_ms': {q: round(latency['confirm'].percentile(p) / 1e6, 3) for q, p in (('p50', 50), ('p99', 99))},
+        'errors': {
+            'unanswered_asks': sent['ask'] - answered['ask'],
+            'unanswered_confirms': sent['confirm'] - answered['confirm'],
+            'rejected_confirms': rejected,
+            'bad_requests': stand_in.bad_requests,
+            **{name: value for name, value in counters.items() if value and not name.startswith('websocket_')},
+        },
+    }
+
+
+def record(path: str, duration: float):
+    # records a live session of the threaded client against config.BASE_URL
+    from src.parlay_connect import ParlayInteractions
+    client = ParlayInteractions()
+    writer = ReplayWriter(path)
+    Recorder(client, writer).attach()
+    client.login()
+    client.get_balance()
+    client.seeding()
+    client.subscribe()
+    client.send_supported_lines()
+    logging.info(f"recording to {path} for {duration}s")
+    time.sleep(duration)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.replay', description='replay and load test the quote path')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('record', help='record a live session')
+    p.add_argument('--out', required=True)
+    p.add_argument('--duration', type=float, default=600, help='seconds')
+    p = commands.add_parser('synthesize', help='write a synthetic load file')
+    p.add_argument('--out', required=True)
+    p.add_argument('--tournaments', type=int, default=4)
+    p.add_argument('--events', type=int, default=50, help='per tournament')
+    p.add_argument('--asks', type=int, default=10000)
+    p.add_argument('--rate', type=float, default=1000, help='asks per second at 1x')
+    p.add_argument('--legs', type=int, default=4)
+    p.add_argument('--confirm-ratio', type=float, default=0.1)
+    p.add_argument('--seed', type=int, default=1)
+    p = commands.add_parser('run', help='replay a file against the local stand-in and report')
+    p.add_argument('path')
+    p.add_argument('--speed', default='1', help="1 for real time, N for N times faster, 'max' for no pacing")
+    p.add_argument('--client', default='threaded', choices=['threaded', 'asyncio', 'sharded'])
+    p.add_argument('--loops', type=int, default=1)
+    p.add_argument('--drain-timeout', type=float, default=10, help='seconds to wait for the last answers')
+    p.add_argument('--callback-ms', type=float, default=0, help='how long the stand-in takes to answer a callback')
+    p.add_argument('--log-level', default=None, help='e.g. WARNING to compare the quote path without logging')
+    p.add_argument('--metrics-file', default='', help='write the client metrics here, off by default')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.out, args.duration)
+    elif args.command == 'synthesize':
+        synthesize(args.out, args.tournaments, args.events, args.asks, args.rate, args.legs,
+                   args.confirm_ratio, args.seed)
+    else:
+        if args.log_level:
+            logging.getLogger().setLevel(args.log_level)
+        speed = 0 if args.speed == 'max' else float(args.speed)
+        report = run(args.path, speed, args.client, args.loops, args.drain_timeout, args.callback_ms,
+                     args.metrics_file)
+        sys.stdout.write(codec.dumps(report).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from src import config
+from src.log import logging
+from src.metrics import registry
+
+# background jobs of the threaded client (token refresh, balance reconciliation, reseed and
+# supported lines publish). One thread sleeps on a heap of due times until the earliest job is
+# due or a new one comes in, and hands due jobs to a pool of SCHEDULER_WORKERS threads. A job
+# never overlaps itself, so a slow reseed holds one worker while the others stay free for the
+# token refresh
+
+LAG = registry.histogram('scheduler_lag_ns')    # due time to the job starting on a worker
+
+
+class Job:
+    __slots__ = ('name', 'fn', 'due', 'interval', 'cancelled')
+
+    def __init__(self, name: str, fn, due: float, interval: float):
+        self.name = name
+        self.fn = fn
+        self.due = due      # time.monotonic()
+        self.interval = interval    # None for one-shot jobs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self, workers: int = None, name: str = 'scheduler'):
+        self.name = name
+        self.workers = workers or config.SCHEDULER_WORKERS
+        self.heap = []      # (due, sequence, job)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.pool = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'{self.name}-job')
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, wait: bool = True):
+        # jobs not started yet are dropped, running ones are waited for when wait
+        with self.condition:
+            self.stopped.set()
+            self.heap = []
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait, cancel_futures=True)
+            self.pool = None
+
+    def wait(self):
+        # blocks until stop()
+        self.stopped.wait()
+
+    def call_later(self, delay: float, fn, name: str = None) -> Job:
+        return self._add(Job(name or fn.__name__, fn, time.monotonic() + delay, None))
+
+    def call_at(self, when: float, fn, name: str = None) -> Job:
+        # when is in epoch seconds, like a token expiry or an event start time
+        return self.call_later(max(when - time.time(), 0), fn, name)
+
+    def every(self, interval: float, fn, name: str = None, first: float = None) -> Job:
+        # every `interval` seconds, the first run `first` seconds from now (default one interval)
+        delay = interval if first is None else first
+        return self._add(Job(name or fn.__name__, fn, time.monotonic() + delay, interval))
+
+    def _add(self, job: Job) -> Job:
+        with self.condition:
+            if not self.stopped.is_set():
+                heapq.heappush(self.heap, (job.due, next(self.sequence), job))
+                self.condition.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopped.is_set():
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.condition.wait(self.heap[0][0] - now if self.heap else None)
+                if self.stopped.is_set():
+                    return
+                _, _, job = heapq.heappop(self.heap)
+            if not job.cancelled:
+                self.pool.submit(self._execute, job)
+
+    def _execute(self, job: Job):
+        started = time.monotonic()
+        LAG.record(int((started - job.due) * 1e9))
+        try:
+            job.fn()
+        except Exception as e:
+            logging.exception(f"scheduled job {job.name} failed, error: {e}")
+        if job.interval is None or job.cancelled:
+            return
+        # one interval after the run that was due, skipping the ones missed while this one ran
+        now = time.monotonic()
+        job.due += job.interval
+        while job.due <= now:
+            job.due += job.interval
+        self._add(job)
@@ -0,0 +1,72 @@
+import base64
+import time
+
+from src import codec
+from src import config
+from src.log import logging
+
+# access token lifecycle: work out when the token expires and refresh it ahead of that in the
+# background, so no request or channel auth ever goes out with an expired token
+
+
+def token_expiry(mm_session: dict) -> float:
+    # epoch seconds the access token expires at: expires_in of the login/refresh response when
+    # present, else the exp claim of the token (a JWT), else SESSION_TOKEN_LIFETIME from now
+    now = time.time()
+    if isinstance(mm_session.get('expires_in'), (int, float)):
+        return now + mm_session['expires_in']
+    try:
+        claims = mm_session['access_token'].split('.')[1]
+        exp = codec.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4))).get('exp')
+        if isinstance(exp, (int, float)):
+            return float(exp)
+    except (KeyError, IndexError, AttributeError, ValueError):
+        pass
+    return now + config.SESSION_TOKEN_LIFETIME
+
+
+def refresh_delay(expires_at: float) -> float:
+    # seconds to wait before refreshing a token expiring at expires_at
+    return max(expires_at - config.SESSION_REFRESH_MARGIN - time.time(), 0)
+
+
+class SessionManager:
+    # refreshes the session of a ParlayInteractions SESSION_REFRESH_MARGIN seconds before the
+    # access token expires, retrying with backoff on failure, see ParlayInteractions.extend_session.
+    # Each refresh is a one-shot job on the client's scheduler that books the next one
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.scheduler = scheduler
+        self.job = None
+        self.stopped = False
+        self.retry = config.SESSION_RETRY_MIN
+
+    def start(self):
+        if self.job is not None:
+            return
+        self.stopped = False
+        self._schedule(refresh_delay(self.client.token_expires_at))
+
+    def stop(self):
+        self.stopped = True
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+    def _schedule(self, delay: float):
+        if not self.stopped:
+            self.job = self.scheduler.call_later(delay, self._refresh, name='session-refresh')
+
+    def _refresh(self):
+        try:
+            self.client.extend_session()
+        except Exception as e:
+            logging.error(f"failed to extend session, retrying in {self.retry}s, error: {e}")
+            self._schedule(self.retry)
+            self.retry = min(self.retry * 2, config.SESSION_RETRY_MAX)
+            return
+        self.retry = config.SESSION_RETRY_MIN
+        # never spin, even when the server hands out tokens shorter lived than the margin
+        delay = max(refresh_delay(self.client.token_expires_at), config.SESSION_RETRY_MIN)
+        logging.info(f"session extended, next refresh in {int(delay)}s")
+        self._schedule(delay)
@@ -0,0 +1,236 @@
+import argparse
+import gc
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+from array import array
+from src import config
+from src import codec
+from src.catalog import LineCatalog, LineRecord
+from src.log import logging
+
+# on-disk copy of the seeded state (tournaments, sport events, line index) so a
+# restart can quote from it right away and reconcile with the API in the background. Two formats,
+# picked by file name:
+#   *.json      one json document, the line index as a list of rows
+#   otherwise   binary: MAGIC, u32 header length, json header, then 8 byte aligned sections: the
+#               events as json and the line index as columns (int64 ids, float64 line and odds,
+#               NaN for missing, uint32 offsets into a utf8 blob of line ids), read through mmap.
+#               Whole floats come back as ints, as the api sends american odds
+# The header names the api and tournament selection the snapshot was seeded with, a snapshot of
+# another api or selection is ignored on load
+#
+#   python -m src.snapshot bench --events 2000    cold crawl vs json vs binary startup time
+
+MAGIC = b'PCSNAP1\0'
+VERSION = 2
+NONE_ID = -(1 << 63)    # missing market or outcome id in the int64 columns
+ID_COLUMNS = ('event_id', 'market_id', 'outcome_id')
+FLOAT_COLUMNS = ('line', 'odds')
+
+
+def source() -> dict:
+    # what the seeded state depends on besides the api's data
+    return {
+        'base_url': config.BASE_URL,
+        'tournaments': sorted(config.TOURNAMENTS_INTERESTED),
+        'load_all_tournaments': config.LOAD_ALL_TOURNAMENTS,
+    }
+
+
+def save(client, path: str):
+    # written next to path and renamed over it, a crash never leaves half a snapshot behind
+    started = time.monotonic()
+    state = {
+        'version': VERSION,
+        'created_at': time.time(),
+        'source': source(),
+        'all_tournaments': client.all_tournaments,
+        'my_tournaments': list(client.my_tournaments.values()),
+        'tournament_events': [[t_id, list(event_ids)] for t_id, event_ids in client.tournament_events.items()],
+        'sport_events': list(client.sport_events.values()),
+    }
+    records = list(client.catalog.lines.values())
+    tmp_path = f'{path}.tmp'
+    if path.endswith('.json'):
+        state['lines'] = [[x.line_id, x.event_id, x.market_id, x.outcome_id, x.line, x.odds] for x in records]
+        with open(tmp_path, 'wb') as fp:
+            fp.write(codec.dumps(state))
+    else:
+        _write_binary(tmp_path, state, records)
+    os.replace(tmp_path, path)
+    logging.info(f"catalog snapshot of {len(records)} lines written to {path} in {time.monotonic() - started:.3f}s")
+
+
+def load(path: str, max_age: float = None, expected_source: dict = None):
+    # returns (state, catalog), or None when there is no usable snapshot at path. With
+    # expected_source, a snapshot taken with another source() is not usable either
+    if not os.path.exists(path):
+        return None
+    # the loads allocate a few hundred thousand objects and none of them are garbage, collections
+    # triggered along the way would only walk the growing state over and over
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        if path.endswith('.json'):
+            with open(path, 'rb') as fp:
+                state = codec.loads(fp.read())
+            catalog = LineCatalog.from_records(LineRecord(*row) for row in state.pop('lines'))
+        else:
+            state, catalog = _read_binary(path)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logging.error(f"ignoring unreadable catalog snapshot {path}, error: {e}")
+        return None
+    finally:
+        if collecting:
+            gc.enable()
+    if state.get('version') != VERSION:
+        logging.info(f"ignoring catalog snapshot {path} of version {state.get('version')}")
+        return None
+    age = time.time() - state['created_at']
+    if max_age is not None and age > max_age:
+        logging.info(f"ignoring catalog snapshot {path}, it is {age:.0f}s old")
+        return None
+    if expected_source is not None and state.get('source') != expected_source:
+        logging.info(f"ignoring catalog snapshot {path}, it was taken from {state.get('source')}, "
+                     f"not {expected_source}")
+        return None
+    return state, catalog
+
+
+def apply(client, state: dict, catalog: LineCatalog):
+    # install a loaded snapshot as the client's seeded state
+    client.all_tournaments = state['all_tournaments']
+    client.my_tournaments = {t['id']: t for t in state['my_tournaments']}
+    tournament_events = {t_id: set(event_ids) for t_id, event_ids in state['tournament_events']}
+    client.event_tournaments = {event_id: t_id for t_id, event_ids in tournament_events.items()
+                                for event_id in event_ids}
+    client.catalog, client.sport_events, client.tournament_events = \
+        catalog, {event['event_id']: event for event in state['sport_events']}, tournament_events
+
+
+def _write_binary(path: str, state: dict, records: list):
+    sections = [('events', codec.dumps(state))]
+    for name in ID_COLUMNS:
+        sections.append((name, array('q', (NONE_ID if getattr(x, name) is None else getattr(x, name)
+                                           for x in records)).tobytes()))
+    for name in FLOAT_COLUMNS:
+        sections.append((name, array('d', (math.nan if getattr(x, name) is None else getattr(x, name)
+                                           for x in records)).tobytes()))
+    line_ids = [x.line_id.encode() for x in records]
+    offsets = array('I', [0])
+    for line_id in line_ids:
+        offsets.append(offsets[-1] + len(line_id))
+    sections.append(('line_id_offsets', offsets.tobytes()))
+    sections.append(('line_ids', b''.join(line_ids)))
+
+    # offsets in the header are relative to the end of the header, which is padded to 8 bytes
+    layout = dict()
+    position = 0
+    for name, data in sections:
+        layout[name] = [position, len(data)]
+        position += _padded(len(data))
+    header = codec.dumps({'version': VERSION, 'lines': len(records), 'sections': layout})
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC + struct.pack('<I', len(header)) + header)
+        fp.write(b'\0' * (_padded(len(MAGIC) + 4 + len(header)) - len(MAGIC) - 4 - len(header)))
+        for _, data in sections:
+            fp.write(data)
+            fp.write(b'\0' * (_padded(len(data)) - len(data)))
+
+
+def _read_binary(path: str):
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            if bytes(view[:len(MAGIC)]) != MAGIC:
+                raise ValueError("not a catalog snapshot")
+            header_length = struct.unpack_from('<I', mapped, len(MAGIC))[0]
+            header_end = len(MAGIC) + 4 + header_length
+            header = codec.loads(bytes(view[len(MAGIC) + 4:header_end]))
+            base = _padded(header_end)
+            n = header['lines']
+
+            def section(name: str):
+                offset, length = header['sections'][name]
+                return view[base + offset:base + offset + length]
+
+            state = codec.loads(bytes(section('events')))
+            columns = dict()
+            for name in ID_COLUMNS:
+                column = section(name).cast('q')
+                columns[name] = [None if x == NONE_ID else x for x in column.tolist()]
+                column.release()
+            for name in FLOAT_COLUMNS:
+                column = section(name).cast('d')
+                columns[name] = [None if x != x else int(x) if x.is_integer() else x for x in column.tolist()]
+                column.release()
+            column = section('line_id_offsets').cast('I')
+            offsets = column.tolist()
+            column.release()
+            blob = bytes(section('line_ids')).decode()
+            if len(blob) != offsets[-1]:
+                # non ascii line ids, offsets are in bytes
+                blob = blob.encode()
+                line_ids = [blob[offsets[i]:offsets[i + 1]].decode() for i in range(n)]
+            else:
+                line_ids = [blob[offsets[i]:offsets[i + 1]] for i in range(n)]
+            catalog = LineCatalog.from_records(map(LineRecord, line_ids, *(columns[name] for name in ID_COLUMNS),
+                                                   *(columns[name] for name in FLOAT_COLUMNS)))
+        finally:
+            view.release()
+    return state, catalog
+
+
+def _padded(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def bench(events: int, tournaments: int, directory: str):
+    # startup time to a quotable catalog: full crawl of the replay stand-in vs loading each snapshot
+    from src import replay
+    from src.parlay_connect import ParlayInteractions
+    path = os.path.join(directory, 'bench.replay.gz')
+    replay.synthesize(path, tournaments=tournaments, events=events // tournaments, asks=0)
+    header, responses, _ = replay.read_replay(path)
+    stand_in = replay.StandIn(responses)
+    stand_in.start()
+    replay.point_at(stand_in)
+    config.LOAD_ALL_TOURNAMENTS = True
+
+    client = ParlayInteractions()
+    client.login()
+    started = time.perf_counter()
+    client.seeding()
+    results = {'cold_crawl_s': time.perf_counter() - started, 'lines': len(client.catalog)}
+    for name in ('json', 'binary'):
+        snapshot_path = os.path.join(directory, f'bench.snapshot{".json" if name == "json" else ""}')
+        save(client, snapshot_path)
+        started = time.perf_counter()
+        state, catalog = load(snapshot_path)
+        apply(ParlayInteractions(), state, catalog)
+        results[f'{name}_load_s'] = time.perf_counter() - started
+        results[f'{name}_bytes'] = os.path.getsize(snapshot_path)
+        if len(catalog) != len(client.catalog):
+            raise Exception(f"{name} snapshot has {len(catalog)} lines, expected {len(client.catalog)}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.snapshot', description='catalog snapshot tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='compare cold crawl, json and binary snapshot startup time')
+    p.add_argument('--events', type=int, default=2000)
+    p.add_argument('--tournaments', type=int, default=20)
+    p.add_argument('--dir', default='.', help='where the bench files are written')
+    args = parser.parse_args()
+    results = bench(args.events, args.tournaments, args.dir)
+    sys.stdout.write(codec.dumps({k: round(v, 4) if isinstance(v, float) else v for k, v in results.items()}).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from multiprocessing import shared_memory
+from src import config
+from src import codec
+from src.async_parlay_connect import AsyncParlayInteractions
+from src.catalog import LineCatalog, LineRecord
+from src.dispatcher import DROPPED_STALE, is_stale
+from src.exposure import ExposureLedger
+from src.log import logging
+from src.metrics import registry
+from src.parlay_connect import ParlayInteractions
+
+# supervisor mode: one process reads the websocket and seeds, N worker processes price and post.
+# Jobs are sharded by parlay_id so an ask and its confirm land on the same worker. The catalog is
+# copied to the workers, not shared: each publish pickles it, along with the event -> tournament
+# map the workers' exposure keys need, into a fresh shared memory segment, and every worker
+# unpickles that into a private LineCatalog. Shared memory only saves pushing the pickle through
+# a pipe per worker, each worker still holds and rebuilds a whole catalog. Events that are over are
+# broadcast to the workers, each settles the parlays it holds. Catalogs, tokens, balances and
+# settles go on an unbounded control queue per worker, next to its bounded job queue, so they
+# never wait behind a backlog of asks nor block the thread sending them
+#   python -m src.supervisor bench --processes 1 2 4    replay load test, threaded vs N processes
+
+
+def publish_catalog(catalog: LineCatalog, event_tournaments: dict) -> shared_memory.SharedMemory:
+    # copy-on-publish: the segment holds a pickle, load_catalog builds the worker's own copy from it
+    records = [(x.line_id, x.event_id, x.market_id, x.outcome_id, x.line, x.odds) for x in catalog.lines.values()]
+    data = pickle.dumps((records, event_tournaments), protocol=pickle.HIGHEST_PROTOCOL)
+    segment = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    segment.buf[:len(data)] = data
+    return segment
+
+
+def load_catalog(name: str, size: int) -> tuple:
+    # (catalog, event_tournaments)
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        records, event_tournaments = pickle.loads(segment.buf[:size])
+    finally:
+        segment.close()
+    return LineCatalog.from_records(LineRecord(*record) for record in records), event_tournaments
+
+
+class ProcessDispatcher:
+    # drop-in for QuoteDispatcher in the supervisor process: submit() ships the job to the worker
+    # process owning the parlay instead of a local thread. The handler is sent by name and run
+    # on the worker's own AsyncParlayInteractions
+    def __init__(self, client: 'QuoteSupervisor', processes: int = None):
+        self.client = client
+        self.processes = processes or config.QUOTE_PROCESSES or os.cpu_count()
+        self.context = multiprocessing.get_context('spawn')
+        self.jobs = [self.context.Queue(maxsize=config.QUOTE_QUEUE_SIZE) for _ in range(self.processes)]
+        self.controls = [self.context.Queue() for _ in range(self.processes)]
+        self.results = self.context.Queue()
+        self.workers = []
+        self.segments = []
+        self.segments_lock = threading.Lock()
+        self.pending_catalog = None     # newest (catalog, event_tournaments) not published yet, see _publisher
+        self.publish_ready = threading.Condition()
+        self.publisher = None
+        self.stopping = False
+        self.max_age_ns = config.QUOTE_MAX_AGE_MS * 1_000_000
+        self.dropped_full = 0
+        self.dropped_stale = 0      # on arrival only, the workers report theirs in quote_dropped_stale_total
+
+    @property
+    def queued(self) -> int:
+        try:
+            return sum(q.qsize() for q in self.jobs)
+        except NotImplementedError:     # macOS has no qsize
+            return 0
+
+    def start(self):
+        if self.workers:
+            return
+        segment = self._publish((self.client.catalog, self.client.event_tournaments))
+        for i in range(self.processes):
+            worker = self.context.Process(target=run_worker, name=f'quote-process-{i}', daemon=True,
+                                          args=(i, self.jobs[i], self.controls[i], self.results,
+                                                segment.name, segment.size,
+                                                dict(self.client.mm_session), self.processes,
+                                                self.client.exposure_ledger.balance, logging.getLogger().level))
+            worker.start()
+            self.workers.append(worker)
+        threading.Thread(target=self._collect, name='worker-metrics', daemon=True).start()
+        self.stopping = False
+        self.publisher = threading.Thread(target=self._publisher, name='catalog-publisher', daemon=True)
+        self.publisher.start()
+        logging.info(f"started {self.processes} quote processes")
+
+    def stop(self):
+        # the publisher goes first, no segment is made or broadcast after this. The workers are
+        # told on their control queues, a full job queue can not hold up the stop
+        with self.publish_ready:
+            self.stopping = True
+            self.publish_ready.notify()
+        if self.publisher is not None:
+            self.publisher.join()
+            self.publisher = None
+        self.broadcast(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        with self.segments_lock:
+            for segment, _ in self.segments:
+                segment.close()
+                segment.unlink()
+            self.segments = []
+
+    def submit(self, parlay_id: str, handler, payload, sheddable: bool = True) -> bool:
+        if sheddable:
+            # asks are priced in the workers, recency for the catalog budget is kept and missing
+            # markets are loaded here. The ask goes on without them, the asks after it find them
+            # in the next published catalog
+            self.client.lifecycle.touch(payload.market_lines)
+            self.client.market_loader.prefetch(payload.market_lines)
+        jobs = self.jobs[zlib.crc32(parlay_id.encode()) % self.processes]
+        job = (handler.__name__, payload)
+        if not sheddable:
+            jobs.put(job)
+            return True
+        try:
+            jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            self.dropped_full += 1
+            return False
+
+    def is_stale(self, payload) -> bool:
+        return is_stale(payload, self.max_age_ns)
+
+    def drop_stale(self):
+        self.dropped_stale += 1
+        DROPPED_STALE.inc()
+
+    def publish_catalog(self, catalog: LineCatalog, event_tournaments: dict):
+        # picked up by _publisher, catalogs replaced before it gets to them are never published
+        if not self.workers:
+            return
+        with self.publish_ready:
+            self.pending_catalog = (catalog, event_tournaments)
+            self.publish_ready.notify()
+
+    def _publisher(self):
+        # at most one publish per CATALOG_PUBLISH_INTERVAL, markets loaded on demand can swap the
+        # catalog many times a second
+        while True:
+            with self.publish_ready:
+                self.publish_ready.wait_for(lambda: self.stopping or self.pending_catalog is not None)
+                if self.stopping:
+                    return
+                published, self.pending_catalog = self.pending_catalog, None
+            segment = self._publish(published)
+            self.broadcast(('catalog', segment.name, segment.size))
+            with self.publish_ready:
+                if self.publish_ready.wait_for(lambda: self.stopping, config.CATALOG_PUBLISH_INTERVAL):
+                    return
+
+    def broadcast(self, job: tuple):
+        # control queues are unbounded, this never blocks
+        for controls in self.controls:
+            controls.put(job)
+
+    def _publish(self, published: tuple) -> shared_memory.SharedMemory:
+        # keep previous segments alive for CATALOG_SEGMENT_TTL, a worker may still be loading one.
+        # A worker that comes too late skips it, a newer catalog is queued behind it
+        segment = publish_catalog(*published)
+        now = time.monotonic()
+        with self.segments_lock:
+            self.segments.append((segment, now))
+            while len(self.segments) > 1 and self.segments[1][1] < now - config.CATALOG_SEGMENT_TTL:
+                old, _ = self.segments.pop(0)
+                old.close()
+                old.unlink()
+        return segment
+
+    def _collect(self):
+        while True:
+            worker_id, raw = self.results.get()
+            registry.set_remote(worker_id, raw)
+
+
+class QuoteSupervisor(ParlayInteractions):
+    # ParlayInteractions whose quote handling runs in worker processes, see ProcessDispatcher
+    def __init__(self, processes: int = None):
+        super().__init__()
+        self.dispatcher = ProcessDispatcher(self, processes)
+
+    def _set_session(self, mm_session: dict):
+        super()._set_session(mm_session)
+        self.dispatcher.broadcast(('token', mm_session['access_token']))
+
+    def _install(self, *args, **kwargs):
+        # seeds, evictions and re-fetched events all reach the workers
+        super()._install(*args, **kwargs)
+        self.dispatcher.publish_catalog(self.catalog, self.event_tournaments)
+
+    def _settle_events(self, event_ids: set):
+        # the parlays are in the workers' ledgers
+        super()._settle_events(event_ids)
+        if event_ids and self.dispatcher.workers:
+            self.dispatcher.broadcast(('settle', set(event_ids)))
+
+    def get_balance(self):
+        balance = super().get_balance()
+        if balance is not None:
+            self.dispatcher.broadcast(('balance', balance))
+        return balance
+
+
+def run_worker(worker_id: int, jobs, controls, results, segment_name: str, segment_size: int,
+               mm_session: dict, processes: int, balance: float, log_level: int):
+    # worker process main: its own AsyncParlayInteractions (pricing, quote cache, one pooled aiohttp
+    # session for the posts, a task per ask) on this process' event loop, a thread feeding it from
+    # the supervisor's job queue, and a thread applying what comes on its control queue. Posting
+    # from the event loop takes about a third of the cpu the threaded client's HTTP stack does.
+    # Every worker holds the exposure of its own parlays, against an equal share of the limits and
+    # balance
+    logging.getLogger().setLevel(log_level)
+    client = AsyncParlayInteractions()
+    client.market_loader.enabled = False
+    client.exposure_ledger = ExposureLedger(share=1 / processes)
+    if balance is not None:
+        client.exposure_ledger.reconcile(balance)
+    client._set_session(mm_session)
+    client._load_valid_odds()
+    client.catalog, client.event_tournaments = _load_published(segment_name, segment_size) or (LineCatalog(), {})
+    asyncio.run(_serve(client, worker_id, jobs, controls, results))
+    results.put((worker_id, registry.raw()))
+
+
+async def _serve(client: AsyncParlayInteractions, worker_id: int, jobs, controls, results):
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    stopping = threading.Event()
+
+    def start(handler_name: str, payload):
+        # on the event loop, the confirm of a parlay waits for the task of its ask
+        if handler_name == 'provide_price':
+            client.start_ask(payload)
+        elif handler_name == 'confirm_price':
+            client._spawn(client._confirm_after_ask(payload))
+        else:
+            getattr(client, handler_name)(payload)
+
+    def read():
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            if not stopping.is_set():
+                loop.call_soon_threadsafe(start, *job)
+        loop.call_soon_threadsafe(stopped.set)
+
+    def report():
+        while True:
+            time.sleep(config.METRICS_INTERVAL)
+            results.put((worker_id, registry.raw()))
+
+    def control():
+        while True:
+            job = controls.get()
+            if job is None:
+                # the reader skips what is queued ahead of the sentinel, this worker drains its
+                # own queue so the put can only wait on jobs that are about to be dropped
+                stopping.set()
+                jobs.put(None)
+                return
+            kind = job[0]
+            if kind == 'catalog':
+                published = _load_published(job[1], job[2])
+                if published is not None:
+                    client.catalog, client.event_tournaments = published
+                    client.quote_cache.clear()
+            elif kind == 'token':
+                loop.call_soon_threadsafe(client._set_session, {**client.mm_session, 'access_token': job[1]})
+            elif kind == 'balance':
+                client.exposure_ledger.reconcile(job[1])
+            elif kind == 'settle':
+                client.exposure_ledger.settle_events(job[1])
+
+    threading.Thread(target=read, name='worker-jobs', daemon=True).start()
+    threading.Thread(target=report, name='metrics-report', daemon=True).start()
+    threading.Thread(target=control, name='worker-control', daemon=True).start()
+    await stopped.wait()
+    # what was started is answered before the session goes
+    await asyncio.gather(*client.background_tasks, return_exceptions=True)
+    if client.session is not None:
+        await client.session.close()
+
+
+def _load_published(name: str, size: int):
+    # None when the segment is gone already, a newer one was published after it
+    try:
+        return load_catalog(name, size)
+    except FileNotFoundError:
+        logging.info(f"catalog segment {name} was replaced before it was loaded")
+        return None
+
+
+def bench(processes: list, asks: int, legs: int, loops: int) -> dict:
+    # replays synthetic asks as fast as the replay.StandIn pusher can push them, through the
+    # threaded client and through the sharded one at each process count
+    from src import replay
+    results = {'cpus': os.cpu_count()}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'supervisor.replay.gz')
+        replay.synthesize(path, tournaments=20, events=50, asks=asks, legs=legs)
+        runs = [('threaded', 'threaded', None)] + [(f'processes_{n}', 'sharded', n) for n in processes]
+        for name, client_kind, n in runs:
+            config.QUOTE_PROCESSES = n or config.QUOTE_PROCESSES
+            report = replay.run(path, 0, client_kind, loops)
+            results[name] = {'throughput_per_s': report['throughput_per_s'], 'ask_latency_ms': report['ask_latency_ms'],
+                             'unanswered_asks': report['errors']['unanswered_asks']}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.supervisor', description='sharded quoting tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='replay load test, threaded vs sharded over N processes')
+    p.add_argument('--processes', type=int, nargs='+',
+                   default=[n for n in (1, 2, 4, 8, 16, 32) if n <= (os.cpu_count() or 1)])
+    p.add_argument('--asks', type=int, default=20000)
+    p.add_argument('--legs', type=int, default=4)
+    p.add_argument('--loops', type=int, default=1)
+    args = parser.parse_args()
+    sys.stdout.write(codec.dumps(bench(args.processes, args.asks, args.legs, args.loops)).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
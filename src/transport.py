@@ -0,0 +1,109 @@
+import argparse
+import sys
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from src import config
+from src import codec
+from src.log import logging
+from src.metrics import Histogram
+
+#   python -m src.transport bench --requests 2000    cold vs pooled round trips to a local stand-in
+
+
+class Transport:
+    # one pooled, keep-alive requests.Session shared by every REST call, so quote callbacks
+    # reuse an open TCP+TLS connection instead of handshaking on each request
+    session: requests.Session = None
+    auth_header: dict = dict()
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=config.HTTP_POOL_HOSTS, pool_maxsize=config.HTTP_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.auth_header = dict()
+        self._warmed_hosts = set()
+        self._lock = threading.Lock()
+
+    def set_access_token(self, access_token: str):
+        # swap the whole dict so concurrent requests see either the old or the new token
+        self.auth_header = {'Authorization': f'Bearer {access_token}'}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        request_headers = self.auth_header
+        if headers:
+            request_headers = {**request_headers, **headers}
+        return self.session.request(method, url, headers=request_headers,
+                                    timeout=timeout or config.REQUEST_TIMEOUT, **kwargs)
+
+    def warm(self, url: str, connections: int = None, wait: bool = True):
+        # open `connections` keep-alive sockets to the host of url ahead of the first real request
+        parts = urlsplit(url)
+        host = f'{parts.scheme}://{parts.netloc}/'
+        with self._lock:
+            if host in self._warmed_hosts:
+                return
+            self._warmed_hosts.add(host)
+        connections = connections or config.HTTP_WARM_CONNECTIONS
+
+        def touch():
+            try:
+                self.session.head(host, timeout=config.REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                logging.info(f"failed to warm connection to {host}, error: {e}")
+
+        threads = [threading.Thread(target=touch, daemon=True) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        if wait:
+            for thread in threads:
+                thread.join()
+        logging.info(f"warming {connections} connections to {host}")
+
+
+def bench(count: int) -> dict:
+    # round trip latency of an offer sized POST to replay.StandIn: a new connection per request as
+    # the module level requests calls did, vs the pooled keep-alive Transport. Plain http on
+    # loopback, so the cold numbers leave out the TLS handshake a real host adds on top
+    from src import replay
+    stand_in = replay.StandIn({})
+    stand_in.start()
+    url = f'{stand_in.base_url}bench/offers'
+    body = codec.dumps({'data': {'parlay_id': 'bench', 'offers': [{'odds': 500, 'max_risk': 100}]}})
+    transport = Transport()
+    transport.warm(url)
+    results = dict()
+    for name, post in (('cold', lambda: requests.post(url, data=body, timeout=config.REQUEST_TIMEOUT)),
+                       ('pooled', lambda: transport.post(url, data=body))):
+        latency = Histogram(name)
+        for _ in range(count):
+            started = time.perf_counter_ns()
+            if post().status_code != 200:
+                raise Exception(f"{name} request to the stand-in failed")
+            latency.record(time.perf_counter_ns() - started)
+        results[name] = {q: round(latency.percentile(p) / 1e6, 3) for q, p in (('p50_ms', 50), ('p99_ms', 99))}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.transport', description='http transport tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='cold vs pooled round trips to a local stand-in')
+    p.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    sys.stdout.write(codec.dumps(bench(args.requests)).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()
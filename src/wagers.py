@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from src import config
+from src import codec
+from src.log import logging
+from src.metrics import Histogram, registry
+
+# bulk cancellation of our open wagers, e.g. before quoting or after batch bet/cancel tests. The
+# open wagers are listed page by page and cancelled WAGER_CANCEL_BATCH per request, posted
+# WAGER_CANCEL_CONCURRENCY at a time and no more than WAGER_CANCEL_RATE requests a second.
+# Connection errors, 429 and 5xx are retried with backoff. Then the list is read again and what
+# is still open goes through another round, WAGER_CANCEL_ROUNDS at most. A wager can also leave the
+# open list by getting matched meanwhile, so the ones gone are looked up among the cancelled
+# wagers and only those count as cancelled. At the end the balance has to be back up by the
+# unmatched stake of every cancelled wager; when the balance can not be read before cancelling,
+# that check is skipped and reported as such.
+#   python -m src.wagers bench --wagers 5000    cancel against a local stand-in of the wager api
+
+CANCEL_BATCH = registry.histogram('wager_cancel_batch_ns')
+CANCEL_RETRIED = registry.counter('wager_cancel_retried_total')
+CANCEL_FAILED = registry.counter('wager_cancel_failed_total')   # batches given up on
+
+
+def wager_id(wager: dict):
+    return wager.get('id', wager.get('wager_id'))
+
+
+def unmatched_stake(wager: dict) -> float:
+    # what cancelling the wager gives back
+    return float(wager.get('unmatched_stake', wager.get('stake', 0)) or 0)
+
+
+class Pacer:
+    # spaces calls at least 1/rate seconds apart across threads
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next, now)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class WagerCanceller:
+    # cancels through the threaded client's transport and session
+    def __init__(self, client, batch: int = None, concurrency: int = None, rate: float = None):
+        self.client = client
+        self.batch = batch or config.WAGER_CANCEL_BATCH
+        self.concurrency = concurrency or config.WAGER_CANCEL_CONCURRENCY
+        self.pacer = Pacer(config.WAGER_CANCEL_RATE if rate is None else rate)
+        self.latency = Histogram('wager_cancel_batch')
+        self.requests = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.lock = threading.Lock()
+
+    def open_wagers(self) -> list:
+        return self.list_wagers('open')
+
+    def list_wagers(self, status: str, wanted: set = None) -> list:
+        # with wanted, the listing stops at the page where the last of those wager ids shows up
+        url = urljoin(self.client.base_url, config.URL['mm_wager_histories'])
+        wagers = []
+        missing = set(wanted) if wanted is not None else None
+        cursor = None
+        while True:
+            params = {'status': status, 'limit': config.WAGER_PAGE_SIZE}
+            if cursor:
+                params['next_cursor'] = cursor
+            response = self.client._get_with_retry(url, params=params)
+            if response.status_code != 200:
+                raise Exception(f"failed to list {status} wagers, status {response.status_code}")
+            data = codec.loads(response.content).get('data') or {}
+            page = data.get('wagers') or []
+            wagers.extend(page)
+            if missing is not None:
+                missing.difference_update(wager_id(wager) for wager in page)
+                if not missing:
+                    return wagers
+            cursor = data.get('next_cursor')
+            if not cursor or not page:
+                return wagers
+
+    def cancel_all(self) -> dict:
+        started = time.monotonic()
+        balance_before = self.client.get_balance()
+        if balance_before is None:
+            logging.error("could not read the balance before cancelling, the returned stakes will not be checked")
+        wagers = self.open_wagers()
+        stakes = {wager_id(wager): unmatched_stake(wager) for wager in wagers}
+        remaining = wagers
+        rounds = 0
+        while remaining and rounds < config.WAGER_CANCEL_ROUNDS:
+            rounds += 1
+            self._cancel(remaining)
+            remaining = self.open_wagers()
+        cancel_seconds = time.monotonic() - started
+        still_open = {wager_id(wager) for wager in remaining}
+        gone = {w_id for w_id in stakes if w_id not in still_open}
+        cancelled = []
+        if gone:
+            listed = {wager_id(wager) for wager in self.list_wagers(config.WAGER_CANCELLED_STATUS, gone)}
+            cancelled = [w_id for w_id in gone if w_id in listed]
+        expected = balance = None
+        if balance_before is not None:
+            expected = round(balance_before + sum(stakes[w_id] for w_id in cancelled), 2)
+            balance = self._settled_balance(expected)
+        report = {
+            'wagers': len(wagers),
+            'cancelled': len(cancelled),
+            'closed_otherwise': len(gone) - len(cancelled),
+            'still_open': len(still_open),
+            'rounds': rounds,
+            'requests': self.requests,
+            'retries': self.retries,
+            'failed_batches': self.failed_batches,
+            'seconds': round(cancel_seconds, 3),
+            'wagers_per_s': round(len(cancelled) / cancel_seconds, 1) if cancel_seconds else 0,
+            'batch_latency_ms': {q: round(self.latency.percentile(p) / 1e6, 3)
+                                 for q, p in (('p50', 50), ('p99', 99), ('max', 100))},
+            'balance_before': balance_before,
+            'balance_after': balance,
+            'balance_expected': expected,
+            'balance_ok': None if expected is None else balance is not None and abs(balance - expected) < 0.01,
+        }
+        if report['still_open'] or report['balance_ok'] is False:
+            logging.error(f"wager cancellation incomplete, {report}")
+        return report
+
+    def _cancel(self, wagers: list):
+        batches = [wagers[i:i + self.batch] for i in range(0, len(wagers), self.batch)]
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='wager-cancel') as pool:
+            list(pool.map(self._cancel_batch, batches))
+
+    def _cancel_batch(self, batch: list) -> bool:
+        url = urljoin(self.client.base_url, config.URL['mm_batch_cancel'])
+        body = codec.dumps({'data': [{'wager_id': wager_id(wager), 'external_id': wager.get('external_id')}
+                                     for wager in batch]})
+        delay = config.RETRY_BACKOFF
+        for attempt in range(config.WAGER_CANCEL_RETRIES + 1):
+            self.pacer.wait()
+            sent = time.perf_counter_ns()
+            try:
+                response = self.client.transport.post(url, data=body)
+                status, error = response.status_code, None
+            except requests.RequestException as e:
+                status, error = None, e
+            elapsed = time.perf_counter_ns() - sent
+            self.latency.record(elapsed)
+            CANCEL_BATCH.record(elapsed)
+            with self.lock:
+                self.requests += 1
+            if status == 200:
+                return True
+            if status is not None and status < 500 and status != 429:
+                break
+            if attempt < config.WAGER_CANCEL_RETRIES:
+                with self.lock:
+                    self.retries += 1
+                CANCEL_RETRIED.inc()
+                time.sleep(delay)
+                delay *= 2
+        with self.lock:
+            self.failed_batches += 1
+        CANCEL_FAILED.inc()
+        logging.error(f"failed to cancel a batch of {len(batch)} wagers, status {status}, error {error}")
+        return False
+
+    def _settled_balance(self, expected: float):
+        # the exchange may credit the stakes back a little after the cancels return. The last balance
+        # read, None when no read succeeded
+        deadline = time.monotonic() + config.WAGER_BALANCE_TIMEOUT
+        balance = None
+        while True:
+            read = self.client.get_balance()
+            if read is not None:
+                balance = read
+                if abs(balance - expected) < 0.01:
+                    return balance
+            if time.monotonic() >= deadline:
+                return balance
+            time.sleep(1)
+
+
+def _stand_in_class():
+    from aiohttp import web
+    from src.replay import StandIn
+
+    class WagerStandIn(StandIn):
+        # replay.StandIn answering the wager api from an in-memory book: open and cancelled wagers
+        # paged by cursor, batch cancels crediting the unmatched stake back, latency per request,
+        # error_rate of the cancels failing with a 503, 429 above rate_limit cancels a second and
+        # `matched` open wagers matched when the first cancel comes in
+        def __init__(self, wagers: int, balance: float, latency: float = 0, error_rate: float = 0,
+                     rate_limit: float = 0, matched: int = 0, seed: int = 1):
+            super().__init__({})
+            rng = random.Random(seed)
+            self.open = {i: {'id': i, 'external_id': f'bench-{i}', 'stake': 10.0,
+                             'unmatched_stake': float(rng.choice((10, 10, 10, 7.5, 2.5)))}
+                         for i in range(1, wagers + 1)}
+            self.cancelled = dict()
+            self.to_match = matched
+            self.balance = balance
+            self.latency = latency
+            self.error_rate = error_rate
+            self.rate_limit = rate_limit
+            self.rng = rng
+            self.window = (0, 0)    # second, cancels in it
+
+        async def _rest(self, request):
+            path = request.path
+            if path.endswith(config.URL['mm_wager_histories']):
+                limit = int(request.query.get('limit', 100))
+                after = int(request.query.get('next_cursor', 0))
+                book = self.cancelled if request.query.get('status') == config.WAGER_CANCELLED_STATUS else self.open
+                page = [wager for w_id, wager in sorted(book.items()) if w_id > after][:limit]
+                cursor = str(page[-1]['id']) if len(page) == limit else None
+                return web.json_response({'data': {'wagers': page, 'next_cursor': cursor}})
+            if path.endswith(config.URL['mm_batch_cancel']):
+                if self.to_match:
+                    # matched stakes stay with the exchange
+                    for w_id in self.rng.sample(sorted(self.open), min(self.to_match, len(self.open))):
+                        del self.open[w_id]
+                    self.to_match = 0
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                second = int(time.monotonic())
+                count = self.window[1] + 1 if self.window[0] == second else 1
+                self.window = (second, count)
+                if self.rate_limit and count > self.rate_limit:
+                    return web.json_response({'error': 'too many requests'}, status=429)
+                if self.rng.random() < self.error_rate:
+                    return web.json_response({'error': 'unavailable'}, status=503)
+                for item in codec.loads(await request.read())['data']:
+                    wager = self.open.pop(item['wager_id'], None)
+                    if wager is not None:
+                        self.cancelled[item['wager_id']] = wager
+                        self.balance += wager['unmatched_stake']
+                return web.json_response({'data': {}})
+            if path.endswith(config.URL['mm_balance']):
+                return web.json_response({'data': {'balance': round(self.balance, 2)}})
+            return await super()._rest(request)
+
+    return WagerStandIn
+
+
+def bench(wagers: int, batch: int, concurrency: int, rate: float, latency_ms: float, error_rate: float,
+          rate_limit: float, matched: int) -> dict:
+    from src.parlay_connect import ParlayInteractions
+    from src.replay import point_at
+    stand_in = _stand_in_class()(wagers, 100000, latency_ms / 1000, error_rate, rate_limit, matched)
+    stand_in.start()
+    point_at(stand_in)
+    client = ParlayInteractions()
+    client.login()
+    return WagerCanceller(client, batch, concurrency, rate).cancel_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m src.wagers', description='bulk wager cancellation')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('bench', help='cancel against a local stand-in of the wager api')
+    p.add_argument('--wagers', type=int, default=5000)
+    p.add_argument('--batch', type=int, default=config.WAGER_CANCEL_BATCH)
+    p.add_argument('--concurrency', type=int, default=config.WAGER_CANCEL_CONCURRENCY)
+    p.add_argument('--rate', type=float, default=config.WAGER_CANCEL_RATE, help='cancel requests per second, 0 for no limit')
+    p.add_argument('--latency-ms', type=float, default=20, help='stand-in time per cancel request')
+    p.add_argument('--error-rate', type=float, default=0.05, help='share of cancel requests failing with 503')
+    p.add_argument('--rate-limit', type=float, default=0, help='stand-in cancel requests per second before 429')
+    p.add_argument('--matched', type=int, default=0, help='open wagers the stand-in matches while they are cancelled')
+    args = parser.parse_args()
+    report = bench(args.wagers, args.batch, args.concurrency, args.rate, args.latency_ms, args.error_rate,
+                   args.rate_limit, args.matched)
+    sys.stdout.write(codec.dumps(report).decode() + '\n')
+
+
+if __name__ == '__main__':
+    main()